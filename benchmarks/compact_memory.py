@@ -0,0 +1,92 @@
+"""Benchmark the memory of compact trees against nested dicts
+
+Builds an etcd-like configuration tree (many services with the same
+fields and repeated values, every value a freshly decoded str like
+ConManEtcd stores it) and measures the memory the tree holds with
+ConManBase(compact=False) and ConManBase(compact=True), along with the
+time it takes to publish the tree and to look values up. Example:
+
+    python -m benchmarks.compact_memory --keys 100000 1000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from conman.conman_base import ConManBase
+
+REGIONS = [b'us-east-1', b'us-west-2', b'eu-west-1', b'ap-south-1']
+
+
+def make_kvs(count, fields=10):
+    """Generate the flat keys and raw values of count etcd keys"""
+    for i in range(count):
+        service = i // fields
+        region = REGIONS[service % len(REGIONS)]
+        field = i % fields
+        if field == 0:
+            value = b'svc-%d.%s.internal' % (service % 500, region)
+        elif field == 1:
+            value = region
+        elif field == 2:
+            value = b'true' if service % 3 else b'false'
+        else:
+            value = b'%d' % (field * 100 + service % 7)
+        yield b'config/svc_%d/field_%d' % (service, field), value
+
+
+def build_tree(count):
+    """Build a nested dict the way ConManEtcd._add_key_recursively does"""
+    tree = {}
+    for key, value in make_kvs(count):
+        parent, _, name = key.decode().rpartition('/')
+        t = tree
+        for c in parent.split('/'):
+            t = t.setdefault(c, {})
+        t[name] = value.decode()
+    return tree
+
+
+def measure(count, compact):
+    gc.collect()
+    tracemalloc.start()
+    conman = ConManBase(compact=compact)
+    tree = build_tree(count)
+    start = time.perf_counter()
+    conman._publish(tree)
+    publish_seconds = time.perf_counter() - start
+    del tree
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    services = count // 10
+    config = conman['config']
+    start = time.perf_counter()
+    for i in range(0, services, max(1, services // 1000)):
+        config['svc_%d' % i]['field_1']
+    lookup_seconds = time.perf_counter() - start
+    return dict(size_mb=size / 2 ** 20,
+                peak_mb=peak / 2 ** 20,
+                publish_seconds=publish_seconds,
+                lookup_seconds=lookup_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--keys', type=int, nargs='+', default=[100000])
+    args = parser.parse_args()
+
+    print('%10s %8s %10s %10s %12s %12s' % (
+        'keys', 'compact', 'size(MB)', 'peak(MB)', 'publish(s)',
+        'lookups(s)'))
+    for count in args.keys:
+        for compact in False, True:
+            r = measure(count, compact)
+            print('%10d %8s %10.1f %10.1f %12.3f %12.4f' % (
+                count, compact, r['size_mb'], r['peak_mb'],
+                r['publish_seconds'], r['lookup_seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark the peak memory and time of loading a large JSON config
+
+Generates a feature-flag style JSON config of roughly the requested size
+and loads it in a fresh process per mode, so the peak RSS of every mode is
+measured separately:
+
+    read    - json.load() from a text-mode file (how ConManFile used to load)
+    json    - ConManFile with the json module parsing the mmapped file
+    orjson  - ConManFile with orjson parsing the mmapped file (if installed)
+    lazy    - ConManFile(lazy_json=True), accessing a single top-level key
+
+Example:
+
+    python -m benchmarks.json_memory --mb 50 200
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from conman import conman_file
+from conman.conman_file import ConManFile
+
+MODES = ['read', 'json', 'orjson', 'lazy']
+
+
+def make_json(size_mb, groups=100):
+    """Generate a JSON config of about size_mb MB
+
+    The flags are spread over the given number of top-level groups.
+    """
+    flag = json.dumps(dict(enabled=True,
+                           rollout=50,
+                           segments=['beta', 'internal', 'eu-west'],
+                           owner='team-platform',
+                           description='x' * 40))
+    count = size_mb * 2 ** 20 // (len(flag) + 20) + 1
+    per_group = count // groups + 1
+    parts = []
+    for g in range(groups):
+        flags = ','.join('"flag_%d":%s' % (i, flag)
+                         for i in range(g * per_group, (g + 1) * per_group))
+        parts.append('"group_%d":{%s}' % (g, flags))
+    return '{' + ','.join(parts) + '}'
+
+
+def _max_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def load(mode, filename):
+    """Load the file in the given mode and print the duration and peak RSS"""
+    base_rss = _max_rss_mb()
+    start = time.perf_counter()
+    if mode == 'read':
+        with open(filename) as f:
+            conf = json.load(f)
+        conf['group_0']
+    elif mode == 'lazy':
+        c = ConManFile([filename], lazy_json=True)
+        c['group_0']
+    else:
+        c = ConManFile([filename], json_parser=mode)
+        c['group_0']
+    duration = time.perf_counter() - start
+    print(json.dumps(dict(seconds=duration,
+                          peak_mb=_max_rss_mb() - base_rss)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mb', type=int, nargs='+', default=[50])
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--generate', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        load(*args.child)
+        return
+    if args.generate:
+        with open(args.generate[1], 'w') as f:
+            f.write(make_json(int(args.generate[0])))
+        return
+
+    modes = [m for m in args.modes
+             if m != 'orjson' or conman_file.orjson is not None]
+    print('%8s %8s %10s %14s' % ('MB', 'mode', 'seconds', 'peak RSS MB'))
+    for size_mb in args.mb:
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        # Children inherit the peak RSS of their parent on Linux, so the
+        # parent never holds a big config itself
+        command = [sys.executable, '-m', 'benchmarks.json_memory']
+        subprocess.check_call(command + ['--generate',
+                                         str(size_mb),
+                                         filename])
+        file_mb = os.path.getsize(filename) / 2 ** 20
+        for mode in modes:
+            out = subprocess.check_output(command + ['--child',
+                                                     mode,
+                                                     filename])
+            result = json.loads(out)
+            print('%8.1f %8s %10.2f %14.1f' % (file_mb,
+                                               mode,
+                                               result['seconds'],
+                                               result['peak_mb']))
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark lazy loading of a big shared etcd prefix
+
+Compares add_key() with add_key(lazy=True) when a process reads a single
+service out of a prefix shared by many. Every load runs in a fresh process
+so its peak RSS can be measured, in addition to the tracemalloc peak of
+Python objects. Tracing slows the load down, so the durations come from
+another run without it.
+
+Requires etcd at /usr/local/bin/etcd (see the README). Example:
+
+    python -m benchmarks.lazy_load --sizes 10000 100000
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from conman.conman_etcd import ConManEtcd
+from conman.etcd_test_util import start_local_etcd_server, delete_key
+
+PREFIX = 'bench_lazy'
+SERVICES = 1000
+
+
+def populate(client, count, batch=128):
+    delete_key(client, PREFIX)
+    value = 'x' * 100
+    for start in range(0, count, batch):
+        puts = [client.transactions.put(
+            '%s/svc_%d/field_%d' % (PREFIX, i % SERVICES, i), value)
+            for i in range(start, min(start + batch, count))]
+        client.transaction(compare=[], success=puts, failure=[])
+
+
+def _load(lazy, page_size, trace, queue):
+    conman = ConManEtcd(page_size=page_size)
+    conman.client.status()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    conman.add_key(PREFIX, lazy=lazy)
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    conman[PREFIX]['svc_7']
+    read_seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    if trace:
+        tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(dict(load_seconds=load_seconds,
+                   read_seconds=read_seconds,
+                   tracemalloc_peak_mb=peak / 2 ** 20,
+                   rss_growth_mb=(rss_after - rss_before) / 2 ** 10))
+
+
+def _run(lazy, page_size, trace):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_load, args=(lazy, page_size, trace, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def measure(lazy, page_size):
+    result = _run(lazy, page_size, trace=True)
+    timed = _run(lazy, page_size, trace=False)
+    result.update(load_seconds=timed['load_seconds'],
+                  read_seconds=timed['read_seconds'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000])
+    # Big prefixes exceed the default gRPC message size limit of 4MB
+    parser.add_argument('--page-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    start_local_etcd_server()
+    client = ConManEtcd().client
+    print('%10s %6s %10s %10s %16s %10s' % (
+        'keys', 'lazy', 'load(s)', 'read(s)', 'tracemalloc(MB)', 'rss(MB)'))
+    for size in args.sizes:
+        populate(client, size)
+        for lazy in False, True:
+            r = measure(lazy, args.page_size)
+            print('%10d %6s %10.3f %10.4f %16.1f %10.1f' % (
+                size, lazy, r['load_seconds'], r['read_seconds'],
+                r['tracemalloc_peak_mb'], r['rss_growth_mb']))
+    delete_key(client, PREFIX)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Microbenchmark path lookups and tree building
+
+Compares the flat path index of ConManBase.get() with walking the nested
+dicts component by component, and building the tree from a sorted etcd
+result by reusing parent dicts with walking from the root for every key.
+
+No etcd server is needed, the etcd result is synthetic. Example:
+
+    python -m benchmarks.lookup --keys 100000
+"""
+import argparse
+import random
+import timeit
+from collections import namedtuple
+
+from conman.conman_etcd import ConManEtcd
+
+Header = namedtuple('Header', 'revision')
+Metadata = namedtuple('Metadata', 'key response_header')
+
+
+def make_etcd_result(count):
+    header = Header(1)
+    # Every item has 20 fields, like a typical config record
+    keys = sorted('svc%d/group%d/item%d/field%d' % (
+        i // 20 % 10, i // 20 % 97, i // 20, i % 20) for i in range(count))
+    return [(('value-%d' % i).encode(), Metadata(k.encode(), header))
+            for i, k in enumerate(keys)]
+
+
+def walk_from_root(conf, etcd_result):
+    """The tree building before parent reuse, for comparison"""
+    for x in etcd_result:
+        components = x[1].key.decode().split('/')
+        t = conf
+        for c in components[:-1]:
+            if c not in t:
+                t[c] = {}
+            t = t[c]
+        t[components[-1]] = x[0].decode()
+
+
+def walk_path(conf, path):
+    t = conf
+    for c in path.split('/'):
+        t = t[c]
+    return t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    etcd_result = make_etcd_result(args.keys)
+    # The client connects lazily, so no etcd server is needed
+    conman = ConManEtcd()
+
+    def build_reusing_parents():
+        tree = {}
+        conman._add_key_recursively(etcd_result, tree)
+        conman._publish(tree)
+
+    def build_from_root():
+        walk_from_root({}, etcd_result)
+
+    number = 3
+    for name, f in [('build (walk from root)', build_from_root),
+                    ('build (reuse parents)', build_reusing_parents)]:
+        t = min(timeit.repeat(f, number=1, repeat=number))
+        print('%-28s %10.1f ms' % (name, t * 1000))
+
+    paths = [x[1].key.decode() for x in
+             random.sample(etcd_result, min(args.lookups, len(etcd_result)))]
+    dotted = [p.replace('/', '.') for p in paths]
+    conf = conman._conf
+    conman.get(paths[0])
+
+    def nested():
+        for p in paths:
+            walk_path(conf, p)
+
+    def chained():
+        for p in paths:
+            c = p.split('/')
+            conf[c[0]][c[1]][c[2]][c[3]]
+
+    def indexed():
+        get = conman.get
+        for p in paths:
+            get(p)
+
+    def indexed_dotted():
+        get = conman.get
+        for p in dotted:
+            get(p)
+
+    for name, f in [('lookup (nested walk)', nested),
+                    ('lookup (chained [])', chained),
+                    ('lookup (get /)', indexed),
+                    ('lookup (get .)', indexed_dotted)]:
+        t = min(timeit.repeat(f, number=1, repeat=number))
+        print('%-28s %10.1f ns/lookup' % (name, t * 1e9 / len(paths)))
+
+
+if __name__ == '__main__':
+    main()
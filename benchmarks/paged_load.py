@@ -0,0 +1,80 @@
+"""Benchmark the peak memory of loading a huge etcd prefix
+
+Compares a single get_prefix load with paginated loads of several page
+sizes as the prefix grows. Every load runs in a fresh process so its peak
+RSS can be measured, in addition to the tracemalloc peak of Python objects.
+
+Requires etcd at /usr/local/bin/etcd (see the README). Example:
+
+    python -m benchmarks.paged_load --sizes 1000 10000 100000 1000000
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from conman.conman_etcd import ConManEtcd
+from conman.etcd_test_util import start_local_etcd_server, delete_key
+
+PREFIX = 'bench_paged'
+
+
+def populate(client, count, batch=128):
+    delete_key(client, PREFIX)
+    for start in range(0, count, batch):
+        puts = [client.transactions.put('%s/%d/%07d' % (PREFIX, i % 100, i),
+                                        'value-%d' % i)
+                for i in range(start, min(start + batch, count))]
+        client.transaction(compare=[], success=puts, failure=[])
+
+
+def _load(page_size, queue):
+    conman = ConManEtcd(page_size=page_size)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+    conman.add_key(PREFIX)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(dict(seconds=duration,
+                   tracemalloc_peak_mb=peak / 2 ** 20,
+                   rss_growth_mb=(rss_after - rss_before) / 2 ** 10))
+
+
+def measure(page_size):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_load, args=(page_size, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--page-sizes', type=int, nargs='+',
+                        default=[1000, 10000])
+    args = parser.parse_args()
+
+    start_local_etcd_server()
+    client = ConManEtcd().client
+    print('%10s %10s %10s %16s %14s' % (
+        'keys', 'page_size', 'seconds', 'tracemalloc(MB)', 'rss(MB)'))
+    for size in args.sizes:
+        populate(client, size)
+        for page_size in [None] + args.page_sizes:
+            r = measure(page_size)
+            print('%10d %10s %10.3f %16.1f %14.1f' % (
+                size, page_size or 'all', r['seconds'],
+                r['tracemalloc_peak_mb'], r['rss_growth_mb']))
+    delete_key(client, PREFIX)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Stress concurrent readers against a writer publishing snapshots
+
+Reader threads read two values that the writer always changes together
+and count any inconsistent pair, while the writer alternates between
+publishing whole new trees and single-path updates. Reports the read and
+write throughput and the number of inconsistent reads, which must be 0.
+
+No etcd server is needed. Example:
+
+    python -m benchmarks.snapshot_stress --readers 8 --seconds 5
+"""
+import argparse
+import threading
+import time
+
+from conman.conman_base import ConManBase, _merge_trees
+
+
+def make_tree(keys):
+    return dict(pair=dict(a='0', b='0'),
+                data={str(i): dict(value=str(i)) for i in range(keys)})
+
+
+def reader(conman, stop, results):
+    reads = 0
+    inconsistent = 0
+    while not stop.is_set():
+        snapshot = conman.snapshot()
+        if snapshot.get('pair/a') != snapshot['pair']['b']:
+            inconsistent += 1
+        conman.get('data/1/value')
+        reads += 1
+    results.append((reads, inconsistent))
+
+
+def writer(conman, stop, results):
+    writes = 0
+    while not stop.is_set():
+        v = str(writes)
+        if writes % 2:
+            tree = _merge_trees(conman.snapshot().tree,
+                                dict(pair=dict(a=v, b=v)))
+            conman._publish(tree)
+        else:
+            conman._set_path('data/%d/value' % (writes % 1000), v)
+        writes += 1
+    results.append(writes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    conman = ConManBase()
+    conman._publish(make_tree(args.keys))
+    stop = threading.Event()
+    read_results = []
+    write_results = []
+    threads = [threading.Thread(target=reader,
+                                args=(conman, stop, read_results))
+               for _ in range(args.readers)]
+    threads.append(threading.Thread(target=writer,
+                                    args=(conman, stop, write_results)))
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    reads = sum(r for r, _ in read_results)
+    inconsistent = sum(i for _, i in read_results)
+    print('readers:           %d' % args.readers)
+    print('reads/s:           %d' % (reads / args.seconds))
+    print('writes/s:          %d' % (write_results[0] / args.seconds))
+    print('inconsistent reads: %d' % inconsistent)
+
+
+if __name__ == '__main__':
+    main()
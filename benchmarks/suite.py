@@ -0,0 +1,324 @@
+"""Run the benchmark suite and compare its results between runs
+
+The suite measures the paths that matter for performance regressions:
+
+    file    - loading ini, json and yaml configs with ConManFile, and
+              reloading one after a change
+    lookup  - get() and chained [] lookups of random leaves
+    etcd    - add_key() and refresh() of a prefix, and the latency from
+              a put to the new value being visible in a watched key
+
+Every case runs at every size (the number of leaves, 10 per service).
+The etcd cases need etcd at /usr/local/bin/etcd (see the README), which is
+started just like for the tests. With --fake-etcd they run against an
+in-memory FakeEtcd (see conman.fake_etcd) instead, and are named
+fake_etcd/..., which measures conman's own overhead without the server
+and the network. Loads and refreshes report the best of a
+few repeats, lookups the mean time per lookup and the watch latency its
+median, 90th percentile and maximum.
+
+Results are saved as JSON, so runs can be compared. The comparison lists
+every measurement and exits with status 1 if any got slower by more than
+the threshold. Example:
+
+    python -m benchmarks.suite run --sizes 1000 100000 -o before.json
+    python -m benchmarks.suite run --sizes 1000 100000 -o after.json
+    python -m benchmarks.suite compare before.json after.json
+"""
+import argparse
+import configparser
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from conman import conman_file
+from conman.conman_base import ConManBase
+from conman.conman_file import ConManFile
+
+GROUPS = ['file', 'lookup', 'etcd']
+FILE_TYPES = ['ini', 'json', 'yaml']
+FIELDS = 10
+ETCD_PREFIX = 'bench_suite'
+
+
+def make_tree(count):
+    """Build a config tree of count leaves, FIELDS per service"""
+    return {'svc_%d' % s: {'field_%d' % f: 'value-%d-%d' % (s, f)
+                           for f in range(FIELDS)}
+            for s in range(max(1, count // FIELDS))}
+
+
+def random_paths(count, n=10000):
+    services = max(1, count // FIELDS)
+    return ['svc_%d/field_%d' % (random.randrange(services),
+                                 random.randrange(FIELDS))
+            for _ in range(n)]
+
+
+def best_of(f, repeat):
+    """The shortest duration of repeated calls, in seconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def write_config(tree, file_type, filename):
+    with open(filename, 'w') as f:
+        if file_type == 'ini':
+            parser = configparser.ConfigParser()
+            parser.read_dict(tree)
+            parser.write(f)
+        elif file_type == 'json':
+            json.dump(tree, f)
+        else:
+            yaml.dump(tree, f, Dumper=getattr(yaml, 'CDumper', yaml.Dumper))
+
+
+def bench_file(sizes, repeat, results):
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            tree = make_tree(size)
+            for file_type in FILE_TYPES:
+                filename = os.path.join(directory, 'config.' + file_type)
+                write_config(tree, file_type, filename)
+
+                def load():
+                    # Parsed files are cached by content
+                    conman_file._parse_cache.clear()
+                    return ConManFile([filename])
+
+                name = 'file/%s/%d' % (file_type, size)
+                results[name + '/load'] = best_of(load, repeat)
+
+                conman = load()
+                tree['svc_0']['field_0'] = 'changed'
+                write_config(tree, file_type, filename)
+
+                def reload():
+                    conman_file._parse_cache.clear()
+                    conman._reload([filename])
+
+                results[name + '/reload'] = best_of(reload, repeat)
+                tree['svc_0']['field_0'] = 'value-0-0'
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_lookup(sizes, repeat, results):
+    for size in sizes:
+        for compact in False, True:
+            conman = ConManBase(compact=compact)
+            conman._publish(make_tree(size))
+            paths = random_paths(size)
+            split = [p.split('/') for p in paths]
+            conman.get(paths[0])
+
+            def get():
+                for p in paths:
+                    conman.get(p)
+
+            def chained():
+                for s, f in split:
+                    conman[s][f]
+
+            name = 'lookup/%s/%d' % ('compact' if compact else 'dict', size)
+            results[name + '/get'] = best_of(get, repeat) / len(paths)
+            results[name + '/chained'] = best_of(chained, repeat) / len(paths)
+
+
+def populate_etcd(client, count, batch=128):
+    from conman.etcd_test_util import delete_key
+    delete_key(client, ETCD_PREFIX)
+    kvs = [('%s/%s' % (ETCD_PREFIX, path), value)
+           for path, value in _leaves(make_tree(count))]
+    for start in range(0, len(kvs), batch):
+        puts = [client.transactions.put(k, v)
+                for k, v in kvs[start:start + batch]]
+        client.transaction(compare=[], success=puts, failure=[])
+
+
+def _leaves(tree):
+    for s, fields in tree.items():
+        for f, value in fields.items():
+            yield s + '/' + f, value
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def watch_latency(conman, client, events):
+    """Measure the time from a put to its value being visible"""
+    latencies = []
+    path = ETCD_PREFIX + '/svc_0/field_0'
+    for i in range(events):
+        value = 'watched-%d' % i
+        start = time.perf_counter()
+        client.put(path, value)
+        deadline = start + 5
+        while conman.get(path) != value:
+            if time.perf_counter() > deadline:
+                raise Exception('Watch event not applied: ' + value)
+            time.sleep(0)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_etcd(sizes, repeat, results, page_size, watch_events, fake=False):
+    from conman.conman_etcd import ConManEtcd
+    from conman.etcd_test_util import delete_key, start_local_etcd_server
+
+    if fake:
+        from conman.fake_etcd import FakeEtcd
+        client = FakeEtcd().client()
+        group = 'fake_etcd'
+    else:
+        start_local_etcd_server()
+        client = ConManEtcd().client
+        group = 'etcd'
+    # The fake client is shared, since it doesn't connect
+    shared = client if fake else None
+    try:
+        for size in sizes:
+            populate_etcd(client, size)
+            name = '%s/%d' % (group, size)
+
+            def load():
+                conman = ConManEtcd(page_size=page_size, client=shared)
+                conman.add_key(ETCD_PREFIX)
+                conman.close()
+
+            results[name + '/load'] = best_of(load, repeat)
+
+            conman = ConManEtcd(page_size=page_size, client=shared)
+            conman.add_key(ETCD_PREFIX, watch=True)
+            results[name + '/refresh'] = best_of(
+                lambda: conman.refresh(ETCD_PREFIX), repeat)
+            latencies = watch_latency(conman, client, watch_events)
+            results[name + '/watch_p50'] = _percentile(latencies, 0.5)
+            results[name + '/watch_p90'] = _percentile(latencies, 0.9)
+            results[name + '/watch_max'] = max(latencies)
+            conman.unwatch(ETCD_PREFIX)
+        delete_key(client, ETCD_PREFIX)
+    finally:
+        client.close()
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    results = {}
+    for group in args.groups:
+        print('Running the %s benchmarks...' % group, file=sys.stderr)
+        if group == 'file':
+            bench_file(args.sizes, args.repeat, results)
+        elif group == 'lookup':
+            bench_lookup(args.sizes, args.repeat, results)
+        else:
+            bench_etcd(args.sizes,
+                       args.repeat,
+                       results,
+                       args.page_size,
+                       args.watch_events,
+                       args.fake_etcd)
+    for name, seconds in sorted(results.items()):
+        print('%-36s %14s' % (name, format_seconds(seconds)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(python=platform.python_version(),
+                           platform=platform.platform(),
+                           revision=_git_revision(),
+                           time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           results=results),
+                      f, indent=2, sort_keys=True)
+
+
+def format_seconds(seconds):
+    for unit, scale in ('s', 1), ('ms', 1e-3), ('us', 1e-6):
+        if seconds >= scale:
+            return '%.3f %s' % (seconds / scale, unit)
+    return '%.1f ns' % (seconds / 1e-9)
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+
+    regressions = 0
+    print('%-36s %14s %14s %9s' % ('benchmark', 'base', 'new', 'change'))
+    for name in sorted(set(base) | set(new)):
+        if name not in base or name not in new:
+            seconds = base.get(name, new.get(name))
+            print('%-36s %14s %14s %9s' % (
+                name,
+                format_seconds(seconds) if name in base else '-',
+                format_seconds(seconds) if name in new else '-',
+                ''))
+            continue
+        change = new[name] / base[name] - 1
+        flag = ''
+        if change > args.threshold:
+            flag = ' <- slower'
+            regressions += 1
+        print('%-36s %14s %14s %+8.1f%%%s' % (name,
+                                              format_seconds(base[name]),
+                                              format_seconds(new[name]),
+                                              change * 100,
+                                              flag))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('run', help='run the benchmarks')
+    p.add_argument('--groups', nargs='+', default=GROUPS, choices=GROUPS)
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[1000, 10000, 100000],
+                   help='the numbers of leaves, up to 1000000')
+    p.add_argument('--repeat', type=int, default=5)
+    # Big prefixes exceed the default gRPC message size limit of 4MB
+    p.add_argument('--page-size', type=int, default=10000)
+    p.add_argument('--watch-events', type=int, default=200)
+    p.add_argument('--fake-etcd', action='store_true',
+                   help='run the etcd benchmarks against an in-memory etcd')
+    p.add_argument('-o', '--output', help='save the results to this file')
+
+    p = commands.add_parser('compare', help='compare two saved runs')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='the relative slowdown reported as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
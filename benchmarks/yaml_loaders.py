@@ -0,0 +1,61 @@
+"""Benchmark the YAML loaders ConManFile can use on large configs
+
+Generates a YAML config of roughly the requested size and times loading it
+with every loader that get_yaml_loader() supports. Example:
+
+    python -m benchmarks.yaml_loaders --mb 10 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+from conman.conman_file import get_yaml_loader
+
+LOADERS = ['full', 'safe', 'c'] if yaml.__with_libyaml__ else ['full', 'safe']
+
+
+def make_yaml(size_mb):
+    """Generate a YAML config of about size_mb MB"""
+    service = yaml.dump(dict(
+        host='svc.internal.example.com',
+        port=8080,
+        enabled=True,
+        timeout=2.5,
+        tags=['a', 'b', 'c'],
+        limits=dict(cpu='500m', memory='1Gi', replicas=3),
+    ), default_flow_style=False)
+    service = ''.join('  ' + line + '\n' for line in service.splitlines())
+    count = size_mb * 2 ** 20 // len(service) + 1
+    return ''.join('service_%d:\n%s' % (i, service) for i in range(count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mb', type=int, nargs='+', default=[10])
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    print('%8s %8s %10s' % ('MB', 'loader', 'seconds'))
+    for size_mb in args.mb:
+        fd, filename = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w') as f:
+            f.write(make_yaml(size_mb))
+        with open(filename, 'rb') as f:
+            data = f.read()
+        for name in LOADERS:
+            loader = get_yaml_loader(name)
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                yaml.load(data, Loader=loader)
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+            print('%8.1f %8s %10.2f' % (len(data) / 2 ** 20, name, best))
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
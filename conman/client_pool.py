@@ -0,0 +1,126 @@
+"""Share etcd clients (and their gRPC channels) between ConManEtcd objects
+
+Every etcd3 client has its own gRPC channel, so every ConManEtcd connects
+(and with TLS, handshakes) on its own. ConManEtcd(client_pool=pool) gets
+its client from a ClientPool instead, which keeps a single client per
+endpoint and credentials and closes it when the last ConManEtcd using it
+is closed. shared_pool is a process-wide pool.
+
+The pool checks the health of a client when it's acquired, at most every
+check_interval seconds, and replaces a client whose channel was closed
+(e.g. by calling close() on it directly). A client that fails the check
+for any other reason (e.g. etcd is down) is kept: gRPC reconnects by
+itself, and replacing the channel would break the watches of the other
+users. Clients are never shared with a forked child process.
+"""
+import logging
+import os
+import threading
+import time
+
+import etcd3
+
+logger = logging.getLogger(__name__)
+
+
+class PooledClient(object):
+    """A client shared by all the users of an endpoint and credentials
+
+    Always get the client from the client attribute, since the pool may
+    replace it.
+    """
+
+    def __init__(self, key, kwargs, client=None):
+        self.key = key
+        self.kwargs = kwargs
+        self.client = client or etcd3.client(**kwargs)
+        self.refs = 0
+        self.healthy = True
+        self.checked_at = time.monotonic()
+
+    def __repr__(self):
+        return 'PooledClient(%s:%s, %d refs)' % (self.kwargs['host'],
+                                                 self.kwargs['port'],
+                                                 self.refs)
+
+
+class ClientPool(object):
+    def __init__(self, check_interval=30.0):
+        """
+        :param float check_interval: the minimal time in seconds between
+            health checks of a client
+        """
+        self.check_interval = check_interval
+        self._clients = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(kwargs):
+        key = dict(kwargs)
+        if key.get('grpc_options') is not None:
+            key['grpc_options'] = tuple(tuple(option)
+                                        for option in key['grpc_options'])
+        return tuple(sorted(key.items()))
+
+    def acquire(self, **kwargs):
+        """Get the shared client of an endpoint and credentials
+
+        :param kwargs: the arguments of etcd3.client()
+        :returns: a PooledClient. Release it with release() when done.
+        """
+        key = self._key(kwargs)
+        with self._lock:
+            if self._pid != os.getpid():
+                # gRPC channels don't survive a fork
+                self._clients = {}
+                self._pid = os.getpid()
+            pooled = self._clients.get(key)
+            if pooled is None:
+                pooled = self._clients[key] = PooledClient(key, kwargs)
+            elif time.monotonic() - pooled.checked_at > self.check_interval:
+                self._check(pooled)
+            pooled.refs += 1
+            return pooled
+
+    def release(self, pooled):
+        """Give back a client, closing it when nobody uses it anymore"""
+        with self._lock:
+            pooled.refs -= 1
+            if pooled.refs > 0:
+                return
+            if self._clients.get(pooled.key) is pooled:
+                del self._clients[pooled.key]
+        pooled.client.close()
+
+    def check(self):
+        """Check the health of all the clients now
+
+        :returns: the number of unhealthy clients
+        """
+        with self._lock:
+            for pooled in self._clients.values():
+                self._check(pooled)
+            return sum(1 for p in self._clients.values() if not p.healthy)
+
+    def _check(self, pooled):
+        pooled.checked_at = time.monotonic()
+        try:
+            pooled.client.status()
+        except ValueError:
+            # The channel was closed
+            logger.warning('Replacing closed etcd client %r', pooled)
+            pooled.client = etcd3.client(**pooled.kwargs)
+            pooled.healthy = True
+        except Exception:
+            logger.warning('etcd client %r is unhealthy', pooled,
+                           exc_info=True)
+            pooled.healthy = False
+        else:
+            pooled.healthy = True
+
+    def __len__(self):
+        return len(self._clients)
+
+
+shared_pool = ClientPool()
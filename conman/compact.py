@@ -0,0 +1,131 @@
+"""A compact, read-only representation of the configuration tree
+
+Big configuration trees are mostly made of many small dicts with the same
+keys (e.g. the fields of every service) and of repeated string values
+(hostnames, 'true', region names). A CompactNode stores the values of a
+dict in a single tuple and shares the key -> position table ("shape") with
+every other node that has the same keys. Strings are interned, so equal
+keys and values are stored once per process.
+
+CompactNode is a read-only Mapping, so code that reads the tree with
+[], get(), in, len(), iteration, keys(), values(), items() or == works
+unchanged. It isn't a dict though, so serializers that only take dicts
+(e.g. json.dumps()) reject it: serialize to_dict() instead.
+"""
+import sys
+import weakref
+from collections.abc import Mapping
+
+# Nodes with more keys get their own shape instead of a shared one
+MAX_SHARED_SHAPE = 64
+
+
+class _Shape(dict):
+    """Maps the keys of a node to the positions of their values"""
+    __slots__ = ('__weakref__',)
+
+
+_shapes = weakref.WeakValueDictionary()
+
+
+def _get_shape(keys):
+    if len(keys) > MAX_SHARED_SHAPE:
+        return _Shape(zip(keys, range(1, len(keys) + 1)))
+    shape = _shapes.get(keys)
+    if shape is None:
+        shape = _Shape(zip(keys, range(1, len(keys) + 1)))
+        _shapes[keys] = shape
+    return shape
+
+
+_intern = sys.intern
+
+
+class CompactNode(Mapping):
+    """A read-only mapping stored as a tuple: (shape, value1, value2, ...)
+
+    Create nodes with compact().
+    """
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, k):
+        i = self._values[0].get(k)
+        if i is None:
+            raise KeyError(k)
+        return self._values[i]
+
+    def get(self, k, default=None):
+        i = self._values[0].get(k)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def __contains__(self, k):
+        return k in self._values[0]
+
+    def __iter__(self):
+        return iter(self._values[0])
+
+    def __len__(self):
+        return len(self._values) - 1
+
+    def keys(self):
+        return self._values[0].keys()
+
+    def values(self):
+        return self._values[1:]
+
+    def items(self):
+        return zip(self._values[0], self._values[1:])
+
+    def __eq__(self, other):
+        if isinstance(other, CompactNode):
+            return self._values == other._values or \
+                dict(self.items()) == dict(other.items())
+        if isinstance(other, Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return compact, (self.to_dict(),)
+
+    def copy(self):
+        return self
+
+    def to_dict(self):
+        """Convert back to nested dicts"""
+        return {k: v.to_dict() if type(v) is CompactNode else v
+                for k, v in self.items()}
+
+
+def compact(tree):
+    """Convert a nested dict to a CompactNode
+
+    Sub-dicts are converted too. Existing CompactNodes (and any other
+    values) are reused as is, so re-compacting a tree in which only a few
+    dicts changed only converts those dicts.
+    """
+    if type(tree) is CompactNode:
+        return tree
+    try:
+        keys = tuple(map(_intern, tree))
+    except TypeError:
+        # Not all the keys are strings
+        keys = tuple(_intern(k) if type(k) is str else k for k in tree)
+    values = [_get_shape(keys)]
+    values += [_intern(v) if type(v) is str else
+               compact(v) if isinstance(v, dict) else v
+               for v in tree.values()]
+    return CompactNode(tuple(values))
@@ -1,14 +1,377 @@
+import logging
+import threading
+from collections.abc import Mapping
+from conman.compact import CompactNode, compact as _compact
+from conman.instrumentation import Instrumentation
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+# Marks a deleted path in the index overlay of a snapshot
+_deleted = object()
+
+# Overlay size above which a derived snapshot gets its own full index
+_MAX_OVERLAY = 512
+
+# The types of the inner nodes of the tree
+_node_types = (dict, CompactNode)
+
+
+class Lazy(object):
+    """A subtree that's loaded on first access
+
+    Lazy values are resolved transparently by ConManBase.__getitem__() and
+    get(). Resolving is thread safe and happens at most once.
+    """
+    __slots__ = ('_load', '_args', '_value', '_lock')
+
+    def __init__(self, load, *args):
+        """
+        :param callable load: called with args to load the subtree
+        """
+        self._load = load
+        self._args = args
+        self._value = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        if self._load is None:
+            return repr(self._value)
+        return 'Lazy(...)'
+
+    def resolve(self):
+        if self._load is not None:
+            with self._lock:
+                if self._load is not None:
+                    self._value = self._load(*self._args)
+                    self._load = self._args = None
+        return self._value
+
+
+def _copy(node):
+    """Copy a node of the tree into a new dict"""
+    return dict(node) if type(node) is dict else dict(node.items())
+
+
+def _build_index(tree):
+    """Build a flat index of all the paths of a nested dict
+
+    Every node (leaf value or sub-dict) is indexed by its full path, with
+    the path components joined by '/'.
+    """
+    index = {}
+    stack = [('', tree)]
+    while stack:
+        prefix, node = stack.pop()
+        for k, v in node.items():
+            path = prefix + str(k)
+            index[path] = v
+            if isinstance(v, _node_types):
+                stack.append((path + '/', v))
+    return index
+
+
+def _mark_deleted(changes, path, node):
+    """Mark a node and all its descendants as deleted"""
+    changes[path] = _deleted
+    if isinstance(node, _node_types):
+        for p in _build_index(node):
+            changes[path + '/' + p] = _deleted
+
+
+def _merge_trees(tree, other):
+    """Return a copy of tree with other merged into it recursively
+
+    Only the dicts that exist in both trees are copied, everything else is
+    shared, so neither tree is modified.
+    """
+    merged = _copy(tree)
+    for k, v in other.items():
+        old = merged.get(k)
+        if isinstance(old, _node_types) and isinstance(v, _node_types):
+            v = _merge_trees(old, v)
+        merged[k] = v
+    return merged
+
+
+def _remove_path(tree, path, changes=None):
+    """Return a copy of tree without a path, pruning parents left empty
+
+    Only the dicts along the path are copied. If the path doesn't exist
+    the tree itself is returned.
+
+    :param dict changes: if not None, the removed paths are marked in it
+    """
+    if changes is None:
+        changes = {}
+    components = path.split('/')
+    parents = []
+    t = tree
+    for c in components[:-1]:
+        if not isinstance(t.get(c), _node_types):
+            return tree
+        parents.append(t)
+        t = t[c]
+    if components[-1] not in t:
+        return tree
+
+    t = _copy(t)
+    _mark_deleted(changes, path, t.pop(components[-1]))
+    # Copy the parents bottom up, dropping the ones left empty
+    for i in range(len(parents) - 1, -1, -1):
+        parent = _copy(parents[i])
+        c = components[i]
+        p = '/'.join(components[:i + 1])
+        if t:
+            parent[c] = t
+            changes[p] = t
+        else:
+            del parent[c]
+            changes[p] = _deleted
+        t = parent
+    return t
+
+
+def _walk(tree, path):
+    """Look up a path by walking the tree
+
+    Lazy values and other mappings (which the index doesn't cover) along
+    the path are resolved.
+    """
+    t = tree
+    for c in path.split('/'):
+        if type(t) is Lazy:
+            t = t.resolve()
+        if isinstance(t, _node_types):
+            t = t.get(c, _missing)
+        elif isinstance(t, Mapping):
+            try:
+                t = t[c]
+            except KeyError:
+                return _missing
+        else:
+            return _missing
+        if t is _missing:
+            return t
+    return t.resolve() if type(t) is Lazy else t
+
+
+class Snapshot(object):
+    """An immutable, versioned view of the configuration tree
+
+    A snapshot is never modified after it's published, so it can be read
+    from any thread without locking. Writers build a new tree that shares
+    all the unchanged sub-dicts with the previous one and publish it as a
+    new snapshot.
+
+    The flat path index used by get() is built lazily. A snapshot derived
+    from a previous one by a few path updates doesn't copy the whole index,
+    but keeps the changed paths in a small overlay on top of it.
+    """
+    __slots__ = ('tree', 'version', '_index', '_overlay')
+
+    def __init__(self, tree, version, index=None, overlay=None):
+        self.tree = tree
+        self.version = version
+        self._index = index
+        self._overlay = overlay
+
+    def __getitem__(self, k):
+        v = self.tree[k]
+        return v.resolve() if type(v) is Lazy else v
+
+    def __repr__(self):
+        return 'Snapshot(version=%d, %r)' % (self.version, self.tree)
+
+    def _lookup(self, path):
+        overlay = self._overlay
+        value = _missing
+        if overlay:
+            value = overlay.get(path, _missing)
+        if value is _missing:
+            index = self._index
+            if index is None:
+                index = self._index = _build_index(self.tree)
+            value = index.get(path, _missing)
+        if value is _missing:
+            # Paths below lazy subtrees aren't indexed
+            return _walk(self.tree, path)
+        elif type(value) is Lazy:
+            return value.resolve()
+        return value
+
+    def get(self, path, default=None):
+        """Get a value or sub-dict by its full path
+
+        See ConManBase.get()
+        """
+        value = self._lookup(path)
+        if value is _missing or value is _deleted:
+            if '.' not in path:
+                return default
+            value = self._lookup(path.replace('.', '/'))
+            if value is _missing or value is _deleted:
+                return default
+        return value
+
+    def _derive(self, tree, changes):
+        """Create the next snapshot from a tree with a few changed paths
+
+        :param dict tree: the new tree
+        :param dict changes: the changed paths and their new values
+            (_deleted for removed paths)
+        """
+        index = self._index
+        if index is None:
+            return Snapshot(tree, self.version + 1)
+        overlay = dict(self._overlay) if self._overlay else {}
+        overlay.update(changes)
+        if len(overlay) > _MAX_OVERLAY:
+            index = dict(index)
+            for path, value in overlay.items():
+                if value is _deleted:
+                    index.pop(path, None)
+                else:
+                    index[path] = value
+            overlay = None
+        return Snapshot(tree, self.version + 1, index, overlay)
+
 
 class ConManBase(dict):
-    def __init__(self):
+    def __init__(self, compact=False, instrumentation=None):
+        """
+        :param bool compact: store the tree as CompactNodes (see
+            conman.compact) instead of dicts. Uses much less memory for
+            big trees, but changes cost a little more.
+        :param Instrumentation instrumentation: receives the timings and
+            counts of loads, parses, watch events and published snapshots
+            (see conman.instrumentation). By default they are ignored.
+        """
         dict.__init__(self)
-        self._conf = {}
+        self.compact = compact
+        self.instrumentation = instrumentation or Instrumentation()
+        self._snapshot = Snapshot({}, 0)
+        # Called with every new snapshot (see add_listener())
+        self._listeners = []
+        # Serializes writers. Readers never take it.
+        self._write_lock = threading.RLock()
+
+    @property
+    def _conf(self):
+        return self._snapshot.tree
 
     def __getitem__(self, k):
-        return self._conf.__getitem__(k)
+        v = self._snapshot.tree[k]
+        return v.resolve() if type(v) is Lazy else v
 
     def __setitem__(self, k, v):
         raise NotImplementedError
 
     def __repr__(self):
         return repr(self._conf)
+
+    def snapshot(self):
+        """Get the current snapshot of the configuration
+
+        The snapshot is immutable, so a reader that needs several values
+        to be consistent with each other should read them all from the
+        same snapshot.
+        """
+        return self._snapshot
+
+    def get(self, path, default=None):
+        """Get a value or sub-dict by its full path
+
+        :param str path: path components separated by '/' or '.'
+            e.g. 'svc/db/host' or 'svc.db.host'
+        :param default: returned if the path doesn't exist
+
+        Lookups hit a flat index of all the paths, so they cost a single
+        dict lookup regardless of the depth. If the path doesn't exist as
+        is and contains dots, they are treated as separators.
+        """
+        return self._snapshot.get(path, default)
+
+    def add_listener(self, listener):
+        """Call a function with every new snapshot
+
+        :param callable listener: called with the snapshot right after it
+            was published, while writers are blocked, so it must be quick
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _set_snapshot(self, snapshot):
+        self._snapshot = snapshot
+        self.instrumentation.published(snapshot)
+        for listener in self._listeners:
+            try:
+                listener(snapshot)
+            except Exception:
+                logger.exception('Snapshot listener failed')
+
+    def _publish(self, tree):
+        """Publish a new tree as the current snapshot
+
+        The tree must not be modified afterwards. Publishing is a single
+        reference assignment, so readers see either the old or the new
+        snapshot, never a mix.
+        """
+        with self._write_lock:
+            if self.compact:
+                tree = {k: _compact(v) if isinstance(v, dict) else v
+                        for k, v in tree.items()}
+            self._set_snapshot(Snapshot(tree, self._snapshot.version + 1))
+
+    def _compact_changes(self, tree, head, changes):
+        """Compact the changed top-level value of a tree in compact mode
+
+        :param dict tree: a new tree that isn't published yet
+        :param str head: the changed top-level key
+        :param dict changes: the changed paths, updated to refer to the
+            compacted nodes
+        """
+        if not self.compact or not isinstance(tree.get(head), dict):
+            return
+        tree[head] = _compact(tree[head])
+        for path, value in changes.items():
+            if isinstance(value, dict):
+                changes[path] = _walk(tree, path)
+
+    def _set_path(self, path, value):
+        """Set a leaf by its '/' separated path, creating parents as needed
+
+        The dicts along the path are copied and the rest of the tree is
+        shared with the previous snapshot.
+        """
+        with self._write_lock:
+            snapshot = self._snapshot
+            components = path.split('/')
+            changes = {}
+            root = t = dict(snapshot.tree)
+            for i, c in enumerate(components[:-1]):
+                child = t.get(c)
+                child = _copy(child) if isinstance(child, _node_types) \
+                    else {}
+                t[c] = child
+                changes['/'.join(components[:i + 1])] = child
+                t = child
+            old = t.get(components[-1], _missing)
+            if isinstance(old, _node_types):
+                _mark_deleted(changes, path, old)
+            t[components[-1]] = value
+            changes[path] = value
+            self._compact_changes(root, components[0], changes)
+            self._set_snapshot(snapshot._derive(root, changes))
+
+    def _delete_path(self, path):
+        """Remove a leaf or subtree and prune the parents it leaves empty"""
+        with self._write_lock:
+            snapshot = self._snapshot
+            changes = {}
+            tree = _remove_path(snapshot.tree, path, changes)
+            if tree is not snapshot.tree:
+                self._compact_changes(tree, path.split('/')[0], changes)
+                self._set_snapshot(snapshot._derive(tree, changes))
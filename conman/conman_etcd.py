@@ -5,31 +5,115 @@ See:  http://python-etcd.readthedocs.org/
 It provides a read-only access and just exposes a nested dict
 """
 import functools
+import itertools
+import logging
+import os
+import queue
+import threading
 import time
-import etcd3
-from conman.conman_base import ConManBase
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from etcd3 import etcdrpc
+from etcd3.client import KVMetadata
+from etcd3.events import DeleteEvent
+from etcd3.exceptions import RevisionCompactedError
+from etcd3.utils import increment_last_byte, to_bytes
+from conman.client_pool import PooledClient
+from conman.conman_base import ConManBase, _merge_trees, _remove_path
+from conman.instrumentation import Instrumentation
+from conman.retry import RetryPolicy, thrice  # noqa: F401
+from conman.shared import SnapshotFile, write_snapshot
+from conman.watch_manager import WatchManager
 
+logger = logging.getLogger(__name__)
 
-def thrice(delay=0.5):
-    """This decorator tries failed operations 3 times before it gives up
 
-    The delay determines how long to wait between tries (in seconds)
+def _parse_endpoint(endpoint):
+    """Get the host and port of a 'host:port' or (host, port) endpoint"""
+    if isinstance(endpoint, str):
+        host, _, port = endpoint.rpartition(':')
+        return dict(host=host, port=int(port))
+    host, port = endpoint
+    return dict(host=host, port=port)
+
+
+def _flatten(tree, prefix, flat):
+    """Collect the leaves of a nested dict as etcd key -> value bytes
+
+    Values that aren't str or bytes are stored as their str().
+    """
+    stack = [(prefix, tree)]
+    while stack:
+        prefix, node = stack.pop()
+        for k, v in node.items():
+            path = prefix + '/' + str(k)
+            if isinstance(v, Mapping):
+                stack.append((path, v))
+            elif isinstance(v, bytes):
+                flat[path.encode()] = v
+            else:
+                flat[path.encode()] = str(v).encode()
+    return flat
+
+
+def _counted(etcd_result, stats):
+    """Pass the KVs of an etcd result through, counting them and their bytes
+
+    The counts are added to the 'keys' and 'bytes' of stats once all the
+    KVs were consumed.
     """
+    keys = 0
+    size = 0
+    for x in etcd_result:
+        keys += 1
+        size += len(x[1].key) + len(x[0])
+        yield x
+    stats['keys'] += keys
+    stats['bytes'] += size
 
-    def decorated(f):
-        @functools.wraps(f)
-        def wrapped(*args, **kwargs):
-            for i in range(3):
-                try:
-                    return f(*args, **kwargs)
-                except Exception:
-                    if i == 2:
-                        raise
-                    time.sleep(delay)
 
-        return wrapped
+def _new_page_stats():
+    """Get a dict for the stats of paged loads (see last_load_stats)"""
+    return dict(pages=0, keys=0, bytes=0, max_page_bytes=0)
 
-    return decorated
+
+class LazyPrefix(Mapping):
+    """A read-only mapping of the children of a key added with lazy=True
+
+    Only the names of the children are loaded upfront. The subtree of a
+    child is fetched from etcd when it's first accessed and kept in the
+    subtree cache of the ConManEtcd, so it may be fetched again after it
+    was evicted.
+    """
+
+    def __init__(self, conman, key, children):
+        """
+        :param ConManEtcd conman: fetches and caches the subtrees
+        :param str key: the etcd key this mapping stands for
+        :param dict children: child name -> True if the child has
+            children of its own, False if it's a single value
+        """
+        self._conman = conman
+        self.key = key
+        self._children = children
+
+    def __getitem__(self, name):
+        if name not in self._children:
+            raise KeyError(name)
+        return self._conman._get_subtree(self.key, name, self._children[name])
+
+    def __contains__(self, name):
+        return name in self._children
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __repr__(self):
+        return 'LazyPrefix(%r, %d children)' % (self.key, len(self))
 
 
 class ConManEtcd(ConManBase):
@@ -43,60 +127,898 @@ class ConManEtcd(ConManBase):
                  user=None,
                  password=None,
                  grpc_options=None,
-                 on_change=lambda e: None):
-        ConManBase.__init__(self)
+                 on_change=lambda e: None,
+                 retry_policy=None,
+                 max_txn_ops=128,
+                 page_size=None,
+                 subtree_cache_size=100000,
+                 compact=False,
+                 cache_file=None,
+                 instrumentation=None,
+                 client_pool=None,
+                 read_endpoints=None,
+                 dispatcher=None,
+                 client=None):
+        # compact=True stores the tree as compact read-only mappings (see
+        # conman.compact). Worth it for big prefixes. instrumentation gets
+        # the measurements of loads, retries and watch events (see
+        # conman.instrumentation).
+        ConManBase.__init__(self, compact, instrumentation)
         self.on_change = on_change
-        self.client = etcd3.client(
-            host=host,
-            port=port,
-            ca_cert=ca_cert,
-            cert_key=cert_key,
-            cert_cert=cert_cert,
-            timeout=timeout,
-            user=user,
-            password=password,
-            grpc_options=grpc_options,
-        )
-
-    def _add_key_recursively(self, etcd_result):
+        # If not None, watch events are queued to this EventDispatcher
+        # (see conman.dispatcher) instead of being passed to on_change
+        self.dispatcher = dispatcher
+        # Retries loads and watch creation. A broken watch is resumed
+        # with the backoff of the policy until it succeeds.
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Must not exceed the --max-txn-ops setting of the etcd server
+        self.max_txn_ops = max_txn_ops
+        # If not None, loads (add_key(), add_keys(), refresh()...) fetch
+        # prefixes page by page
+        self.page_size = page_size
+        self.last_load_stats = {}
+        self.last_write_stats = {}
+        # The etcd revision each managed key was last synced to
+        self._revisions = {}
+        # The incremental watch id of each key added with watch=True
+        self._watch_ids = {}
+        # Keys added with lazy=True
+        self._lazy_keys = set()
+        # The subtrees of lazy keys fetched so far, least recently used
+        # first: (key, name) -> (subtree, number of etcd keys)
+        self._subtrees = OrderedDict()
+        self._subtree_keys = 0
+        # The latest event revision of every lazy subtree, so a fetch that
+        # raced with a change isn't cached
+        self._subtree_revisions = {}
+        self._subtree_lock = threading.Lock()
+        # The maximum number of etcd keys in cached lazy subtrees
+        self.subtree_cache_size = subtree_cache_size
+        # If not None, loads write the tree and its revisions to this
+        # snapshot file (see conman.shared), and add_key() serves
+        # keys found in it without waiting for etcd
+        self.cache_file = cache_file
+        self._cache = self._open_cache()
+        # Set when the cache file is behind the tree. A background thread
+        # writes it, coalescing the loads in the meantime.
+        self._cache_pending = threading.Event()
+        self._cache_thread = None
+        self._cache_write_lock = threading.Lock()
+        # The minimal time between writes of the cache file
+        self.cache_write_interval = 0.1
+        # Keys served from the cache that weren't revalidated yet
+        self.stale_keys = set()
+        client_args = dict(host=host,
+                           port=port,
+                           ca_cert=ca_cert,
+                           cert_key=cert_key,
+                           cert_cert=cert_cert,
+                           timeout=timeout,
+                           user=user,
+                           password=password,
+                           grpc_options=grpc_options)
+        # If not None, the clients are shared with the other ConManEtcds
+        # of the pool (see conman.client_pool)
+        self.client_pool = client_pool
+        # A client passed in (e.g. of a FakeEtcd, see conman.fake_etcd) is
+        # used instead of connecting, and isn't closed
+        self._own_client = client is None
+        if client is None:
+            self._pooled = self._acquire_client(client_args)
+        else:
+            self._pooled = PooledClient(None, client_args, client)
+        # Reads are spread round-robin over the clients of read_endpoints
+        # ('host:port' or (host, port)). Watches use the main client.
+        self._readers = [
+            self._acquire_client(dict(client_args,
+                                      **_parse_endpoint(endpoint)))
+            for endpoint in read_endpoints or ()]
+        self._read_counter = itertools.count()
+        # All the watches share a single etcd watch (see
+        # conman.watch_manager)
+        self._watches = WatchManager(lambda: self.client, self.retry_policy)
+        self._closed = False
+
+    @property
+    def client(self):
+        return self._pooled.client
+
+    def _acquire_client(self, client_args):
+        if self.client_pool is None:
+            return PooledClient(None, client_args)
+        return self.client_pool.acquire(**client_args)
+
+    def _read_client(self):
+        """Get the client of the next read endpoint"""
+        readers = self._readers
+        if not readers:
+            return self._pooled.client
+        return readers[next(self._read_counter) % len(readers)].client
+
+    def close(self):
+        """Stop watching and close the clients and the dispatcher
+
+        Pooled clients are given back to the pool, which closes them when
+        no other ConManEtcd uses them. The dispatcher delivers the events
+        it queued before it stops. The latest tree is written to
+        cache_file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for key in list(self._watch_ids):
+            self.unwatch(key)
+        self._watches.close()
+        if self._cache_thread is not None:
+            pending = self._cache_pending.is_set()
+            # Wakes the writer up so it stops
+            self._cache_pending.set()
+            self._cache_thread.join()
+            if not pending:
+                self._cache_pending.clear()
+        self.flush_cache()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        for pooled in [self._pooled] + self._readers:
+            if pooled is self._pooled and not self._own_client:
+                continue
+            if self.client_pool is None:
+                pooled.client.close()
+            else:
+                self.client_pool.release(pooled)
+
+    def _add_key_recursively(self, etcd_result, tree, stats=None):
+        """Store the KVs of an etcd result in a nested dict
+
+        :param dict stats: if not None, the number of KVs and their bytes
+            are added to it (see _counted())
+        :returns: the etcd revision the result was read at
+
+        The KVs are sorted by key, so consecutive keys usually share their
+        parent. The parent dict of the previous key is reused in that case
+        instead of walking from the root again.
+        """
+        if stats is not None:
+            etcd_result = _counted(etcd_result, stats)
         ok = False
-        target = self._conf
+        revision = 0
+        root = tree
+        prev_parent = None
+        t = root
         for x in etcd_result:
             ok = True
-            value = x[0].decode()
-            key = x[1].key.decode()
-            components = key.split('/')
-            t = target
-            for c in components[:-1]:
-                if c not in t:
-                    t[c] = {}
-                t = t[c]
-            t[components[-1]] = value
+            parent, _, name = x[1].key.decode().rpartition('/')
+            if parent != prev_parent:
+                t = root
+                if parent:
+                    for c in parent.split('/'):
+                        child = t.get(c)
+                        if not isinstance(child, dict):
+                            child = t[c] = {}
+                        t = child
+                prev_parent = parent
+            t[name] = x[0].decode()
+            revision = x[1].response_header.revision
         if not ok:
             raise Exception('Empty result')
+        return revision
+
+    def _fetch_prefix(self, key, stats=None):
+        """Stream a key prefix, page by page if page_size was set
+
+        :param dict stats: see _fetch_prefix_paged()
+        """
+        if self.page_size:
+            return self._fetch_prefix_paged(key, self.page_size, stats=stats)
+        return self._read_client().get_prefix(key, sort_order='ascend')
+
+    def _fetch_prefix_paged(self,
+                            key,
+                            page_size,
+                            keys_only=False,
+                            revision=0,
+                            client=None,
+                            stats=None):
+        """Stream a key prefix page by page
+
+        Every page is a range request limited to page_size KVs that
+        continues right after the last key of the previous page. All pages
+        are pinned to the revision of the first one (or to revision if
+        not 0), so the result is a consistent snapshot even if the prefix
+        changes during the load. Only one page of raw KVs is held in
+        memory at a time.
+
+        :param client: the client to read with (by default the next read
+            endpoint's). It must have the revision.
+        :param dict stats: the dict to add the stats of the pages to. By
+            default a new one, stored in last_load_stats.
+        """
+        # All the pages come from the same endpoint, which surely has
+        # the revision of the first one
+        client = client or self._read_client()
+        start = to_bytes(key)
+        range_end = increment_last_byte(start)
+        if stats is None:
+            stats = _new_page_stats()
+            self.last_load_stats = stats
+        while True:
+            request = etcdrpc.RangeRequest(key=start,
+                                           range_end=range_end,
+                                           limit=page_size,
+                                           revision=revision,
+                                           keys_only=keys_only)
+            response = client.kvstub.Range(
+                request,
+                client.timeout,
+                credentials=client.call_credentials,
+                metadata=client.metadata)
+            header = response.header
+            if revision:
+                # The header has the latest revision, not the one read at
+                header.revision = revision
+            else:
+                revision = header.revision
+            page_bytes = response.ByteSize()
+            stats['pages'] += 1
+            stats['keys'] += len(response.kvs)
+            stats['bytes'] += page_bytes
+            stats['max_page_bytes'] = max(stats['max_page_bytes'], page_bytes)
+            stats['revision'] = revision
+            for kv in response.kvs:
+                yield kv.value, KVMetadata(kv, header)
+            if not response.more or not response.kvs:
+                return
+            start = response.kvs[-1].key + b'\0'
+            # Release this page before the next one is fetched
+            del response
+
+    def _fetch_prefixes_txn(self, keys, revision=0, client=None):
+        """Range over several key prefixes in a single transaction
+
+        :param list keys: the key prefixes (at most max_txn_ops)
+        :param int revision: the revision to read at (0 means latest)
+        :param client: the client to read with (by default the next read
+            endpoint's)
+        :returns: the revision read at and a list of etcd results
+        """
+        ops = []
+        for key in keys:
+            key = to_bytes(key)
+            request = etcdrpc.RangeRequest(key=key,
+                                           range_end=increment_last_byte(key),
+                                           revision=revision)
+            ops.append(etcdrpc.RequestOp(request_range=request))
+        client = client or self._read_client()
+        response = client.kvstub.Txn(etcdrpc.TxnRequest(success=ops),
+                                     client.timeout,
+                                     credentials=client.call_credentials,
+                                     metadata=client.metadata)
+        header = response.header
+        results = [[(kv.value, KVMetadata(kv, header))
+                    for kv in r.response_range.kvs]
+                   for r in response.responses]
+        return header.revision, results
+
+    def _fetch_prefixes(self, keys):
+        """Fetch several key prefixes as one consistent snapshot
+
+        The first max_txn_ops prefixes are read in one transaction. If
+        there are more, the rest are read by parallel transactions pinned
+        to the revision of the first one.
+
+        :returns: the revision of the snapshot and a list of etcd results
+        """
+        n = self.max_txn_ops
+        chunks = [keys[i:i + n] for i in range(0, len(keys), n)]
+        client = self._read_client()
+        revision, results = self._fetch_prefixes_txn(chunks[0],
+                                                     client=client)
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=len(chunks) - 1) as pool:
+                fetch = functools.partial(self._fetch_prefixes_txn,
+                                          revision=revision,
+                                          client=client)
+                for _, chunk_results in pool.map(fetch, chunks[1:]):
+                    results.extend(chunk_results)
+        return revision, results
+
+    def _apply_event(self, key, event):
+        """Apply a single watch event of a managed key to the nested dict
+
+        Events older than the revision the key was last synced to are
+        stale (e.g. they were already part of a refresh) and are ignored.
+        Events of the current revision are idempotent, so re-applying them
+        is harmless.
+        """
+        revision = event.mod_revision
+        with self._write_lock:
+            if revision < self._revisions.get(key, 0):
+                return
+            if key in self._lazy_keys:
+                self._apply_lazy_event(key, event)
+            elif isinstance(event, DeleteEvent):
+                self._delete_path(event.key.decode())
+            else:
+                self._set_path(event.key.decode(), event.value.decode())
+            self._revisions[key] = revision
+
+    def _apply_lazy_event(self, key, event):
+        """Apply a watch event of a lazy key
+
+        The names of the children are updated and the cached subtree of
+        the changed child is dropped, so it's fetched again when it's next
+        accessed.
+        """
+        path = event.key.decode()
+        if not path.startswith(key + '/'):
+            return
+        name, sep, _ = path[len(key) + 1:].partition('/')
+        lazy = self._snapshot.get(key)
+        children = dict(lazy._children) if isinstance(lazy, LazyPrefix) \
+            else {}
+        if isinstance(event, DeleteEvent):
+            # A child with children of its own may still have others
+            if not sep and not children.get(name):
+                children.pop(name, None)
+        else:
+            children[name] = children.get(name, False) or bool(sep)
+        with self._subtree_lock:
+            self._subtree_revisions[(key, name)] = event.mod_revision
+            self._evict_subtree((key, name))
+        if not isinstance(lazy, LazyPrefix) or children != lazy._children:
+            self._set_path(key, LazyPrefix(self, key, children))
+
+    def _fetch_children(self, key, stats=None):
+        """Fetch the names of the children of a key (without the values)
+
+        :returns: a list with a single (key, tree, revision) tuple, where
+            the tree has a LazyPrefix at the path of the key
+        """
+        prefix = key + '/'
+        if self.page_size:
+            kvs = self._fetch_prefix_paged(prefix,
+                                           self.page_size,
+                                           keys_only=True)
+        else:
+            kvs = self._read_client().get_prefix(prefix, keys_only=True)
+        if stats is not None:
+            kvs = _counted(kvs, stats)
+        tree, revision = self._children_tree(key, kvs)
+        if revision is None:
+            raise Exception('Empty result')
+        return [(key, tree, revision)]
+
+    def _children_tree(self, key, kvs):
+        """Build the tree of a lazy key from the KVs of its children
+
+        :param kvs: the KVs under the key (only their keys are used)
+        :returns: the tree, with a LazyPrefix at the path of the key, and
+            the revision of the KVs (None if there are none)
+        """
+        prefix = key + '/'
+        children = {}
+        revision = None
+        n = len(prefix)
+        for _, metadata in kvs:
+            name, sep, _ = metadata.key[n:].decode().partition('/')
+            children[name] = children.get(name, False) or bool(sep)
+            revision = metadata.response_header.revision
+
+        tree = t = {}
+        components = key.split('/')
+        for c in components[:-1]:
+            t[c] = {}
+            t = t[c]
+        t[components[-1]] = LazyPrefix(self, key, children)
+        return tree, revision
+
+    def _fetch_subtree(self, key, name, has_children, stats=None):
+        """Fetch the subtree of a child of a lazy key
+
+        :returns: the subtree, the number of etcd keys in it and the
+            revision it was read at
+        """
+        path = key + '/' + name
+        if not has_children:
+            value, metadata = self._read_client().get(path)
+            if metadata is None:
+                raise KeyError(name)
+            if stats is not None:
+                stats['keys'] += 1
+                stats['bytes'] += len(metadata.key) + len(value)
+            return value.decode(), 1, metadata.response_header.revision
+
+        kvs = list(self._fetch_prefix(path + '/'))
+        tree = {}
+        try:
+            revision = self._add_key_recursively(kvs, tree, stats)
+        except Exception:
+            raise KeyError(name)
+        for c in path.split('/'):
+            tree = tree[c]
+        return tree, len(kvs), revision
+
+    def _get_subtree(self, key, name, has_children):
+        """Get the subtree of a child of a lazy key from the cache or etcd
+
+        The cache holds at most subtree_cache_size etcd keys (but always
+        the latest subtree), evicting the least recently used subtrees.
+        """
+        k = (key, name)
+        with self._subtree_lock:
+            cached = self._subtrees.get(k)
+            if cached is not None:
+                self._subtrees.move_to_end(k)
+                return cached[0]
+
+        start = time.perf_counter()
+        stats = self._new_stats()
+        subtree, n, revision = self._retry('fetch_subtree',
+                                           self._fetch_subtree,
+                                           key,
+                                           name,
+                                           has_children,
+                                           stats)
+        self._report_load([key + '/' + name], start, stats)
+        with self._subtree_lock:
+            if revision < self._subtree_revisions.get(k, 0):
+                return subtree
+            self._evict_subtree(k)
+            self._subtrees[k] = (subtree, n)
+            self._subtree_keys += n
+            while self._subtree_keys > self.subtree_cache_size and \
+                    len(self._subtrees) > 1:
+                _, (_, evicted) = self._subtrees.popitem(last=False)
+                self._subtree_keys -= evicted
+        return subtree
+
+    def _evict_subtree(self, k):
+        cached = self._subtrees.pop(k, None)
+        if cached is not None:
+            self._subtree_keys -= cached[1]
+
+    def _on_watch_event(self, key, event):
+        if key not in self._watch_ids:
+            return
+        if isinstance(event, Exception):
+            # The watch is gone. Resume it from another thread because
+            # this callback runs on the etcd3 watcher thread, which must
+            # be free to re-establish the watch stream.
+            resync = isinstance(event, RevisionCompactedError)
+            t = threading.Thread(target=self._resume_watch,
+                                 args=(key, resync))
+            t.daemon = True
+            t.start()
+            return
+
+        start = time.perf_counter()
+        lag = event.mod_revision - self._revisions.get(key, 0)
+        self._apply_event(key, event)
+        self.instrumentation.watch_event(key,
+                                         event.mod_revision,
+                                         lag,
+                                         time.perf_counter() - start)
+        self._notify(event)
+
+    def _notify(self, event):
+        if self.dispatcher is not None:
+            self.dispatcher.submit(event)
+        else:
+            self.on_change(event)
+
+    def _watch_incrementally(self, *keys):
+        """Watch the key prefixes from the revision after their last sync"""
+        for key in keys:
+            old = self._watch_ids.get(key)
+            if old is not None:
+                self._watches.remove(old)
+        registrations = self._watches.add_many([
+            (key,
+             functools.partial(self._on_watch_event, key),
+             increment_last_byte(to_bytes(key)),
+             self._revisions[key] + 1)
+            for key in keys])
+        self._watch_ids.update(zip(keys, registrations))
+
+    def _resume_watch(self, key, resync=False):
+        """Re-establish the incremental watch of a key after it broke
+
+        The watch resumes from the last applied revision, so nothing is
+        reloaded. Only if etcd already compacted that revision the key is
+        fully re-synced first.
+        """
+        delays = self.retry_policy.backoff()
+        while key in self._watch_ids:
+            try:
+                if resync:
+                    self._store(self._fetch_key(key), replace=True)
+                    resync = False
+                self._watch_incrementally(key)
+                return
+            except RevisionCompactedError:
+                resync = True
+            except Exception:
+                logger.exception('Failed to resume watch of %s', key)
+                time.sleep(next(delays))
 
     def watch(self, key):
-        watch_id = self.client.add_watch_callback(key, self.on_change)
-        return watch_id
+        """Pass the changes of a key to on_change
+
+        :returns: the watch id to pass to cancel()
+        """
+        return self._watches.add(key, self._notify)
 
     def watch_prefix(self, key):
-        return self.client.watch_prefix(key)
+        """Watch a key prefix
+
+        :returns: an iterator of the events and a cancel function
+        """
+        events = queue.Queue()
+        watch_id = self._watches.add(
+            key, events.put, range_end=increment_last_byte(to_bytes(key)))
+
+        def cancel():
+            self.cancel(watch_id)
+            events.put(None)
+
+        def iterator():
+            while True:
+                event = events.get()
+                if event is None:
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+
+        return iterator(), cancel
 
     def cancel(self, watch_id):
-        self.client.cancel_watch(watch_id)
+        self._watches.remove(watch_id)
 
-    def add_key(self, key, watch=False):
+    def unwatch(self, key):
+        """Stop keeping a key added with watch=True in sync"""
+        watch_id = self._watch_ids.pop(key, None)
+        if watch_id is not None:
+            self.cancel(watch_id)
+
+    def add_key(self, key, watch=False, lazy=False):
         """Add a key to managed etcd keys and store its data
 
         :param str key: the etcd path
         :param bool watch: determine if need to watch the key
+        :param bool lazy: load only the names of the children of the key.
+            The key is stored as a LazyPrefix mapping that fetches the
+            subtree of a child on first access.
+
+        When a key is added all its data is stored as a dict. If page_size
+        was set the data is streamed page by page (see _fetch_prefix_paged).
+
+        A watched key is kept in sync incrementally: every PUT/DELETE
+        under the key is applied to the affected leaf only (and passed to
+        on_change). If the watch breaks it resumes from the last applied
+        revision, and only falls back to a full reload if that revision
+        was compacted.
 
-        When a key is added all its data is stored as a dict
+        Lazy keys are meant for big shared prefixes of which a process
+        reads only a few subtrees. Loading them transfers the keys but no
+        values, and at most subtree_cache_size etcd keys of fetched
+        subtrees are kept in memory. A change under a watched lazy key
+        drops the cached subtree of the changed child.
+
+        If cache_file was set and has the key (and it isn't lazy) the key
+        is served from the cache right away and revalidated in the
+        background, see _load_cached().
         """
-        etcd_result = self.client.get_prefix(key, sort_order='ascend')
-        self._add_key_recursively(etcd_result)
+        if not lazy and self._load_cached([key], watch):
+            return
+        if lazy:
+            self._lazy_keys.add(key)
+        self._load_key(key, replace=False)
+        if watch and key not in self._watch_ids:
+            self._retry('watch', self._watch_incrementally, key)
+
+    def add_keys(self, keys, watch=False):
+        """Add several keys at once and store their data
+
+        :param list keys: the etcd paths
+        :param bool watch: determine if need to watch the keys
+
+        All the keys are fetched in a single round trip (or a few parallel
+        ones pinned to the same revision for many keys), so their data is
+        a consistent snapshot. If page_size was set they're fetched page
+        by page instead, all pinned to the revision of the first page. If
+        any key doesn't exist an exception is raised and nothing is
+        stored. The keys are never lazy.
+
+        If cache_file was set and has all the keys they are served from the
+        cache right away and revalidated in the background.
+        """
+        keys = list(keys)
+        if self._load_cached(keys, watch):
+            return
+        self._load_keys(keys, replace=False)
         if watch:
-            self.watch(key)
+            keys = [key for key in keys if key not in self._watch_ids]
+            if keys:
+                self._retry('watch', self._watch_incrementally, *keys)
+
+    def _fetch_key(self, key, stats=None):
+        if key in self._lazy_keys:
+            return self._fetch_children(key, stats)
+        return self._fetch_tree(key, stats)
+
+    def _fetch_tree(self, key, stats=None):
+        """Fetch a key and build its tree (without storing it)
+
+        :param dict stats: see _add_key_recursively()
+        :returns: a list with a single (key, tree, revision) tuple
+        """
+        tree = {}
+        revision = self._add_key_recursively(self._fetch_prefix(key),
+                                             tree,
+                                             stats)
+        return [(key, tree, revision)]
+
+    def _fetch_trees(self, keys, stats=None, missing_ok=False):
+        """Fetch several keys and build their trees (without storing them)
+
+        :param dict stats: see _add_key_recursively()
+        :param bool missing_ok: a key that doesn't exist gets a None tree
+            instead of raising an exception
+        :returns: a list of (key, tree, revision) tuples
+        """
+        if self.page_size:
+            return self._fetch_trees_paged(keys, stats, missing_ok)
+        revision, results = self._fetch_prefixes(keys)
+        loaded = []
+        for key, etcd_result in zip(keys, results):
+            if not etcd_result:
+                if missing_ok:
+                    loaded.append((key, None, revision))
+                    continue
+                raise Exception('Empty result: ' + key)
+            tree = {}
+            self._add_key_recursively(etcd_result, tree, stats)
+            loaded.append((key, tree, revision))
+        return loaded
+
+    def _fetch_trees_paged(self, keys, stats=None, missing_ok=False):
+        """Fetch several keys page by page (see _fetch_prefix_paged())
+
+        The keys are fetched one after the other, with all their pages
+        pinned to the revision of the first page, so their data is still
+        a consistent snapshot. The stats of the pages of all the keys are
+        stored in last_load_stats.
+
+        :param dict stats: see _add_key_recursively()
+        :param bool missing_ok: see _fetch_trees()
+        :returns: a list of (key, tree, revision) tuples
+        """
+        client = self._read_client()
+        page_stats = _new_page_stats()
+        self.last_load_stats = page_stats
+        revision = 0
+        loaded = []
+        for key in keys:
+            kvs = self._fetch_prefix_paged(key,
+                                           self.page_size,
+                                           revision=revision,
+                                           client=client,
+                                           stats=page_stats)
+            first = next(kvs, None)
+            revision = page_stats['revision']
+            if first is None:
+                if missing_ok:
+                    loaded.append((key, None, revision))
+                    continue
+                raise Exception('Empty result: ' + key)
+            tree = {}
+            self._add_key_recursively(itertools.chain([first], kvs),
+                                      tree,
+                                      stats)
+            loaded.append((key, tree, revision))
+        return loaded
+
+    def _retry(self, operation, f, *args):
+        """Call f(*args) per the retry policy, reporting the retries"""
+        attempts = [0]
+
+        def attempt():
+            attempts[0] += 1
+            return f(*args)
+
+        try:
+            return self.retry_policy.call(attempt)
+        finally:
+            if attempts[0] > 1:
+                self.instrumentation.retried(operation, attempts[0] - 1)
+
+    def _new_stats(self):
+        """Get a dict that fetches count their keys and bytes into
+
+        Counting isn't free, so it's skipped (None) without an
+        instrumentation that could use it.
+        """
+        if type(self.instrumentation) is Instrumentation:
+            return None
+        return dict(keys=0, bytes=0)
+
+    def _report_load(self, keys, start, stats):
+        if stats is not None:
+            self.instrumentation.loaded('etcd',
+                                        keys,
+                                        time.perf_counter() - start,
+                                        stats['keys'],
+                                        stats['bytes'])
+
+    def _load_key(self, key, replace):
+        start = time.perf_counter()
+        stats = self._new_stats()
+        try:
+            loaded = self._retry('load', self._fetch_key, key, stats)
+        except Exception:
+            if key not in self._revisions:
+                self._lazy_keys.discard(key)
+            raise
+        self._store(loaded, replace)
+        self._report_load([key], start, stats)
+
+    def _load_keys(self, keys, replace, missing_ok=False):
+        start = time.perf_counter()
+        stats = self._new_stats()
+        self._store(self._retry('load',
+                                self._fetch_trees,
+                                keys,
+                                stats,
+                                missing_ok),
+                    replace)
+        self._report_load(keys, start, stats)
+
+    def _store(self, loaded, replace, write_cache=True):
+        """Merge freshly loaded keys into the tree and publish it
+
+        :param list loaded: (key, tree, revision) tuples. A None tree
+            means the key no longer exists: its data is dropped and it's
+            no longer managed.
+        :param bool replace: if True the existing data of the keys is
+            dropped first, otherwise the new data is merged into it
+        :param bool write_cache: write the new tree to cache_file (in the
+            background)
+
+        The keys are loaded into separate trees, so the published tree
+        switches from the old data to the new data in one step.
+        """
+        with self._write_lock:
+            tree = self._conf
+            for key, key_tree, revision in loaded:
+                if key_tree is None:
+                    tree = _remove_path(tree, key)
+                    self._revisions.pop(key, None)
+                    continue
+                if replace:
+                    tree = _remove_path(tree, key)
+                tree = _merge_trees(tree, key_tree)
+                self._revisions[key] = revision
+                if key in self._lazy_keys:
+                    self._evict_subtrees(key)
+            self._publish(tree)
+            if write_cache:
+                self._write_cache()
+
+    def _open_cache(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+        try:
+            return SnapshotFile(self.cache_file)
+        except Exception:
+            logger.exception('Ignoring bad cache file %s', self.cache_file)
+            return None
+
+    def _write_cache(self):
+        """Have the tree written to cache_file in the background
+
+        The writes of loads that happen while the cache file is written
+        (or less than cache_write_interval after) are coalesced into one.
+        """
+        if self.cache_file is None or self._closed:
+            return
+        self._cache_pending.set()
+        if self._cache_thread is None:
+            self._cache_thread = threading.Thread(target=self._run_cache)
+            self._cache_thread.daemon = True
+            self._cache_thread.start()
+
+    def _run_cache(self):
+        while True:
+            self._cache_pending.wait()
+            if self._closed:
+                return
+            self.flush_cache()
+            time.sleep(self.cache_write_interval)
+
+    def flush_cache(self):
+        """Write the tree and the revisions of its keys to cache_file now
+
+        Does nothing if cache_file is up to date. Lazy keys are left out,
+        their subtrees are never all in memory.
+        """
+        with self._cache_write_lock:
+            if not self._cache_pending.is_set():
+                return
+            self._cache_pending.clear()
+            with self._write_lock:
+                snapshot = self._snapshot
+                lazy_keys = list(self._lazy_keys)
+                revisions = {k: r for k, r in self._revisions.items()
+                             if k not in self._lazy_keys}
+            tree = snapshot.tree
+            for key in lazy_keys:
+                tree = _remove_path(tree, key)
+            try:
+                write_snapshot(self.cache_file,
+                               tree,
+                               snapshot.version,
+                               dict(revisions=revisions))
+            except Exception:
+                logger.exception('Failed to write cache file %s',
+                                 self.cache_file)
+
+    def _load_cached(self, keys, watch):
+        """Serve new keys from the cache file and revalidate them
+
+        The keys are stored at their cached revision right away, so
+        starting doesn't depend on etcd being fast or even up. Then a
+        background thread brings them up to date: watched keys are watched
+        from their cached revision (only the changes since are applied,
+        unless etcd compacted that revision), other keys are reloaded.
+        It keeps retrying until etcd answers.
+
+        :returns: False if not all the keys are in the cache
+        """
+        cache = self._cache
+        if cache is None:
+            return False
+        revisions = cache.metadata.get('revisions', {})
+        if any(k in self._revisions or k not in revisions for k in keys):
+            return False
+        loaded = [(k, cache.to_dict(k), revisions[k]) for k in keys]
+        self._store(loaded, replace=False, write_cache=False)
+        self.stale_keys.update(keys)
+        if watch:
+            for key in keys:
+                self._watch_ids.setdefault(key, None)
+        t = threading.Thread(target=self._revalidate, args=(keys, watch))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _revalidate(self, keys, watch):
+        if watch:
+            try:
+                self._watch_incrementally(*keys)
+            except Exception:
+                # Resume them one by one, resyncing the compacted ones
+                for key in keys:
+                    self._resume_watch(key)
+            self.stale_keys.difference_update(keys)
+            return
+        delays = self.retry_policy.backoff()
+        while True:
+            try:
+                # Keys deleted from etcd since are dropped
+                self._load_keys(keys, replace=True, missing_ok=True)
+                self.stale_keys.difference_update(keys)
+                return
+            except Exception as e:
+                logger.exception('Failed to revalidate %s', keys)
+                if not self.retry_policy.retryable(e):
+                    return
+                time.sleep(next(delays))
+
+    def _evict_subtrees(self, key):
+        with self._subtree_lock:
+            for k in [k for k in self._subtrees if k[0] == key]:
+                self._evict_subtree(k)
 
     def refresh(self, key=None):
         """Refresh an existing key or all keys
@@ -106,8 +1028,131 @@ class ConManEtcd(ConManBase):
         If the key parameter doesn't exist an exception will be raised.
         No need to watch again the conf keys.
         """
-        keys = [key] if key else self._conf.keys()
-        for k in keys:
-            if k in self._conf:
-                del self._conf[k]
-            self.add_key(k, watch=False)
+        if key is None:
+            return self.refresh_all()
+        self._load_key(key, replace=True)
+
+    def refresh_all(self):
+        """Refresh all keys from one consistent snapshot
+
+        See add_keys() for how the keys are fetched. Lazy keys are
+        refreshed one by one.
+        """
+        keys = [k for k in self._revisions if k not in self._lazy_keys]
+        if keys:
+            self._load_keys(keys, replace=True)
+        for key in list(self._lazy_keys):
+            self._load_key(key, replace=True)
+
+    def __setitem__(self, key, tree):
+        """Write a nested dict to etcd, see put_tree()"""
+        if not isinstance(tree, Mapping):
+            raise Exception('Only nested dicts can be written')
+        self.put_tree(key, tree)
+
+    def put_tree(self, key, tree, delete_missing=True):
+        """Write a nested dict under an etcd key
+
+        :param str key: the etcd path
+        :param dict tree: the values, str or bytes (other values are
+            written as their str())
+        :param bool delete_missing: delete the keys under key that aren't
+            in the tree, so the tree replaces what was there
+        :returns: the etcd revision of the last write, or None if nothing
+            changed
+
+        The tree is flattened into etcd keys and compared with what's
+        under the key, so only new and changed keys are put (and missing
+        ones deleted). The writes are batched into transactions of up to
+        max_txn_ops operations each, so writing 10,000 keys takes a
+        hundred round trips. Every transaction is atomic, but a write that
+        needs several isn't. Then all the puts go before the deletes, so
+        the key is never missing while it's rewritten.
+
+        If the key is managed it's read again at the revision of the last
+        write once it committed, so it can be read back right away (a lazy
+        key has its children listed again and its cached subtrees
+        dropped). That read also has the writes of others that committed
+        in between. Watch events up to that revision are ignored. The
+        stats of the write are stored in last_write_stats.
+        """
+        start = time.perf_counter()
+        new = _flatten(tree, key, {})
+        old = {}
+        # Not a load, so last_load_stats is left alone
+        for value, metadata in self._fetch_prefix(key + '/',
+                                                  _new_page_stats()):
+            old[metadata.key] = value
+        puts = [etcdrpc.RequestOp(
+                    request_put=etcdrpc.PutRequest(key=k, value=v))
+                for k, v in new.items() if old.get(k) != v]
+        deletes = []
+        if delete_missing:
+            deletes = [etcdrpc.RequestOp(
+                           request_delete_range=etcdrpc.DeleteRangeRequest(
+                               key=k))
+                       for k in old if k not in new]
+        ops = puts + deletes
+
+        revision = None
+        n = self.max_txn_ops
+        for i in range(0, len(ops), n):
+            revision = self._retry('write', self._txn, ops[i:i + n])
+        self.last_write_stats = dict(puts=len(puts),
+                                     deletes=len(deletes),
+                                     unchanged=len(new) - len(puts),
+                                     txns=(len(ops) + n - 1) // n,
+                                     revision=revision,
+                                     seconds=time.perf_counter() - start)
+        if revision is None:
+            return None
+
+        if key in self._revisions:
+            loaded = self._retry('load', self._reload_written, key, revision)
+            with self._write_lock:
+                if revision > self._revisions[key]:
+                    self._store(loaded, replace=True)
+        return revision
+
+    def _reload_written(self, key, revision):
+        """Read a managed key again at the revision put_tree() wrote
+
+        It's read with the main client, which wrote it so it surely has
+        the revision, page by page if page_size was set (in one page
+        otherwise). last_load_stats is left alone.
+
+        :returns: a list with a single (key, tree, revision) tuple
+        """
+        lazy = key in self._lazy_keys
+        kvs = self._fetch_prefix_paged(key + '/' if lazy else key,
+                                       self.page_size or 0,
+                                       keys_only=lazy,
+                                       revision=revision,
+                                       client=self.client,
+                                       stats=_new_page_stats())
+        if lazy:
+            key_tree, _ = self._children_tree(key, kvs)
+            return [(key, key_tree, revision)]
+        key_tree = {}
+        first = next(kvs, None)
+        if first is not None:
+            self._add_key_recursively(itertools.chain([first], kvs),
+                                      key_tree)
+        else:
+            # Everything under the key was deleted
+            t = key_tree
+            for c in key.split('/'):
+                t = t[c] = {}
+        return [(key, key_tree, revision)]
+
+    def _txn(self, ops):
+        """Apply write operations in one transaction
+
+        :returns: the revision of the transaction
+        """
+        client = self.client
+        response = client.kvstub.Txn(etcdrpc.TxnRequest(success=ops),
+                                     client.timeout,
+                                     credentials=client.call_credentials,
+                                     metadata=client.metadata)
+        return response.header.revision
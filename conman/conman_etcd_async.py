@@ -0,0 +1,217 @@
+"""An asyncio flavor of the etcd configuration management class
+
+It has the same surface as ConManEtcd, but loading, refreshing and
+watching are coroutines that never block the event loop:
+
+- blocking etcd calls run in the loop's default executor
+- failed calls are retried per the retry policy with asyncio.sleep()
+- change notifications (on_change and the events() iterator) are delivered
+  on the event loop instead of on the etcd3 watcher thread, unless a
+  dispatcher was given (see conman.dispatcher), which gets them instead
+
+cache_file, instrumentation and lazy keys work like with ConManEtcd. Note
+that the first access to a subtree of a lazy key fetches it right away,
+blocking the event loop.
+"""
+import asyncio
+import inspect
+import logging
+import time
+from etcd3.utils import increment_last_byte, to_bytes
+from conman.conman_etcd import ConManEtcd
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConManEtcd(ConManEtcd):
+    def __init__(self, *args, **kwargs):
+        """Initialize like ConManEtcd
+
+        on_change may be a plain function or a coroutine function.
+        """
+        ConManEtcd.__init__(self, *args, **kwargs)
+        self._loop = None
+        self._event_queues = set()
+        # The running tasks of a coroutine on_change. The loop only keeps
+        # weak references to them.
+        self._tasks = set()
+
+    async def _run(self, operation, f, *args, **kwargs):
+        """Run a blocking call in the executor, retrying failures
+
+        :param str operation: the operation to report retries of (see
+            Instrumentation.retried())
+        """
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        attempts = [0]
+
+        def attempt():
+            attempts[0] += 1
+            return f(*args, **kwargs)
+
+        try:
+            return await self.retry_policy.call_async(loop.run_in_executor,
+                                                      None,
+                                                      attempt)
+        finally:
+            if attempts[0] > 1:
+                self.instrumentation.retried(operation, attempts[0] - 1)
+
+    def _notify(self, event):
+        if self.dispatcher is not None:
+            self.dispatcher.submit(event)
+            return
+        # Called on the etcd3 watcher thread, hand over to the event loop
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event):
+        result = self.on_change(event)
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+        for queue in self._event_queues:
+            queue.put_nowait(event)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Change callback failed', exc_info=task.exception())
+
+    async def add_key(self, key, watch=False, lazy=False):
+        """Add a key to managed etcd keys and store its data
+
+        See ConManEtcd.add_key()
+        """
+        if not lazy and await self._run('load',
+                                        self._load_cached,
+                                        [key],
+                                        watch):
+            return
+        if lazy:
+            self._lazy_keys.add(key)
+        try:
+            await self._load_key_async(key, replace=False)
+        except Exception:
+            if key not in self._revisions:
+                self._lazy_keys.discard(key)
+            raise
+        if watch and key not in self._watch_ids:
+            await self._run('watch', self._watch_incrementally, key)
+
+    async def add_keys(self, keys, watch=False):
+        """Add several keys at once and store their data
+
+        See ConManEtcd.add_keys()
+        """
+        keys = list(keys)
+        if await self._run('load', self._load_cached, keys, watch):
+            return
+        await self._load_keys_async(keys, replace=False)
+        keys = [k for k in keys if k not in self._watch_ids]
+        if watch and keys:
+            await self._run('watch', self._watch_incrementally, *keys)
+
+    async def _load_key_async(self, key, replace):
+        start = time.perf_counter()
+        stats = self._new_stats()
+        loaded = await self._run('load', self._fetch_key, key, stats)
+        await self._store_async(loaded, replace)
+        self._report_load([key], start, stats)
+
+    async def _load_keys_async(self, keys, replace):
+        start = time.perf_counter()
+        stats = self._new_stats()
+        loaded = await self._run('load', self._fetch_trees, keys, stats)
+        await self._store_async(loaded, replace)
+        self._report_load(keys, start, stats)
+
+    async def _store_async(self, loaded, replace):
+        """Store loaded keys in the executor
+
+        Storing compacts the tree (in compact mode), calls the listeners
+        and takes the write lock, which a watch event may hold.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._store, loaded, replace)
+
+    async def refresh(self, key=None):
+        """Refresh an existing key or all keys
+
+        See ConManEtcd.refresh()
+        """
+        if key is None:
+            return await self.refresh_all()
+        await self._load_key_async(key, replace=True)
+
+    async def refresh_all(self):
+        """Refresh all keys from one consistent snapshot
+
+        See ConManEtcd.refresh_all()
+        """
+        keys = [k for k in self._revisions if k not in self._lazy_keys]
+        if keys:
+            await self._load_keys_async(keys, replace=True)
+        for key in list(self._lazy_keys):
+            await self._load_key_async(key, replace=True)
+
+    async def watch(self, key):
+        """Watch a key and call on_change on the event loop for each event
+
+        :returns: the watch id to pass to cancel()
+        """
+        return await self._run('watch',
+                               self._watches.add,
+                               key,
+                               self._notify_event)
+
+    def _notify_event(self, event):
+        if not isinstance(event, Exception):
+            self._notify(event)
+
+    async def watch_prefix(self, key):
+        """Watch a key prefix
+
+        :returns: an async iterator of the events and a cancel function
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        watch_id = await self._run(
+            'watch',
+            self._watches.add,
+            key,
+            lambda e: loop.call_soon_threadsafe(queue.put_nowait, e),
+            range_end=increment_last_byte(to_bytes(key)))
+
+        def cancel():
+            self.cancel(watch_id)
+            queue.put_nowait(None)
+
+        async def iterator():
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+
+        return iterator(), cancel
+
+    async def events(self):
+        """Iterate asynchronously over all change events
+
+        Yields the events of the keys added with watch=True and of
+        watch(). Every iterator gets all the events from the moment it
+        starts.
+        """
+        queue = asyncio.Queue()
+        self._event_queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._event_queues.discard(queue)
@@ -4,31 +4,485 @@ It provides a read-only access and just exposes a nested dict
 Supported file formats: Ini,  Json and Yaml
 """
 import os
+import re
 import json
+import mmap
+import hashlib
+import logging
+import threading
+import time
+import functools
 import yaml
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from configparser import ConfigParser
-from conman.conman_base import ConManBase
+from conman.conman_base import (ConManBase,
+                                Lazy,
+                                _build_index,
+                                _missing,
+                                _node_types)
+from conman.file_watcher import FileWatcher
+from conman.layers import LayeredConfig
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 FILE_TYPES = 'ini json yaml'.split()
 
+# How far into a file to look for its first significant line
+SNIFF_SIZE = 64 * 1024
+_ini_section = re.compile(rb'^\[[^\[\]]+\]\s*$')
+
+# Files at least that big are memory-mapped instead of read
+MMAP_THRESHOLD = 1024 * 1024
+
+# Parsed config files keyed by (path, mtime, size, content hash)
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+PARSE_CACHE_SIZE = 256
+
+
+def _parse_ini(data):
+    parser = ConfigParser()
+    parser.read_string(bytes(data).decode())
+    return {name: dict(parser.items(name)) for name in parser.sections()}
+
+
+JSON_PARSERS = ('auto', 'orjson', 'json')
+
+
+def _parse_json(data, parser='auto'):
+    """Parse JSON from a bytes-like object (bytes, mmap or memoryview)
+
+    :param str parser: 'orjson', 'json' or 'auto' (orjson if installed)
+
+    orjson parses straight from the buffer and is faster, but builds a
+    bigger object graph. The json module needs a str, which is decoded
+    straight from the buffer. JSON orjson doesn't accept (e.g. NaN or huge
+    integers) is left to the json module.
+    """
+    if parser != 'json' and orjson is not None:
+        try:
+            return orjson.loads(data if isinstance(data, bytes)
+                                else memoryview(data))
+        except orjson.JSONDecodeError:
+            pass
+    if not isinstance(data, bytes):
+        data = str(data, json.detect_encoding(bytes(data[:4])))
+    return json.loads(data)
+
+
+_json_string = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_json_string_pattern = re.compile(_json_string)
+# A string or a structural character. What's between two tokens is
+# whitespace or scalars.
+_json_token = re.compile(_json_string + rb'|[\[\]{},:]')
+# Everything up to the next bracket, skipping strings as a whole
+_json_between = re.compile(rb'(?:[^"\[\]{}]+|' + _json_string + rb')*')
+_json_scalar = re.compile(rb'[^"\[\]{},:]*')
+_json_space = re.compile(rb'\s*')
+_json_open = frozenset(b'[{')
+_json_close = frozenset(b']}')
+
+
+def _blank(data, start, end):
+    return _json_space.match(data, start).end() >= end
+
+
+def _skip_json_container(data, pos):
+    """Find the end of the array or object that starts at pos
+
+    :returns: the position after its closing bracket or None
+    """
+    depth = 0
+    while True:
+        pos = _json_between.match(data, pos).end()
+        if pos >= len(data):
+            return None
+        c = data[pos]
+        if c in _json_open:
+            depth += 1
+        elif c in _json_close:
+            depth -= 1
+            if not depth:
+                return pos + 1
+        else:
+            # An unterminated string
+            return None
+        pos += 1
+
+
+def _scan_json_members(data, pos):
+    """Locate the top-level members of a JSON object
+
+    Only the brackets in between the members are looked at, so
+    containers are skipped at the speed of the regex engine.
+
+    :param int pos: the position after the opening '{'
+    :returns: the (key start, key end, value start, value end) of every
+        member and the position after the closing '}', or None if the
+        object is malformed
+    """
+    members = []
+    while True:
+        m = _json_token.search(data, pos)
+        if m is None or not _blank(data, pos, m.start()):
+            return None
+        c = data[m.start()]
+        if c == 0x7d and not members:  # '}' of an empty object
+            return members, m.end()
+        if c != 0x22:  # '"'
+            return None
+        key_start, key_end = m.span()
+        m = _json_token.search(data, key_end)
+        if m is None or data[m.start()] != 0x3a or \
+                not _blank(data, key_end, m.start()):  # ':'
+            return None
+        start = _json_space.match(data, m.end()).end()
+        c = data[start] if start < len(data) else None
+        if c in _json_open:
+            end = _skip_json_container(data, start)
+        elif c == 0x22:
+            m = _json_string_pattern.match(data, start)
+            end = m and m.end()
+        else:
+            end = _json_scalar.match(data, start).end()
+        if end is None:
+            return None
+        m = _json_token.search(data, end)
+        if m is None or not _blank(data, end, m.start()):
+            return None
+        c = data[m.start()]
+        if c != 0x2c and c != 0x7d:  # ',' or '}'
+            return None
+        members.append((key_start, key_end, start, end))
+        pos = m.end()
+        if c == 0x7d:
+            return members, pos
+
+
+def _parse_json_span(view, start, end, parser):
+    return _parse_json(view[start:end], parser)
+
+
+def _parse_json_lazy(data, parser='auto'):
+    """Parse a JSON object, leaving its top-level containers unparsed
+
+    The top-level members are located by a scan (see
+    _scan_json_members()) that doesn't build any objects. Every array or
+    object member becomes a Lazy value that parses its span of data on
+    first access, so data must stay valid as long as the result is used.
+    Data the scan can't handle (e.g. not an object) is parsed eagerly.
+    """
+    start = _json_space.match(data).end()
+    scan = None
+    if data[start:start + 1] == b'{':
+        scan = _scan_json_members(data, start + 1)
+    if scan is None or not _blank(data, scan[1], len(data)):
+        return _parse_json(data, parser)
+    view = memoryview(data)
+    conf = {}
+    for key_start, key_end, start, end in scan[0]:
+        key = data[key_start:key_end]
+        key = _parse_json(key) if b'\\' in key else key[1:-1].decode()
+        if start < end and data[start] in _json_open:
+            conf[key] = Lazy(_parse_json_span, view, start, end, parser)
+        else:
+            conf[key] = _parse_json(data[start:end], parser)
+    return conf
+
+
+def get_yaml_loader(name='auto'):
+    """Get a YAML loader class by name
+
+    :param str name: one of:
+        'auto' - the fastest safe loader: the libyaml based CSafeLoader if
+            PyYAML was compiled with libyaml, SafeLoader otherwise
+        'c' - CSafeLoader (fails if libyaml is not available)
+        'safe' - the pure Python SafeLoader
+        'full' - FullLoader, which can also construct some Python objects
+    """
+    if name == 'auto':
+        return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    if name == 'c':
+        if not yaml.__with_libyaml__:
+            raise Exception('PyYAML was built without libyaml')
+        return yaml.CSafeLoader
+    if name == 'safe':
+        return yaml.SafeLoader
+    if name == 'full':
+        return yaml.FullLoader
+    raise Exception('Unknown YAML loader: ' + name)
+
+
+def _parse_yaml(data, loader='auto'):
+    return yaml.load(bytes(data), Loader=get_yaml_loader(loader))
+
+
+_parsers = dict(ini=_parse_ini,
+                json=_parse_json,
+                json_lazy=_parse_json_lazy,
+                yaml=_parse_yaml)
+
+
+def _sniff_file_types(data):
+    """Detect the likely file types of a config from its first bytes
+
+    :param bytes data: the content of the config file
+    :returns: the candidate file types, most likely first
+
+    Leading blank and comment lines are skipped. A '[section]' header
+    means INI, a '{' means JSON (or a YAML flow mapping) and anything else
+    means YAML.
+    """
+    for line in data[:SNIFF_SIZE].lstrip(b'\xef\xbb\xbf').splitlines():
+        line = line.strip()
+        if not line or line[:1] in (b'#', b';'):
+            continue
+        if _ini_section.match(line):
+            return ['ini']
+        if line[:1] == b'{':
+            return ['json', 'yaml']
+        return ['yaml']
+    return ['yaml']
+
+
+def _parse_config(data,
+                  file_type,
+                  filename,
+                  yaml_loader='auto',
+                  json_parser='auto',
+                  lazy_json=False):
+    """Parse the content of a config file
+
+    :param bytes data: the content of the config file (or an mmap of it)
+    :param str file_type: the file type to try first (may be None)
+    :param str filename: the config filename (for error messages)
+    :param str yaml_loader: the YAML loader name (see get_yaml_loader())
+    :param str json_parser: the JSON parser name (see _parse_json())
+    :param bool lazy_json: parse the top-level containers of JSON files
+        on first access (see _parse_json_lazy())
+    :returns: the parsed configuration dict
+
+    The given file type is tried first. If it's unknown or parsing fails
+    the file types sniffed from the content are tried, so usually the
+    content is parsed exactly once. A parse that fails or doesn't produce
+    a dict leaves no trace.
+    """
+    return _parse_config_timed(data,
+                               file_type,
+                               filename,
+                               yaml_loader,
+                               json_parser,
+                               lazy_json)[0]
+
+
+def _parse_config_timed(data,
+                        file_type,
+                        filename,
+                        yaml_loader='auto',
+                        json_parser='auto',
+                        lazy_json=False):
+    """Parse like _parse_config(), measuring the time it takes
+
+    :returns: the parsed configuration dict, the file type it was parsed
+        as and the duration in seconds
+    """
+    start = time.perf_counter()
+    file_types = [file_type] if file_type in _parsers else []
+    for t in _sniff_file_types(data):
+        if t not in file_types:
+            file_types.append(t)
+    for t in file_types:
+        try:
+            if t == 'yaml':
+                conf = _parsers[t](data, yaml_loader)
+            elif t == 'json':
+                parse = _parsers['json_lazy' if lazy_json else 'json']
+                conf = parse(data, json_parser)
+            else:
+                conf = _parsers[t](data)
+        except Exception:
+            continue
+        if isinstance(conf, dict):
+            return conf, t, time.perf_counter() - start
+
+    raise Exception('Bad config file: ' + filename)
+
+
+def _read_config_file(filename, use_mmap=True):
+    """Read a config file
+
+    :param bool use_mmap: memory-map the file if it's at least
+        MMAP_THRESHOLD bytes, so it's parsed without copying it
+    :returns: the parse cache key of the file and its content (bytes or
+        a read-only mmap)
+    """
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if use_mmap and st.st_size >= MMAP_THRESHOLD:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+    key = (os.path.abspath(filename),
+           st.st_mtime_ns,
+           st.st_size,
+           hashlib.sha1(data).hexdigest())
+    return key, data
+
+
+def _copy_tree(node):
+    """Copy the dicts and lists of a parsed config
+
+    Lazy values are copied into Lazy values that copy what the original
+    resolves to, so the parsing is still shared but the results aren't.
+    """
+    if type(node) is dict:
+        return {k: _copy_tree(v) for k, v in node.items()}
+    if type(node) is list:
+        return [_copy_tree(v) for v in node]
+    if type(node) is Lazy:
+        return Lazy(_resolve_copy, node)
+    return node
+
+
+def _resolve_copy(lazy):
+    return _copy_tree(lazy.resolve())
+
+
+# The cache keeps the parsed configs and only hands out copies of them, so
+# a ConManFile changing its tree doesn't change the others'
+def _get_cached(key):
+    with _parse_cache_lock:
+        conf = _parse_cache.get(key)
+        if conf is None:
+            return None
+        _parse_cache.move_to_end(key)
+    return _copy_tree(conf)
+
+
+def _put_cached(key, conf):
+    """Cache a config
+
+    :returns: a copy of the config for the caller to use
+    """
+    with _parse_cache_lock:
+        _parse_cache[key] = conf
+        while len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    return _copy_tree(conf)
+
+
+def diff_trees(old, new, keys=None):
+    """Compare two nested dicts
+
+    :param iterable keys: only compare these top-level keys (all if None)
+    :returns: a dict with sorted lists of the '/' separated leaf paths
+        that were 'added', 'removed' and 'changed'
+    """
+    diff = dict(added=[], removed=[], changed=[])
+    if keys is None:
+        keys = set(old) | set(new)
+    stack = [('', old, new, keys)]
+    while stack:
+        prefix, o, n, keys = stack.pop()
+        for k in keys:
+            path = prefix + str(k)
+            ov = o.get(k, _missing)
+            nv = n.get(k, _missing)
+            if ov is nv:
+                continue
+            if type(ov) is Lazy:
+                ov = ov.resolve()
+            if type(nv) is Lazy:
+                nv = nv.resolve()
+            if isinstance(ov, _node_types) and isinstance(nv, _node_types):
+                stack.append((path + '/', ov, nv, set(ov) | set(nv)))
+            elif ov is _missing:
+                diff['added'].extend(_leaf_paths(path, nv))
+            elif nv is _missing:
+                diff['removed'].extend(_leaf_paths(path, ov))
+            elif ov != nv:
+                diff['changed'].append(path)
+    for paths in diff.values():
+        paths.sort()
+    return diff
+
+
+def _leaf_paths(path, node):
+    if not isinstance(node, _node_types):
+        return [path]
+    return [path + '/' + p for p, v in _build_index(node).items()
+            if not isinstance(v, _node_types)] or [path]
+
 
 class ConManFile(ConManBase):
-    def __init__(self, config_files=()):
+    def __init__(self,
+                 config_files=(),
+                 yaml_loader='auto',
+                 on_change=lambda diff: None,
+                 json_parser='auto',
+                 lazy_json=False,
+                 compact=False,
+                 instrumentation=None,
+                 deep_merge=False):
         """Initialize with config files
 
         :param iterable config_files: a list of config file names or
             environment variables that contain file names.
+        :param str yaml_loader: the loader that parses YAML files. By
+            default the fastest safe loader available (see get_yaml_loader())
+        :param callable on_change: called with the diff (see diff_trees())
+            after watched config files changed and were reloaded
+        :param str json_parser: the parser of JSON files: 'orjson', 'json'
+            or 'auto' (orjson if installed). orjson is faster, but the
+            json module builds a smaller object graph.
+        :param bool lazy_json: parse the top-level arrays and objects of
+            JSON files only when they are first accessed. The files are
+            memory-mapped, so they must be replaced (e.g. renamed over)
+            rather than rewritten in place while in use.
+        :param bool compact: store the configuration as compact read-only
+            mappings (see conman.compact)
+        :param Instrumentation instrumentation: receives the load and
+            parse times (see conman.instrumentation)
+        :param bool deep_merge: merge the files deeply, so a later file
+            overrides only the values it has instead of whole top-level
+            subtrees (see conman.layers). Lazy JSON values are parsed when
+            they are merged.
 
         You may choose not to initialize with any config files and add
         them later using add_config_file(), which is more sophisticated.
 
-        ConMan works with multiple file formats and will try all of them
-        until one succeeds or all of them fail.
+        ConMan works with multiple file formats. If the format of a file
+        can't be told by its extension it's detected from its content.
+
+        Big files are memory-mapped and parsed straight from the mapped
+        bytes, without reading them into memory first.
         """
-        ConManBase.__init__(self)
+        ConManBase.__init__(self, compact, instrumentation)
         self._config_files = []
-        for config_file in config_files:
-            self.add_config_file(config_file)
+        get_yaml_loader(yaml_loader)
+        self.yaml_loader = yaml_loader
+        self.on_change = on_change
+        if json_parser not in JSON_PARSERS:
+            raise Exception('Unknown JSON parser: ' + json_parser)
+        if json_parser == 'orjson' and orjson is None:
+            raise Exception('orjson is not installed')
+        self.json_parser = json_parser
+        self.lazy_json = lazy_json
+        # The parsed content and given file type of every config file
+        self._layers = {}
+        self._file_types = {}
+        # Merges the files deeply if deep_merge was set
+        self._merger = LayeredConfig() if deep_merge else None
+        self._watcher = None
+        self._watch_args = None
+        if config_files:
+            self.add_config_files(config_files)
 
     def add_config_file(self,
                         filename=None,
@@ -63,38 +517,238 @@ class ConManFile(ConManBase):
         if filename is not None and env_variable is not None:
             raise Exception('filename and env_variable are both not None')
 
-        if filename in self._config_files:
-            raise Exception('filename is already in the config file list')
-
         if env_variable:
             filename = os.environ[env_variable]
 
         if base_dir:
             filename = os.path.join(base_dir, filename)
 
-        if not os.path.isfile(filename):
-            raise Exception('No such file: ' + filename)
+        self.add_config_files([filename], file_type=file_type)
+
+    def add_config_files(self,
+                         filenames,
+                         file_type=None,
+                         max_workers=None,
+                         use_processes=False):
+        """Add several configuration files at once
+
+        :param iterable filenames: paths to config files
+        :param str file_type: if not None, the file type of all the files
+        :param int max_workers: the size of the pool that parses the files
+        :param bool use_processes: parse in a process pool instead of a
+            thread pool. Worth it for many big files, since parsing is CPU
+            bound. Not supported with lazy_json.
+
+        The files are read and parsed in parallel, but merged in the given
+        order, so later files still override earlier ones deterministically.
+        If any file is bad nothing is added.
+
+        Parsed files are cached by path, modification time, size and
+        content hash, so adding an unchanged file again doesn't parse it.
+        """
+        if use_processes and self.lazy_json:
+            raise Exception('lazy_json files are parsed in threads')
+        filenames = list(filenames)
+        for filename in filenames:
+            if filename in self._config_files:
+                raise Exception(
+                    'filename is already in the config file list')
+            if not os.path.isfile(filename):
+                raise Exception('No such file: ' + filename)
+
+        start = time.perf_counter()
+        file_types = [file_type] * len(filenames)
+        confs = self._load_files(filenames,
+                                 file_types,
+                                 max_workers,
+                                 use_processes)
+        with self._write_lock:
+            merged = dict(self._conf)
+            for filename, t, conf in zip(filenames, file_types, confs):
+                if self._merger is not None:
+                    self._merger.set_layer(filename, conf)
+                    merged = self._merger.tree
+                else:
+                    merged.update(conf)
+                self._layers[filename] = conf
+                self._file_types[filename] = t
+            self._publish(merged)
+            self._config_files.extend(filenames)
+        self._report_load(filenames, confs, start)
+        if self._watcher is not None:
+            self.stop_watching()
+            self.watch(*self._watch_args)
+
+    def _load_files(self,
+                    filenames,
+                    file_types,
+                    max_workers=None,
+                    use_processes=False):
+        """Read and parse config files, using the parse cache
+
+        :returns: the parsed configuration dict of every file
+        """
+        # An mmap can't be sent to another process
+        read = functools.partial(_read_config_file,
+                                 use_mmap=not use_processes)
+        if len(filenames) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                files = list(pool.map(read, filenames))
+        else:
+            files = [read(f) for f in filenames]
+
+        try:
+            # Different parsers may parse the same file differently
+            keys = [key + (self.yaml_loader, self.json_parser, self.lazy_json)
+                    for key, _ in files]
+            confs = [_get_cached(key) for key in keys]
+            misses = [i for i, conf in enumerate(confs) if conf is None]
+            args = [(files[i][1],
+                     file_types[i] or self._guess_file_type(filenames[i]),
+                     filenames[i],
+                     self.yaml_loader,
+                     self.json_parser,
+                     self.lazy_json) for i in misses]
+            if len(misses) > 1:
+                executor = ProcessPoolExecutor if use_processes \
+                    else ThreadPoolExecutor
+                with executor(max_workers=max_workers) as pool:
+                    parsed = list(pool.map(_parse_config_timed, *zip(*args)))
+            else:
+                parsed = [_parse_config_timed(*a) for a in args]
+            for i, (conf, parsed_type, seconds) in zip(misses, parsed):
+                self.instrumentation.parsed(parsed_type,
+                                            seconds,
+                                            len(files[i][1]))
+                confs[i] = _put_cached(keys[i], conf)
+            return confs
+        finally:
+            # Lazy values still refer to the mapped files
+            if not self.lazy_json:
+                for _, data in files:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+
+    def watch(self, debounce=0.1, poll_interval=1.0, use_inotify=None):
+        """Reload the config files whenever they change
 
-        if not file_type:
-            file_type = self._guess_file_type(filename)
+        :param float debounce: wait until the files didn't change for that
+            many seconds, so a burst of writes triggers a single reload
+        :param float poll_interval: seconds between modification time
+            checks if inotify isn't used
+        :param bool use_inotify: None means use inotify if available and
+            poll otherwise
 
-        file_types = set(FILE_TYPES)
-        if file_type:
+        Only the changed files are parsed again, and only the top-level
+        keys they define are re-merged. Files that fail to parse (e.g. in
+        the middle of a non-atomic write) keep their previous content until
+        they change again. on_change is called with the diff of every
+        reload that changed anything.
+        """
+        if self._watcher is not None:
+            return
+        self._watch_args = (debounce, poll_interval, use_inotify)
+        self._watcher = FileWatcher(self._config_files,
+                                    self._reload,
+                                    debounce=debounce,
+                                    poll_interval=poll_interval,
+                                    use_inotify=use_inotify)
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _report_load(self, filenames, confs, start):
+        size = 0
+        for filename in filenames:
             try:
-                return self._process_file(filename, file_type)
-            except Exception:
-                # Remove failed file_type from set of file types to try
-                if file_type in file_types:
-                    file_types.remove(file_type)
+                size += os.path.getsize(filename)
+            except OSError:
+                pass
+        self.instrumentation.loaded('file',
+                                    filenames,
+                                    time.perf_counter() - start,
+                                    sum(len(conf) for conf in confs),
+                                    size)
 
-        # If no file type can be guessed or guess failed try all parsers
-        for file_type in file_types:
+    def _reload(self, filenames):
+        """Parse changed config files again and re-merge what they define"""
+        start = time.perf_counter()
+        loaded = []
+        for filename in self._config_files:
+            if filename not in filenames:
+                continue
             try:
-                return self._process_file(filename, file_type)
+                conf = self._load_files([filename],
+                                        [self._file_types[filename]])[0]
             except Exception:
-                pass
+                logger.warning('Failed to reload %s', filename, exc_info=True)
+                continue
+            loaded.append((filename, conf))
 
-        raise Exception('Bad config file: ' + filename)
+        with self._write_lock:
+            old = self._conf
+            if self._merger is not None:
+                tree, affected = self._merge_deeply(loaded)
+            else:
+                tree, affected = self._merge_shallowly(loaded)
+            diff = diff_trees(old, tree, affected)
+            if any(diff.values()):
+                self._publish(tree)
+        if loaded:
+            self._report_load([f for f, _ in loaded],
+                              [conf for _, conf in loaded],
+                              start)
+        if any(diff.values()):
+            self.on_change(diff)
+
+    def _merge_shallowly(self, loaded):
+        """Re-merge the top-level keys the reloaded files define
+
+        :param list loaded: (filename, conf) pairs
+        :returns: the new tree and the affected top-level keys
+        """
+        affected = set()
+        for filename, conf in loaded:
+            affected |= set(self._layers[filename]) | set(conf)
+            self._layers[filename] = conf
+
+        tree = dict(self._conf)
+        layers = list(self._layers.values())
+        for k in affected:
+            for layer in reversed(layers):
+                if k in layer:
+                    tree[k] = layer[k]
+                    break
+            else:
+                tree.pop(k, None)
+        return tree, affected
+
+    def _merge_deeply(self, loaded):
+        """Recompute the paths that changed in the reloaded files
+
+        :param list loaded: (filename, conf) pairs
+        :returns: the new tree and the affected top-level keys
+        """
+        affected = set()
+        for filename, conf in loaded:
+            self._layers[filename] = conf
+            paths = self._merger.set_layer(filename, conf)
+            affected.update(path[0] for path in paths)
+        return self._merger.tree, affected
+
+    def provenance(self, path):
+        """Get the config file a value comes from
+
+        :param str path: the '/' separated path of a leaf value
+        :returns: the file name or None if there's no such value
+
+        Only available with deep_merge=True.
+        """
+        if self._merger is None:
+            raise Exception('provenance() needs deep_merge=True')
+        return self._merger.provenance(path)
 
     def _guess_file_type(self, filename):
         """Guess the file type based on its extension
@@ -110,24 +764,3 @@ class ConManFile(ConManBase):
                     yaml='yaml',
                     json='json',
                     ini='ini').get(ext, None)
-
-    def _process_file(self, filename, file_type):
-        process_func = getattr(self, '_process_%s_file' % file_type)
-        process_func(filename)
-
-    def _process_ini_file(self, filename):
-        parser = ConfigParser()
-        parser.read(filename)
-        for section_name in parser.sections():
-            self._conf[section_name] = {}
-            section = self._conf[section_name]
-            for name, value in parser.items(section_name):
-                section[name] = value
-
-    def _process_json_file(self, filename):
-        with open(filename) as f:
-            self._conf.update(json.load(f))
-
-    def _process_yaml_file(self, filename):
-        with open(filename) as f:
-            self._conf.update(yaml.full_load(f))
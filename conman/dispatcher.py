@@ -0,0 +1,210 @@
+"""Deliver watch events in coalesced batches on worker threads
+
+By default ConManEtcd calls on_change for every watch event, on the etcd3
+watcher thread. A slow callback then holds up the watch stream, and a bulk
+change of thousands of keys triggers thousands of callbacks. With
+ConManEtcd(dispatcher=EventDispatcher(callback)) the events are queued
+instead, and the callback gets them in batches on a worker thread:
+
+- events are collected until max_batch keys changed or max_delay seconds
+  passed since the first of them
+- several changes of the same key while it's queued are coalesced into
+  the latest one
+- at most max_queue keys are queued. When the queue is full the policy
+  decides: 'block' holds up the watcher thread until there's room,
+  'drop_oldest' and 'drop_newest' drop an event (and count it), so the
+  callback should re-read the configuration when stats['dropped'] grows
+- batches are delivered by up to workers threads. While all of them are
+  busy events keep coalescing in the queue. With more than one worker
+  batches may be delivered out of order.
+
+stats has the counters and the queue depth, and the instrumentation (see
+conman.instrumentation) gets the size, queue depth and lag of every batch.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from conman.instrumentation import Instrumentation
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+def _event_key(event):
+    return getattr(event, 'key', None)
+
+
+class EventDispatcher(object):
+    def __init__(self,
+                 callback,
+                 max_batch=1000,
+                 max_delay=0.05,
+                 max_queue=10000,
+                 policy=BLOCK,
+                 workers=1,
+                 key=_event_key,
+                 instrumentation=None):
+        """
+        :param callable callback: called with a list of events
+        :param int max_batch: the maximal number of events in a batch
+        :param float max_delay: the maximal time in seconds an event waits
+            for more events to be batched with it
+        :param int max_queue: the maximal number of queued events
+        :param str policy: what to do with a new event when the queue is
+            full: 'block', 'drop_oldest' or 'drop_newest'
+        :param int workers: the number of threads that run the callback
+        :param callable key: gets the key events are coalesced by. Events
+            with a None key are never coalesced.
+        :param Instrumentation instrumentation: gets the batch metrics
+        """
+        if policy not in POLICIES:
+            raise Exception('Unknown backpressure policy: ' + policy)
+        self.callback = callback
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.policy = policy
+        self.key = key
+        self.instrumentation = instrumentation or Instrumentation()
+        self.stats = dict(received=0,
+                          coalesced=0,
+                          dropped=0,
+                          batches=0,
+                          delivered=0,
+                          failed=0,
+                          queue_depth=0,
+                          max_queue_depth=0,
+                          lag=0.0,
+                          max_lag=0.0)
+        # key -> (event, the time its key was first queued)
+        self._queue = OrderedDict()
+        self._unique = 0
+        self._window_start = None
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(workers)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, event):
+        """Queue an event (called on the watcher thread)"""
+        k = self.key(event)
+        stats = self.stats
+        with self._cond:
+            if self._closed:
+                raise Exception('The dispatcher is closed')
+            stats['received'] += 1
+            if k is not None and k in self._queue:
+                received = self._queue.pop(k)[1]
+                self._queue[k] = (event, received)
+                stats['coalesced'] += 1
+                return
+            while len(self._queue) >= self.max_queue:
+                if self.policy == DROP_NEWEST:
+                    stats['dropped'] += 1
+                    return
+                if self.policy == DROP_OLDEST:
+                    self._queue.popitem(last=False)
+                    stats['dropped'] += 1
+                    break
+                self._cond.wait()
+                if self._closed:
+                    raise Exception('The dispatcher is closed')
+            if k is None:
+                # Unique, so it's never coalesced
+                k = self._unique = self._unique - 1
+            now = time.monotonic()
+            self._queue[k] = (event, now)
+            if self._window_start is None:
+                self._window_start = now
+            depth = len(self._queue)
+            stats['queue_depth'] = depth
+            stats['max_queue_depth'] = max(stats['max_queue_depth'], depth)
+            self._cond.notify_all()
+
+    def _next_batch(self):
+        """Wait for the next batch to be due and take it from the queue"""
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            deadline = self._window_start + self.max_delay
+            while len(self._queue) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            n = min(self.max_batch, len(self._queue))
+            batch = [self._queue.popitem(last=False)[1] for _ in range(n)]
+            # Events left behind are overdue, so the window stays open
+            if not self._queue:
+                self._window_start = None
+            self.stats['queue_depth'] = len(self._queue)
+            self._in_flight += 1
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            batch = self._next_batch()
+            if batch is None:
+                self._slots.release()
+                return
+            self._pool.submit(self._deliver, batch)
+
+    def _deliver(self, batch):
+        lag = time.monotonic() - min(received for _, received in batch)
+        events = [event for event, _ in batch]
+        failed = False
+        try:
+            self.callback(events)
+        except Exception:
+            failed = True
+            logger.exception('Event callback failed')
+        finally:
+            self._slots.release()
+            stats = self.stats
+            with self._cond:
+                self._in_flight -= 1
+                stats['batches'] += 1
+                stats['delivered'] += len(events)
+                stats['failed'] += failed
+                stats['lag'] = lag
+                stats['max_lag'] = max(stats['max_lag'], lag)
+                depth = stats['queue_depth']
+                self._cond.notify_all()
+            self.instrumentation.dispatched(len(events), depth, lag)
+
+    def flush(self, timeout=None):
+        """Wait until all the queued events were delivered
+
+        :returns: False if the timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._in_flight, timeout)
+
+    def close(self):
+        """Deliver the queued events and stop
+
+        Events submitted afterwards raise an exception.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._pool.shutdown(wait=True)
@@ -1,84 +1,101 @@
 #!/usr/bin/env python
+import json
 import psutil
 import subprocess
 import time
-from conman.conman_etcd import thrice
+import urllib.request
+from conman.retry import RetryPolicy
 from etcd3.exceptions import Etcd3Exception
 
 etcd_process = None
 
+retry = RetryPolicy(max_attempts=3, base_delay=0.5, max_delay=2)
 
-def start_local_etcd_server():
-    """Start etcd if not running already
+ETCD_BINARY = '/usr/local/bin/etcd'
+HEALTH_URL = 'http://127.0.0.1:2379/health'
+
+# Seconds between readiness checks
+POLL_INTERVAL = 0.01
+
+
+def start_local_etcd_server(timeout=30):
+    """Start etcd if not running already and wait until it's healthy
 
     Note: this function is blocking
     """
-    if is_local_etcd_running():
+    if is_local_etcd_healthy():
         return
 
     global etcd_process
-    etcd_process = subprocess.Popen(
-        '/usr/local/bin/etcd',
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    if not is_local_etcd_running():
+        etcd_process = subprocess.Popen(ETCD_BINARY,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
 
-    # Wait for etcd process to start
-    while not is_local_etcd_running():
-        time.sleep(1)
-    # wait a little longer to let etcd warm up
-    time.sleep(2)
+    deadline = time.monotonic() + timeout
+    while not is_local_etcd_healthy():
+        if etcd_process is not None and etcd_process.poll() is not None:
+            code = etcd_process.returncode
+            etcd_process = None
+            raise Exception('local etcd server exited with %d' % code)
+        if time.monotonic() > deadline:
+            raise Exception('local etcd server is not healthy')
+        time.sleep(POLL_INTERVAL)
 
 
-def is_local_etcd_running():
-    etcd = None
+def is_local_etcd_healthy(timeout=1):
+    """Check the health endpoint of the local etcd server
+
+    etcd reports healthy once it has a leader and serves requests.
+    """
+    try:
+        with urllib.request.urlopen(HEALTH_URL, timeout=timeout) as r:
+            return json.load(r).get('health') == 'true'
+    except Exception:
+        return False
+
+
+def _local_etcd_processes():
+    processes = []
     for p in psutil.process_iter():
         try:
-            if p.name() == 'etcd' and p.status() != 'zombie':
-                etcd = p
-                break
-        except psutil.ZombieProcess:
+            if p.name() == 'etcd' and p.status() != psutil.STATUS_ZOMBIE:
+                processes.append(p)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
             pass
+    return processes
 
-    if not etcd:
-        return False
 
-    return etcd.status() == 'running'
+def is_local_etcd_running():
+    return bool(_local_etcd_processes())
 
 
-def kill_local_etcd_server():
+def kill_local_etcd_server(timeout=10):
     global etcd_process
     if etcd_process is not None:
-        etcd_process.stdout.close()
-        etcd_process.stderr.close()
         etcd_process.kill()
         try:
-            etcd_process.wait(3)
-        except psutil.TimeoutExpired:
-            etcd_process.terminate()
+            etcd_process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            # Don't leave it running (or a zombie) behind
+            etcd_process.kill()
+            etcd_process.wait()
         etcd_process = None
 
-    if not is_local_etcd_running():
-        return
-
-    for p in psutil.process_iter():
+    processes = _local_etcd_processes()
+    for p in processes:
         try:
-            if p.name() == 'etcd' and p.status() != 'zombie':
-                p.kill()
-        except psutil.ZombieProcess:
+            p.kill()
+        except psutil.NoSuchProcess:
             pass
 
-    # Wait for 10 seconds for process to die
-    for i in range(20):
-        if not is_local_etcd_running():
-            return
-
-        time.sleep(0.5)
-
-    # Server didn't die, just give up and raise an exception
-    raise Exception('local etcd server is still running')
+    _, alive = psutil.wait_procs(processes, timeout)
+    if alive:
+        # Server didn't die, just give up and raise an exception
+        raise Exception('local etcd server is still running')
 
 
-@thrice()
+@retry
 def set_key(client, key, values):
     """Insert a bunch of key value pairs to an etcd key using etcdctl.
 
@@ -94,7 +111,7 @@ def set_key(client, key, values):
             client.put(k, value)
 
 
-@thrice()
+@retry
 def delete_key(client, key):
     """Delete a key if exists
 
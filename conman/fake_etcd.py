@@ -0,0 +1,392 @@
+"""An in-memory etcd for tests and benchmarks
+
+FakeEtcd implements the KV and watch parts of the etcd API in memory,
+with the full MVCC semantics conman relies on: a global revision, the
+create/mod revisions and versions of keys, reads at past revisions,
+transactions (with compares) that apply at a single revision, watches
+from past revisions and compaction.
+
+FakeEtcd.client() returns an etcd3 client whose KV stub and watcher are
+the FakeEtcd, so everything built on the client (get(), put(),
+get_prefix(), transaction(), watches and the raw kvstub requests of
+ConManEtcd) behaves like with a server, minus the network and the
+process:
+
+    etcd = FakeEtcd()
+    conman = ConManEtcd(client=etcd.client())
+
+Watch callbacks run on a watcher thread per client, like with etcd3.
+break_watches() fails all the watches the way a broken watch stream
+does. Leases, auth, cluster and maintenance calls aren't supported.
+"""
+import bisect
+import itertools
+import logging
+import queue
+import threading
+
+import etcd3
+from etcd3 import etcdrpc
+from etcd3.client import Transactions
+from etcd3.etcdrpc import kv_pb2
+from etcd3.events import new_event
+from etcd3.exceptions import RevisionCompactedError
+from etcd3.utils import to_bytes
+
+logger = logging.getLogger(__name__)
+
+_compare_results = {
+    etcdrpc.Compare.EQUAL: lambda a, b: a == b,
+    etcdrpc.Compare.GREATER: lambda a, b: a > b,
+    etcdrpc.Compare.LESS: lambda a, b: a < b,
+    etcdrpc.Compare.NOT_EQUAL: lambda a, b: a != b,
+}
+
+_compare_targets = {
+    etcdrpc.Compare.VERSION: 'version',
+    etcdrpc.Compare.CREATE: 'create_revision',
+    etcdrpc.Compare.MOD: 'mod_revision',
+    etcdrpc.Compare.VALUE: 'value',
+    etcdrpc.Compare.LEASE: 'lease',
+}
+
+_sort_targets = {
+    etcdrpc.RangeRequest.KEY: 'key',
+    etcdrpc.RangeRequest.VERSION: 'version',
+    etcdrpc.RangeRequest.CREATE: 'create_revision',
+    etcdrpc.RangeRequest.MOD: 'mod_revision',
+    etcdrpc.RangeRequest.VALUE: 'value',
+}
+
+
+def _in_range(key, start, range_end):
+    if not range_end:
+        return key == start
+    if range_end == b'\0':
+        return key >= start
+    return start <= key < range_end
+
+
+class FakeEtcd(object):
+    def __init__(self):
+        self.revision = 1
+        self.compacted = 0
+        # key -> the revisions of the key and its KeyValues (None when
+        # deleted) at them, oldest first
+        self._history = {}
+        # All the keys in the history, sorted
+        self._keys = []
+        # The Event of every change and its revision, oldest first
+        self._log = []
+        self._log_revisions = []
+        self._watchers = []
+        self._lock = threading.RLock()
+
+    def client(self, timeout=None):
+        """Create an etcd3 client backed by this etcd"""
+        return FakeEtcdClient(self, timeout)
+
+    def _header(self):
+        return etcdrpc.ResponseHeader(cluster_id=1,
+                                      member_id=1,
+                                      revision=self.revision,
+                                      raft_term=1)
+
+    def _get(self, key, revision):
+        """Get the KeyValue of a key at a revision (None if missing)"""
+        history = self._history.get(key)
+        if history is None:
+            return None
+        revisions, kvs = history
+        i = bisect.bisect_right(revisions, revision)
+        return kvs[i - 1] if i else None
+
+    def _range_keys(self, key, range_end):
+        if not range_end:
+            return [key] if key in self._history else []
+        start = bisect.bisect_left(self._keys, key)
+        if range_end == b'\0':
+            return self._keys[start:]
+        return self._keys[start:bisect.bisect_left(self._keys, range_end)]
+
+    def _range(self, request, latest):
+        """Read a range at the requested revision or else at the latest
+        one (the revision being written in a transaction)"""
+        revision = request.revision or latest
+        if revision < self.compacted:
+            raise RevisionCompactedError(self.compacted)
+        if revision > latest:
+            raise Exception('Future revision: %d' % revision)
+        kvs = [kv for kv in (self._get(k, revision)
+                             for k in self._range_keys(request.key,
+                                                       request.range_end))
+               if kv is not None]
+        if request.sort_order != etcdrpc.RangeRequest.NONE or \
+                request.sort_target != etcdrpc.RangeRequest.KEY:
+            attr = _sort_targets[request.sort_target]
+            kvs.sort(key=lambda kv: getattr(kv, attr),
+                     reverse=request.sort_order ==
+                     etcdrpc.RangeRequest.DESCEND)
+        response = etcdrpc.RangeResponse(header=self._header(),
+                                         count=len(kvs))
+        if request.limit and len(kvs) > request.limit:
+            kvs = kvs[:request.limit]
+            response.more = True
+        if not request.count_only:
+            for kv in kvs:
+                if request.keys_only:
+                    kv = kv_pb2.KeyValue(key=kv.key,
+                                         create_revision=kv.create_revision,
+                                         mod_revision=kv.mod_revision,
+                                         version=kv.version)
+                response.kvs.append(kv)
+        return response
+
+    def _put(self, request, revision, events):
+        key = request.key
+        old = self._get(key, revision)
+        if key not in self._history:
+            bisect.insort(self._keys, key)
+            self._history[key] = ([], [])
+        kv = kv_pb2.KeyValue(
+            key=key,
+            value=request.value,
+            create_revision=old.create_revision if old else revision,
+            mod_revision=revision,
+            version=old.version + 1 if old else 1)
+        self._set(key, revision, kv)
+        events.append(kv_pb2.Event(type=kv_pb2.Event.PUT, kv=kv))
+        response = etcdrpc.PutResponse()
+        if request.prev_kv and old is not None:
+            response.prev_kv.CopyFrom(old)
+        return response
+
+    def _delete_range(self, request, revision, events):
+        response = etcdrpc.DeleteRangeResponse()
+        for key in self._range_keys(request.key, request.range_end):
+            old = self._get(key, revision)
+            if old is None:
+                continue
+            self._set(key, revision, None)
+            kv = kv_pb2.KeyValue(key=key, mod_revision=revision)
+            events.append(kv_pb2.Event(type=kv_pb2.Event.DELETE, kv=kv))
+            response.deleted += 1
+            if request.prev_kv:
+                response.prev_kvs.append(old)
+        return response
+
+    def _set(self, key, revision, kv):
+        revisions, kvs = self._history[key]
+        if revisions and revisions[-1] == revision:
+            kvs[-1] = kv
+        else:
+            revisions.append(revision)
+            kvs.append(kv)
+
+    def _compare(self, compare, revision):
+        kv = self._get(compare.key, revision)
+        target = _compare_targets[compare.target]
+        if kv is None and compare.target == etcdrpc.Compare.VALUE:
+            return False
+        actual = getattr(kv, target) if kv is not None else 0
+        return _compare_results[compare.result](actual,
+                                                getattr(compare, target))
+
+    def _txn(self, request, revision, events):
+        succeeded = all(self._compare(c, revision) for c in request.compare)
+        response = etcdrpc.TxnResponse(succeeded=succeeded)
+        for op in request.success if succeeded else request.failure:
+            kind = op.WhichOneof('request')
+            if kind == 'request_range':
+                response.responses.add(response_range=self._range(
+                    op.request_range, revision))
+            elif kind == 'request_put':
+                response.responses.add(response_put=self._put(
+                    op.request_put, revision, events))
+            elif kind == 'request_delete_range':
+                response.responses.add(
+                    response_delete_range=self._delete_range(
+                        op.request_delete_range, revision, events))
+            else:
+                response.responses.add(response_txn=self._txn(
+                    op.request_txn, revision, events))
+        return response
+
+    def _write(self, apply, request):
+        """Apply a write request at the next revision and notify the
+        watchers of its events"""
+        with self._lock:
+            events = []
+            revision = self.revision + 1
+            response = apply(request, revision, events)
+            if events:
+                self.revision = revision
+                self._log.extend(events)
+                self._log_revisions.extend([revision] * len(events))
+                for watcher in self._watchers:
+                    watcher._notify(events)
+            response.header.CopyFrom(self._header())
+            return response
+
+    # The KV service
+
+    def Range(self, request, timeout=None, credentials=None, metadata=None):
+        with self._lock:
+            return self._range(request, self.revision)
+
+    def Put(self, request, timeout=None, credentials=None, metadata=None):
+        return self._write(self._put, request)
+
+    def DeleteRange(self,
+                    request,
+                    timeout=None,
+                    credentials=None,
+                    metadata=None):
+        return self._write(self._delete_range, request)
+
+    def Txn(self, request, timeout=None, credentials=None, metadata=None):
+        return self._write(self._txn, request)
+
+    def Compact(self, request, timeout=None, credentials=None, metadata=None):
+        with self._lock:
+            revision = request.revision
+            if revision <= self.compacted:
+                raise RevisionCompactedError(self.compacted)
+            if revision > self.revision:
+                raise Exception('Future revision: %d' % revision)
+            self.compacted = revision
+            for key in list(self._history):
+                revisions, kvs = self._history[key]
+                i = bisect.bisect_right(revisions, revision)
+                # Keep the version that was current at the revision
+                if i and kvs[i - 1] is not None:
+                    i -= 1
+                del revisions[:i]
+                del kvs[:i]
+                if not revisions:
+                    del self._history[key]
+            self._keys = sorted(self._history)
+            i = bisect.bisect_left(self._log_revisions, revision)
+            del self._log[:i]
+            del self._log_revisions[:i]
+            return etcdrpc.CompactionResponse(header=self._header())
+
+    def break_watches(self, error=None):
+        """Fail all the watches like a broken watch stream does
+
+        Every watch callback gets the error (by default a
+        ConnectionError), and the watches are dropped.
+        """
+        with self._lock:
+            for watcher in self._watchers:
+                watcher._break(error or ConnectionError('Watch broken'))
+
+
+class _Watch(object):
+    def __init__(self, key, range_end, callback):
+        self.key = key
+        self.range_end = range_end
+        self.callback = callback
+
+
+class FakeWatcher(object):
+    """The watcher of a FakeEtcdClient
+
+    Calls the callbacks in order on its own thread.
+    """
+
+    def __init__(self, etcd):
+        self._etcd = etcd
+        self._watches = {}
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def add_callback(self,
+                     key,
+                     callback,
+                     range_end=None,
+                     start_revision=None,
+                     progress_notify=False,
+                     filters=None,
+                     prev_kv=False):
+        etcd = self._etcd
+        key = to_bytes(key)
+        range_end = to_bytes(range_end) if range_end else b''
+        with etcd._lock:
+            if start_revision and start_revision < etcd.compacted:
+                raise RevisionCompactedError(etcd.compacted)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                etcd._watchers.append(self)
+            watch_id = next(self._ids)
+            watch = self._watches[watch_id] = _Watch(key, range_end, callback)
+            if start_revision:
+                i = bisect.bisect_left(etcd._log_revisions, start_revision)
+                for event in etcd._log[i:]:
+                    if _in_range(event.kv.key, key, range_end):
+                        self._queue.put((watch_id, watch, event))
+            return watch_id
+
+    def cancel(self, watch_id):
+        with self._etcd._lock:
+            self._watches.pop(watch_id, None)
+
+    def close(self):
+        with self._etcd._lock:
+            self._watches = {}
+            if self in self._etcd._watchers:
+                self._etcd._watchers.remove(self)
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread = None
+
+    def _notify(self, events):
+        """Queue the events of a revision (called with the etcd lock)"""
+        for event in events:
+            for watch_id, watch in self._watches.items():
+                if _in_range(event.kv.key, watch.key, watch.range_end):
+                    self._queue.put((watch_id, watch, event))
+
+    def _break(self, error):
+        for watch_id, watch in self._watches.items():
+            self._queue.put((watch_id, watch, error))
+        self._watches = {}
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            watch_id, watch, event = item
+            if isinstance(event, Exception):
+                pass
+            elif self._watches.get(watch_id) is not watch:
+                # Cancelled
+                continue
+            else:
+                event = new_event(event)
+            try:
+                watch.callback(event)
+            except Exception:
+                logger.exception('Watch callback failed')
+
+
+class FakeEtcdClient(etcd3.Etcd3Client):
+    """An etcd3 client that talks to a FakeEtcd instead of a server"""
+
+    def __init__(self, etcd, timeout=None):
+        self.etcd = etcd
+        self._url = 'fake'
+        self.metadata = None
+        self.uses_secure_channel = False
+        self.timeout = timeout
+        self.call_credentials = None
+        self.kvstub = etcd
+        self.watcher = FakeWatcher(etcd)
+        self.transactions = Transactions()
+
+    def close(self):
+        self.watcher.close()
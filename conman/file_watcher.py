@@ -0,0 +1,167 @@
+"""Watch files for changes
+
+Uses inotify on Linux and falls back to polling modification times
+elsewhere. Bursts of changes are debounced: the callback fires once the
+watched files have been quiet for the debounce period, with the set of
+all the files that changed.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Watch the directories, so files replaced by rename are still seen
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+_event_header = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not hasattr(select, 'select'):
+        return None
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def inotify_available():
+    return _load_libc() is not None
+
+
+class FileWatcher(object):
+    def __init__(self,
+                 filenames,
+                 callback,
+                 debounce=0.1,
+                 poll_interval=1.0,
+                 use_inotify=None):
+        """Start watching files in a background thread
+
+        :param iterable filenames: the files to watch
+        :param callable callback: called with the set of changed filenames
+        :param float debounce: seconds without changes before the callback
+            fires
+        :param float poll_interval: seconds between checks when polling
+        :param bool use_inotify: None means use inotify if available
+        """
+        self.filenames = {os.path.abspath(f): f for f in filenames}
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._libc = _load_libc() if use_inotify is not False else None
+        if use_inotify and self._libc is None:
+            raise Exception('inotify is not available')
+        self._fd = None
+        self._wds = {}
+        if self._libc is not None:
+            self._init_inotify()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _init_inotify(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._fd = fd
+        dirs = {os.path.dirname(f) for f in self.filenames}
+        for d in dirs:
+            wd = self._libc.inotify_add_watch(fd, d.encode(), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+            self._wds[wd] = d
+
+    def _read_inotify(self):
+        """Return the watched files that inotify reported changes for"""
+        changed = set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            path = os.path.join(self._wds.get(wd, ''), name)
+            if path in self.filenames:
+                changed.add(self.filenames[path])
+        return changed
+
+    def _stat(self):
+        stats = {}
+        for path, filename in self.filenames.items():
+            try:
+                st = os.stat(path)
+                stats[filename] = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError:
+                stats[filename] = None
+        return stats
+
+    def _run(self):
+        pending = set()
+        last_change = 0
+        stats = None if self.uses_inotify else self._stat()
+        while not self._stop.is_set():
+            if pending:
+                timeout = max(0, last_change + self.debounce - time.time())
+            else:
+                timeout = self.poll_interval
+            if self.uses_inotify:
+                # Wake up regularly to notice stop()
+                ready, _, _ = select.select([self._fd], [], [],
+                                            min(timeout, 0.2))
+                changed = self._read_inotify() if ready else set()
+            else:
+                self._stop.wait(timeout)
+                new_stats = self._stat()
+                changed = {f for f, s in new_stats.items()
+                           if s != stats.get(f)}
+                stats = new_stats
+            if changed:
+                pending |= changed
+                last_change = time.time()
+            elif pending and time.time() - last_change >= self.debounce:
+                try:
+                    self.callback(pending)
+                except Exception:
+                    try:
+                        logger.exception('File watch callback failed')
+                    except Exception:
+                        # e.g. stderr was closed. Keep watching anyway.
+                        pass
+                pending = set()
@@ -0,0 +1,250 @@
+"""Instrumentation of loads, retries, parsing, watch events, event dispatch
+and the tree
+
+ConManEtcd, ConManFile and ConManBase report what they do to the
+Instrumentation object passed as their instrumentation argument. The
+default one ignores everything, so the cost is an empty method call per
+load, parse, watch event or published snapshot.
+
+Recorder keeps totals in memory and exports them as a dict (to_dict()) or
+in the Prometheus text format (to_prometheus()):
+
+    recorder = Recorder()
+    conman = ConManEtcd(instrumentation=recorder)
+    conman.add_key('config')
+    print(recorder.to_prometheus())
+"""
+import threading
+from collections import defaultdict
+
+from conman.compact import CompactNode
+
+
+class Instrumentation(object):
+    """Receives the measurements of a ConMan and ignores them
+
+    Subclass it and override the methods you need. The methods may be
+    called from any thread (e.g. the etcd watcher thread), so they should
+    be quick and thread safe.
+    """
+
+    def loaded(self, source, names, seconds, keys, size):
+        """Keys or files were loaded and published
+
+        :param str source: 'etcd' or 'file'
+        :param list names: the etcd keys or file names loaded together
+        :param float seconds: the duration of the load, retries included
+        :param int keys: the number of etcd keys fetched, or the number of
+            top-level keys of the files
+        :param int size: the number of bytes fetched (etcd keys and values)
+            or read (files)
+        """
+
+    def retried(self, operation, retries):
+        """An operation succeeded or gave up after retrying
+
+        :param str operation: 'load', 'watch', 'fetch_subtree' or 'write'
+        :param int retries: the number of retries (attempts after the
+            first one)
+        """
+
+    def parsed(self, file_type, seconds, size):
+        """A config file was parsed
+
+        :param str file_type: the format the file was parsed as
+        :param float seconds: the duration, including any failed attempts
+            to parse it as another format
+        :param int size: the size of the file in bytes
+        """
+
+    def watch_event(self, key, revision, lag, seconds):
+        """A watch event of a key was applied to the tree
+
+        :param str key: the managed etcd key
+        :param int revision: the revision of the event
+        :param int lag: the number of revisions between the revision the
+            key was synced to and the event. Large after a watch resumed
+            from an old revision.
+        :param float seconds: the time it took to apply the event
+        """
+
+    def published(self, snapshot):
+        """A new snapshot of the tree was published
+
+        :param Snapshot snapshot: the new snapshot (see ConManBase)
+        """
+
+    def dispatched(self, events, queue_depth, lag):
+        """An EventDispatcher delivered a batch of events
+
+        :param int events: the number of events in the batch
+        :param int queue_depth: the number of events still queued
+        :param float lag: how long the oldest event of the batch waited
+        """
+
+
+class Recorder(Instrumentation):
+    """Keeps the totals of all the measurements
+
+    The size of the tree is computed when it's exported, so publishing
+    costs nothing extra.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loads = defaultdict(lambda: dict(count=0,
+                                               seconds=0.0,
+                                               keys=0,
+                                               bytes=0))
+        self._retries = defaultdict(int)
+        self._parses = defaultdict(lambda: dict(count=0,
+                                                seconds=0.0,
+                                                bytes=0))
+        self._watch = dict(events=0,
+                           seconds=0.0,
+                           lag=0,
+                           max_lag=0,
+                           revision=0)
+        self._dispatch = dict(batches=0,
+                              events=0,
+                              queue_depth=0,
+                              lag=0.0,
+                              max_lag=0.0)
+        self._snapshot = None
+
+    def loaded(self, source, names, seconds, keys, size):
+        with self._lock:
+            stats = self._loads[source]
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['keys'] += keys
+            stats['bytes'] += size
+
+    def retried(self, operation, retries):
+        with self._lock:
+            self._retries[operation] += retries
+
+    def parsed(self, file_type, seconds, size):
+        with self._lock:
+            stats = self._parses[file_type]
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += size
+
+    def watch_event(self, key, revision, lag, seconds):
+        with self._lock:
+            stats = self._watch
+            stats['events'] += 1
+            stats['seconds'] += seconds
+            stats['lag'] = lag
+            stats['max_lag'] = max(stats['max_lag'], lag)
+            stats['revision'] = max(stats['revision'], revision)
+
+    def published(self, snapshot):
+        self._snapshot = snapshot
+
+    def dispatched(self, events, queue_depth, lag):
+        with self._lock:
+            stats = self._dispatch
+            stats['batches'] += 1
+            stats['events'] += events
+            stats['queue_depth'] = queue_depth
+            stats['lag'] = lag
+            stats['max_lag'] = max(stats['max_lag'], lag)
+
+    def to_dict(self):
+        """Export the totals as a dict of plain values"""
+        with self._lock:
+            result = dict(loads={k: dict(v) for k, v in self._loads.items()},
+                          retries=dict(self._retries),
+                          parses={k: dict(v) for k, v in self._parses.items()},
+                          watch=dict(self._watch),
+                          dispatch=dict(self._dispatch))
+        snapshot = self._snapshot
+        if snapshot is None:
+            result['tree'] = dict(version=0, leaves=0)
+        else:
+            result['tree'] = dict(version=snapshot.version,
+                                  leaves=count_leaves(snapshot.tree))
+        return result
+
+    def to_prometheus(self, prefix='conman'):
+        """Export the totals in the Prometheus text exposition format"""
+        d = self.to_dict()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            name = prefix + '_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    labels = '{%s}' % ','.join(
+                        '%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+                lines.append('%s%s %r' % (name, labels or '', value))
+
+        loads = sorted(d['loads'].items())
+        for field, name, help in [
+                ('count', 'loads_total', 'Loads of keys or files'),
+                ('seconds', 'load_seconds_total', 'Time spent loading'),
+                ('keys', 'load_keys_total', 'Keys fetched or read'),
+                ('bytes', 'load_bytes_total', 'Bytes fetched or read')]:
+            metric(name, 'counter', help,
+                   [(dict(source=s), v[field]) for s, v in loads])
+        metric('retries_total', 'counter', 'Retries of failed operations',
+               [(dict(operation=k), v)
+                for k, v in sorted(d['retries'].items())])
+        parses = sorted(d['parses'].items())
+        for field, name, help in [
+                ('count', 'parses_total', 'Config files parsed'),
+                ('seconds', 'parse_seconds_total', 'Time spent parsing'),
+                ('bytes', 'parse_bytes_total', 'Bytes parsed')]:
+            metric(name, 'counter', help,
+                   [(dict(format=f), v[field]) for f, v in parses])
+        watch = d['watch']
+        metric('watch_events_total', 'counter', 'Watch events applied',
+               [(None, watch['events'])])
+        metric('watch_apply_seconds_total', 'counter',
+               'Time spent applying watch events', [(None, watch['seconds'])])
+        metric('watch_lag_revisions', 'gauge',
+               'Revisions between the last event and the synced revision',
+               [(None, watch['lag'])])
+        metric('watch_max_lag_revisions', 'gauge',
+               'The maximal watch lag in revisions',
+               [(None, watch['max_lag'])])
+        metric('watch_revision', 'gauge', 'The latest applied revision',
+               [(None, watch['revision'])])
+        dispatch = d['dispatch']
+        metric('dispatch_batches_total', 'counter', 'Event batches delivered',
+               [(None, dispatch['batches'])])
+        metric('dispatch_events_total', 'counter', 'Events delivered',
+               [(None, dispatch['events'])])
+        metric('dispatch_queue_depth', 'gauge', 'Events waiting for delivery',
+               [(None, dispatch['queue_depth'])])
+        metric('dispatch_lag_seconds', 'gauge',
+               'How long the oldest event of the last batch waited',
+               [(None, dispatch['lag'])])
+        metric('dispatch_max_lag_seconds', 'gauge',
+               'The maximal dispatch lag', [(None, dispatch['max_lag'])])
+        metric('snapshot_version', 'gauge', 'The version of the tree',
+               [(None, d['tree']['version'])])
+        metric('tree_leaves', 'gauge', 'The number of values in the tree',
+               [(None, d['tree']['leaves'])])
+        return '\n'.join(lines) + '\n'
+
+
+def count_leaves(tree):
+    """Count the values of a tree
+
+    Lazy values and lazily loaded mappings count as a single value, so
+    counting never loads anything.
+    """
+    count = 0
+    stack = [tree]
+    while stack:
+        for v in stack.pop().values():
+            if isinstance(v, (dict, CompactNode)):
+                stack.append(v)
+            else:
+                count += 1
+    return count
@@ -0,0 +1,250 @@
+"""Deep merge of ordered configuration layers
+
+ConManFile merges its files shallowly by default: a later file replaces
+whole top-level subtrees of earlier ones. A LayeredConfig merges its
+layers (e.g. defaults, then site config, then local overrides) deeply:
+dicts are merged key by key and any other value, including a list,
+replaces what the earlier layers had at its path.
+
+The merged tree is kept up to date along with a flat view of it (leaf
+path -> value) and the provenance of every leaf (the name of the layer
+it comes from). When a layer changes only the paths where its old and
+new trees differ are recomputed, by merging what all the layers have at
+those paths. Unchanged subtrees are shared with the layers and with the
+previous merged tree, which is never modified, so it can be published
+as is.
+
+ConManFile(deep_merge=True) merges its files with a LayeredConfig, and
+LayeredConMan layers whole ConMan objects, e.g. a ConManEtcd on top of a
+ConManFile with the defaults.
+"""
+import functools
+from collections import OrderedDict
+
+from conman.conman_base import ConManBase, Lazy, _copy, _missing, _node_types
+
+# The value of a path under a non-dict value of a layer
+_hidden = object()
+
+
+def _resolve(value):
+    return value.resolve() if type(value) is Lazy else value
+
+
+def _at(tree, path):
+    """Get the value of a layer at a path (a tuple of keys)
+
+    :returns: the value, _missing if the path doesn't exist or _hidden if
+        the layer has a non-dict value at one of its prefixes
+    """
+    t = tree
+    for c in path:
+        if not isinstance(t, _node_types):
+            return _hidden
+        t = _resolve(t.get(c, _missing))
+        if t is _missing:
+            return t
+    return t
+
+
+def _merge(a, b):
+    """Merge b into a recursively, without modifying either"""
+    if a is _missing or not isinstance(a, _node_types) or \
+            not isinstance(b, _node_types):
+        return b
+    merged = _copy(a)
+    for k, v in b.items():
+        merged[k] = _merge(_resolve(merged.get(k, _missing)), _resolve(v))
+    return merged
+
+
+def _replace_at(tree, path, value):
+    """Return a copy of tree with the value at path replaced (or removed
+    if value is _missing), copying only the dicts along the path"""
+    if not path:
+        return {} if value is _missing else value
+    root = t = _copy(tree)
+    for c in path[:-1]:
+        child = _resolve(t.get(c))
+        child = _copy(child) if isinstance(child, _node_types) else {}
+        t[c] = child
+        t = child
+    if value is _missing:
+        t.pop(path[-1], None)
+    else:
+        t[path[-1]] = value
+    return root
+
+
+def _join(prefix, key):
+    return prefix + '/' + str(key) if prefix else str(key)
+
+
+def _leaves(value, prefix):
+    """Iterate over the (path, value) pairs of the leaves of a value"""
+    if value is _missing or value is _hidden:
+        return
+    if not isinstance(value, _node_types):
+        yield prefix, value
+        return
+    stack = [(prefix, value)]
+    while stack:
+        prefix, node = stack.pop()
+        for k, v in node.items():
+            v = _resolve(v)
+            if isinstance(v, _node_types):
+                stack.append((_join(prefix, k), v))
+            else:
+                yield _join(prefix, k), v
+
+
+def changed_paths(old, new):
+    """Find where two trees differ
+
+    Subtrees that are the same object are skipped without looking inside.
+
+    :returns: the topmost differing paths as tuples of keys. None of them
+        is a prefix of another.
+    """
+    paths = []
+    stack = [((), old, new)]
+    while stack:
+        path, o, n = stack.pop()
+        for k in set(o) | set(n):
+            ov = o.get(k, _missing)
+            nv = n.get(k, _missing)
+            if ov is nv:
+                continue
+            ov = _resolve(ov)
+            nv = _resolve(nv)
+            if isinstance(ov, _node_types) and isinstance(nv, _node_types):
+                stack.append((path + (k,), ov, nv))
+            elif ov is _missing or nv is _missing or \
+                    isinstance(ov, _node_types) or \
+                    isinstance(nv, _node_types) or ov != nv:
+                paths.append(path + (k,))
+    return paths
+
+
+class LayeredConfig(object):
+    def __init__(self):
+        # Layer name -> tree, lowest priority first
+        self._layers = OrderedDict()
+        # The merged tree
+        self.tree = {}
+        # Leaf path ('/' separated) -> value and the name of its layer
+        self.resolved = {}
+        self._provenance = {}
+        self.stats = dict(recomputed=0)
+
+    @property
+    def layers(self):
+        """The names of the layers, lowest priority first"""
+        return list(self._layers)
+
+    def set_layer(self, name, tree):
+        """Add a layer on top of the others or replace an existing layer
+
+        A replaced layer keeps its place.
+
+        :param str name: the name of the layer
+        :param dict tree: the content of the layer. It must not be modified
+            afterwards, replace the layer instead.
+        :returns: the recomputed paths (tuples of keys)
+        """
+        old = self._layers.get(name, {})
+        self._layers[name] = tree
+        paths = changed_paths(old, tree)
+        self._recompute(paths)
+        return paths
+
+    def remove_layer(self, name):
+        """Remove a layer
+
+        :returns: the recomputed paths (tuples of keys)
+        """
+        paths = changed_paths(self._layers.pop(name), {})
+        self._recompute(paths)
+        return paths
+
+    def get(self, path, default=None):
+        """Get a leaf value by its '/' separated path"""
+        return self.resolved.get(path, default)
+
+    def provenance(self, path):
+        """Get the name of the layer a leaf value comes from
+
+        :param str path: the '/' separated path of the leaf
+        :returns: the layer name or None if there's no such leaf
+        """
+        return self._provenance.get(path)
+
+    def _recompute(self, paths):
+        """Merge the values of all the layers at the changed paths"""
+        tree = self.tree
+        resolved = self.resolved
+        provenance = self._provenance
+        for path in paths:
+            prefix = '/'.join(str(c) for c in path)
+            merged = _missing
+            sources = {}
+            for name, layer in self._layers.items():
+                value = _at(layer, path)
+                if value is _hidden:
+                    # A non-dict value at a prefix replaced everything
+                    # the earlier layers had here
+                    merged = _missing
+                elif value is not _missing:
+                    merged = _merge(merged, value)
+                    for p, _ in _leaves(value, prefix):
+                        sources[p] = name
+            for p, _ in _leaves(_at(tree, path), prefix):
+                del resolved[p]
+                del provenance[p]
+            for p, value in _leaves(merged, prefix):
+                resolved[p] = value
+                provenance[p] = sources[p]
+            if _at(tree, path) is not _hidden:
+                tree = _replace_at(tree, path, merged)
+            self.stats['recomputed'] += 1
+        self.tree = tree
+
+
+class LayeredConMan(ConManBase):
+    """Merges the configurations of several ConMan objects deeply
+
+    Every source is a layer, and a new snapshot of a source recomputes
+    only the paths that changed in it.
+    """
+
+    def __init__(self, sources, compact=False, instrumentation=None):
+        """
+        :param list sources: (name, conman) pairs, lowest priority first
+        :param bool compact: see ConManBase
+        :param Instrumentation instrumentation: see ConManBase
+        """
+        ConManBase.__init__(self, compact, instrumentation)
+        self.layers = LayeredConfig()
+        self._sources = []
+        with self._write_lock:
+            for name, conman in sources:
+                listener = functools.partial(self._on_snapshot, name)
+                conman.add_listener(listener)
+                self._sources.append((conman, listener))
+                self.layers.set_layer(name, conman.snapshot().tree)
+            self._publish(self.layers.tree)
+
+    def _on_snapshot(self, name, snapshot):
+        with self._write_lock:
+            if self.layers.set_layer(name, snapshot.tree):
+                self._publish(self.layers.tree)
+
+    def provenance(self, path):
+        """Get the name of the source a leaf value comes from"""
+        return self.layers.provenance(path)
+
+    def close(self):
+        """Stop following the sources"""
+        for conman, listener in self._sources:
+            conman.remove_listener(listener)
+        self._sources = []
@@ -0,0 +1,204 @@
+"""Retry policies for etcd operations
+
+A RetryPolicy retries only errors that are worth retrying (see
+is_retryable()), sleeps with exponential backoff and decorrelated jitter
+between attempts, so many clients that fail together don't retry in
+lockstep, and gives up after a maximum number of attempts or an overall
+deadline, whichever comes first.
+"""
+import asyncio
+import functools
+import random
+import threading
+import time
+
+import grpc
+from etcd3 import exceptions
+
+RETRYABLE_STATUS_CODES = frozenset([
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.ABORTED,
+])
+
+RETRYABLE_EXCEPTIONS = (
+    exceptions.ConnectionFailedError,
+    exceptions.ConnectionTimeoutError,
+    exceptions.InternalServerError,
+    exceptions.WatchTimedOut,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_retryable(error):
+    """Decide if a failed operation is worth retrying
+
+    Connectivity problems, timeouts and overloaded or leader-less servers
+    are transient. Anything else (missing keys, bad requests, compacted
+    revisions, auth failures, bugs) fails the same way again. So does a
+    message over the gRPC size limit, although it's RESOURCE_EXHAUSTED
+    too.
+    """
+    if isinstance(error, grpc.RpcError) and hasattr(error, 'code'):
+        code = error.code()
+        if code == grpc.StatusCode.RESOURCE_EXHAUSTED and \
+                _is_message_too_large(error):
+            return False
+        return code in RETRYABLE_STATUS_CODES
+    return isinstance(error, RETRYABLE_EXCEPTIONS)
+
+
+def _is_message_too_large(error):
+    """Check if an RPC failed because a message exceeded the size limit
+
+    e.g. 'Received message larger than max (5345594 vs. 4194304)'
+    """
+    details = error.details() if hasattr(error, 'details') else None
+    return 'message larger than max' in (details or '').lower()
+
+
+def _always(error):
+    return True
+
+
+class RetryPolicy(object):
+    def __init__(self,
+                 max_attempts=3,
+                 base_delay=0.1,
+                 max_delay=5.0,
+                 deadline=None,
+                 retryable=is_retryable,
+                 on_attempt=None):
+        """Configure the retry policy
+
+        :param int max_attempts: give up after that many attempts
+            (None means no limit)
+        :param float base_delay: the minimal delay between attempts
+        :param float max_delay: the maximal delay between attempts
+        :param float deadline: give up if the next attempt would start more
+            than that many seconds after the first one (None means never)
+        :param callable retryable: decides if an exception is retried
+        :param callable on_attempt: called after every attempt with the
+            attempt number (starting at 1), its duration in seconds and
+            the exception it raised (None if it succeeded)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable = retryable
+        self.on_attempt = on_attempt
+        self._lock = threading.Lock()
+        self.stats = dict(calls=0,
+                          attempts=0,
+                          retries=0,
+                          failures=0,
+                          attempt_seconds=0.0)
+
+    def backoff(self):
+        """Generate the delays between attempts
+
+        Uses decorrelated jitter: every delay is random between base_delay
+        and three times the previous delay, capped at max_delay.
+        """
+        delay = self.base_delay
+        while True:
+            delay = min(self.max_delay,
+                        random.uniform(self.base_delay, delay * 3))
+            yield delay
+
+    def _record(self, attempt, duration, error):
+        with self._lock:
+            stats = self.stats
+            stats['attempts'] += 1
+            stats['attempt_seconds'] += duration
+            if attempt == 1:
+                stats['calls'] += 1
+            else:
+                stats['retries'] += 1
+        if self.on_attempt is not None:
+            self.on_attempt(attempt, duration, error)
+
+    def _next_delay(self, attempt, start, delays, error):
+        """Return the delay before the next attempt or raise the error"""
+        if not self.retryable(error):
+            raise error
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            raise error
+        delay = next(delays)
+        if self.deadline is not None:
+            if time.monotonic() + delay - start > self.deadline:
+                raise error
+        return delay
+
+    def call(self, f, *args, **kwargs):
+        """Call f with args and kwargs, retrying per the policy"""
+        start = time.monotonic()
+        delays = self.backoff()
+        attempt = 0
+        while True:
+            attempt += 1
+            attempt_start = time.monotonic()
+            try:
+                result = f(*args, **kwargs)
+            except Exception as e:
+                self._record(attempt, time.monotonic() - attempt_start, e)
+                try:
+                    delay = self._next_delay(attempt, start, delays, e)
+                except Exception:
+                    with self._lock:
+                        self.stats['failures'] += 1
+                    raise
+                time.sleep(delay)
+            else:
+                self._record(attempt, time.monotonic() - attempt_start, None)
+                return result
+
+    async def call_async(self, f, *args, **kwargs):
+        """Await f(*args, **kwargs), retrying per the policy
+
+        Like call(), but sleeps without blocking the event loop.
+        """
+        start = time.monotonic()
+        delays = self.backoff()
+        attempt = 0
+        while True:
+            attempt += 1
+            attempt_start = time.monotonic()
+            try:
+                result = await f(*args, **kwargs)
+            except Exception as e:
+                self._record(attempt, time.monotonic() - attempt_start, e)
+                try:
+                    delay = self._next_delay(attempt, start, delays, e)
+                except Exception:
+                    with self._lock:
+                        self.stats['failures'] += 1
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                self._record(attempt, time.monotonic() - attempt_start, None)
+                return result
+
+    def __call__(self, f):
+        """Use the policy as a decorator"""
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            return self.call(f, *args, **kwargs)
+
+        return wrapped
+
+
+def thrice(delay=0.5):
+    """This decorator tries failed operations 3 times before it gives up
+
+    The delay determines how long to wait between tries (in seconds).
+    Every exception is retried. Prefer a RetryPolicy, which only retries
+    transient errors and spreads retries out.
+    """
+    return RetryPolicy(max_attempts=3,
+                       base_delay=delay,
+                       max_delay=delay,
+                       retryable=_always)
@@ -0,0 +1,395 @@
+"""Share the configuration with other processes through a snapshot file
+
+One agent process (e.g. the master of a prefork server) keeps the
+configuration in sync, and a SnapshotPublisher writes every new snapshot
+to a file. Worker processes read it with ConManShared, which memory-maps
+the file instead of loading it: lookups binary-search the mapped file, so
+all the workers share one copy of the data in the page cache (put the file
+on a tmpfs such as /dev/shm to keep it off the disk).
+
+A snapshot file is never modified. A new one is written next to it and
+renamed over it, so readers that still map the old file keep a consistent
+snapshot, and checking for a newer snapshot is a single stat() call.
+
+File layout (little-endian):
+
+    header: magic, version, entry count, metadata length
+    metadata: JSON (e.g. the etcd revisions of the keys)
+    entry table: path offset, path length, value length, value type
+    data: the path and value bytes of every entry
+
+There is an entry for every leaf of the tree, sorted by the UTF-8 bytes of
+its '/' separated path. String values are stored as is, and other values
+(numbers, lists, ...) as JSON. Empty dicts have no leaves, so they aren't
+stored.
+"""
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+
+from conman.conman_base import (ConManBase,
+                                Lazy,
+                                _missing,
+                                _node_types,
+                                _remove_path)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CONMAN\x00\x01'
+_header = struct.Struct('<8sQQI')
+_entry = struct.Struct('<QIIB3x')
+_STR = 0
+_JSON = 1
+
+
+def _flatten(tree):
+    """Get the (path bytes, value) pairs of all the leaves of a tree"""
+    leaves = []
+    stack = [('', tree)]
+    while stack:
+        prefix, node = stack.pop()
+        for k, v in node.items():
+            path = prefix + str(k)
+            if type(v) is Lazy:
+                v = v.resolve()
+            if isinstance(v, (_node_types, Mapping)):
+                stack.append((path + '/', v))
+            else:
+                leaves.append((path.encode(), v))
+    leaves.sort(key=lambda leaf: leaf[0])
+    return leaves
+
+
+def write_snapshot(filename, tree, version=0, metadata=None):
+    """Write a tree to a snapshot file atomically
+
+    :param str filename: the snapshot file
+    :param dict tree: the configuration tree
+    :param int version: the version of the snapshot
+    :param dict metadata: JSON serializable data to store with it
+    """
+    leaves = _flatten(tree)
+    meta = json.dumps(metadata or {}).encode()
+    table = bytearray()
+    data = bytearray()
+    data_start = _header.size + len(meta) + _entry.size * len(leaves)
+    for path, value in leaves:
+        if type(value) is str:
+            value, value_type = value.encode(), _STR
+        else:
+            value, value_type = json.dumps(value).encode(), _JSON
+        table += _entry.pack(data_start + len(data),
+                             len(path),
+                             len(value),
+                             value_type)
+        data += path
+        data += value
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.conman-snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_header.pack(MAGIC, version, len(leaves), len(meta)))
+            f.write(meta)
+            f.write(table)
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class SnapshotFile(Mapping):
+    """A read-only view of a memory-mapped snapshot file
+
+    The view is the root of the tree. Sub-trees are SnapshotViews, leaves
+    are decoded on access.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, meta_len = _header.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise Exception('Bad snapshot file: ' + filename)
+        self.version = version
+        self.count = count
+        start = _header.size
+        self.metadata = json.loads(self._mm[start:start + meta_len])
+        self._table = start + meta_len
+        self._paths = _Paths(self)
+        self._root = SnapshotView(self, b'')
+
+    def _entry(self, i):
+        return _entry.unpack_from(self._mm, self._table + i * _entry.size)
+
+    def _path(self, i):
+        offset, path_len, _, _ = self._entry(i)
+        return self._mm[offset:offset + path_len]
+
+    def _value(self, i):
+        offset, path_len, value_len, value_type = self._entry(i)
+        start = offset + path_len
+        value = self._mm[start:start + value_len]
+        return value.decode() if value_type == _STR else json.loads(value)
+
+    def _find(self, path):
+        """Find the entry of a leaf path, or None"""
+        i = bisect.bisect_left(self._paths, path)
+        if i < self.count and self._path(i) == path:
+            return i
+        return None
+
+    def _has_prefix(self, prefix):
+        i = bisect.bisect_left(self._paths, prefix)
+        return i < self.count and self._path(i).startswith(prefix)
+
+    def lookup(self, path):
+        """Get the leaf value or SnapshotView of a '/' separated path
+
+        :returns: _missing if the path doesn't exist
+        """
+        path = path.encode()
+        i = self._find(path)
+        if i is not None:
+            return self._value(i)
+        if path and self._has_prefix(path + b'/'):
+            return SnapshotView(self, path)
+        return _missing
+
+    def to_dict(self, prefix=''):
+        """Build a nested dict of the leaves whose path starts with prefix
+
+        Like an etcd prefix query, the prefix doesn't have to end at a
+        path separator. The dict is rooted at the top of the tree.
+        """
+        prefix = prefix.encode()
+        tree = {}
+        i = bisect.bisect_left(self._paths, prefix)
+        while i < self.count:
+            path = self._path(i)
+            if not path.startswith(prefix):
+                break
+            *parents, name = path.decode().split('/')
+            t = tree
+            for c in parents:
+                t = t.setdefault(c, {})
+            t[name] = self._value(i)
+            i += 1
+        return tree
+
+    def __getitem__(self, k):
+        return self._root[k]
+
+    def __iter__(self):
+        return iter(self._root)
+
+    def __len__(self):
+        return len(self._root)
+
+    def __repr__(self):
+        return 'SnapshotFile(version=%d, %d leaves)' % (self.version,
+                                                        self.count)
+
+
+class _Paths(object):
+    """The sorted entry paths of a snapshot file as a sequence for bisect"""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self):
+        return self._snapshot.count
+
+    def __getitem__(self, i):
+        return self._snapshot._path(i)
+
+
+class SnapshotView(Mapping):
+    """A read-only mapping of a sub-tree of a snapshot file"""
+
+    def __init__(self, snapshot, path):
+        self._snapshot = snapshot
+        self._prefix = path + b'/' if path else b''
+
+    def __getitem__(self, k):
+        value = self._snapshot.lookup(self._prefix.decode() + str(k))
+        if value is _missing:
+            raise KeyError(k)
+        return value
+
+    def __iter__(self):
+        snapshot = self._snapshot
+        prefix = self._prefix
+        n = len(prefix)
+        i = bisect.bisect_left(snapshot._paths, prefix)
+        while i < snapshot.count:
+            path = snapshot._path(i)
+            if not path.startswith(prefix):
+                return
+            name, sep, _ = path[n:].partition(b'/')
+            yield name.decode()
+            if not sep:
+                i += 1
+                continue
+            # Skip the rest of the sub-tree of this child ('0' follows '/')
+            i = bisect.bisect_left(snapshot._paths, prefix + name + b'0', i)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class SnapshotPublisher(object):
+    def __init__(self, conman, filename, interval=0.1):
+        """Write every new snapshot of a ConMan to a snapshot file
+
+        :param ConManBase conman: the agent's ConMan
+        :param str filename: the snapshot file
+        :param float interval: the minimal time between writes. Snapshots
+            published in the meantime are coalesced into one write.
+
+        The current snapshot is written before the constructor returns.
+        Writes happen in a background thread until close() is called.
+        The keys a ConManEtcd added with lazy=True are left out: writing
+        them would fetch all their subtrees.
+        """
+        self.conman = conman
+        self.filename = filename
+        self.interval = interval
+        self.written_version = None
+        self._pending = threading.Event()
+        self._closed = False
+        self._write()
+        conman.add_listener(self._on_snapshot)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _on_snapshot(self, snapshot):
+        self._pending.set()
+
+    def _write(self):
+        conman = self.conman
+        with conman._write_lock:
+            snapshot = conman.snapshot()
+            lazy_keys = set(getattr(conman, '_lazy_keys', ()))
+            revisions = {k: r
+                         for k, r in getattr(conman, '_revisions', {}).items()
+                         if k not in lazy_keys}
+        if snapshot.version == self.written_version:
+            return
+        tree = snapshot.tree
+        for key in lazy_keys:
+            tree = _remove_path(tree, key)
+        write_snapshot(self.filename,
+                       tree,
+                       snapshot.version,
+                       dict(revisions=revisions))
+        self.written_version = snapshot.version
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            if self._closed:
+                return
+            self._pending.clear()
+            try:
+                self._write()
+            except Exception:
+                logger.exception('Failed to write snapshot %s',
+                                 self.filename)
+            time.sleep(self.interval)
+
+    def close(self):
+        """Stop publishing, after writing the latest snapshot"""
+        self.conman.remove_listener(self._on_snapshot)
+        self._closed = True
+        self._pending.set()
+        self._thread.join()
+        self._write()
+
+
+class ConManShared(ConManBase):
+    def __init__(self, filename, check_interval=1.0):
+        """Read the configuration from a snapshot file
+
+        :param str filename: the snapshot file a SnapshotPublisher writes
+        :param float check_interval: how often (in seconds) to check for a
+            newer snapshot when the configuration is read
+
+        Nothing is loaded: reads look up the memory-mapped file, and a
+        newer snapshot file is mapped when it's noticed. Use snapshot() to
+        read several values from the same snapshot.
+        """
+        ConManBase.__init__(self)
+        self.filename = filename
+        self.check_interval = check_interval
+        self._file = SnapshotFile(filename)
+        self._next_check = time.monotonic() + check_interval
+
+    @property
+    def version(self):
+        return self._file.version
+
+    @property
+    def metadata(self):
+        return self._file.metadata
+
+    @property
+    def _conf(self):
+        return self.snapshot()
+
+    def is_stale(self):
+        """Check if the snapshot file was replaced since it was mapped"""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime_ns, st.st_size) != self._file.stat
+
+    def refresh(self):
+        """Map the latest snapshot file if it's newer
+
+        :returns: True if a newer snapshot was mapped
+        """
+        self._next_check = time.monotonic() + self.check_interval
+        if not self.is_stale():
+            return False
+        with self._write_lock:
+            self._file = SnapshotFile(self.filename)
+        return True
+
+    def snapshot(self):
+        if time.monotonic() >= self._next_check:
+            self.refresh()
+        return self._file
+
+    def __getitem__(self, k):
+        return self.snapshot()[k]
+
+    def get(self, path, default=None):
+        """Get a value or sub-tree by its full path
+
+        See ConManBase.get()
+        """
+        snapshot = self.snapshot()
+        value = snapshot.lookup(path)
+        if value is _missing and '.' in path:
+            value = snapshot.lookup(path.replace('.', '/'))
+        return default if value is _missing else value
+
+    def __repr__(self):
+        return repr(self.snapshot())
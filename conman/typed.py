@@ -0,0 +1,204 @@
+"""Typed access to configuration values, converted once
+
+Values loaded from etcd and INI files are strings, so code that needs a
+number calls int() (or json.loads()) on every read. A TypedView converts
+a value the first time it's read as a type and caches the result along
+with the raw value it was converted from. Later reads return the cached
+result as long as the tree still holds the very same raw object.
+
+Changes never touch the unchanged leaves of the tree (see ConManBase), so
+a change invalidates only the cached results of the values it replaced,
+and checking costs a lookup and an identity comparison.
+
+The paths declared in a schema are converted whenever a new snapshot is
+published, i.e. at load or watch-apply time, so even the first read after
+a change doesn't convert:
+
+    typed = TypedView(conman, schema={'svc/timeout': 'duration',
+                                      'svc/workers': 'int'})
+    typed.get('svc/timeout')        # 30.0 for '30s'
+    typed.get_int('svc/retries', 3)
+
+A value that fails to convert raises ValueError when it's read. Results
+(e.g. of get_json()) are shared by all the readers, so don't modify them.
+"""
+import json
+import logging
+import re
+
+from conman.conman_base import _missing
+
+logger = logging.getLogger(__name__)
+
+_true = frozenset(['1', 'true', 'yes', 'on', 'y', 't'])
+_false = frozenset(['0', 'false', 'no', 'off', 'n', 'f'])
+
+_duration_units = dict(ms=0.001, s=1, m=60, h=3600, d=86400, w=604800)
+_duration_part = re.compile(r'(\d+(?:\.\d*)?|\.\d+)(ms|s|m|h|d|w)')
+
+
+def to_bool(value):
+    """Convert a value to a bool
+
+    Strings such as 'true', 'yes', 'on' and '1' (or their opposites) are
+    accepted in any case. Anything else raises ValueError.
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        if value in (0, 1):
+            return bool(value)
+    elif isinstance(value, str):
+        v = value.strip().lower()
+        if v in _true:
+            return True
+        if v in _false:
+            return False
+    raise ValueError('Not a bool: %r' % (value,))
+
+
+def to_duration(value):
+    """Convert a value to a number of seconds (float)
+
+    Numbers are seconds. Strings are either numbers or a sequence of
+    numbers with units, e.g. '250ms', '30s', '1h30m' or '2d'.
+    """
+    if isinstance(value, bool):
+        raise ValueError('Not a duration: %r' % (value,))
+    if isinstance(value, (int, float)):
+        return float(value)
+    v = str(value).strip()
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    seconds = 0.0
+    pos = 0
+    for m in _duration_part.finditer(v):
+        if m.start() != pos:
+            break
+        seconds += float(m.group(1)) * _duration_units[m.group(2)]
+        pos = m.end()
+    if pos == 0 or pos != len(v):
+        raise ValueError('Not a duration: %r' % (value,))
+    return seconds
+
+
+def to_json(value):
+    """Parse a JSON string. Values that aren't strings (e.g. from YAML
+    files) are returned as is."""
+    if isinstance(value, (str, bytes)):
+        return json.loads(value)
+    return value
+
+
+CONVERTERS = dict(str=str,
+                  int=int,
+                  float=float,
+                  bool=to_bool,
+                  duration=to_duration,
+                  json=to_json)
+
+
+class _Failed(object):
+    """The result of a conversion that failed"""
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+class TypedView(object):
+    def __init__(self, conman, schema=None):
+        """
+        :param ConManBase conman: the configuration to read
+        :param dict schema: path -> type, where the type is a name in
+            CONVERTERS ('str', 'int', 'float', 'bool', 'duration' or
+            'json') or a function that converts a raw value. The values
+            of these paths are converted on every publish.
+        """
+        self._conman = conman
+        self.schema = {}
+        for path, type_ in (schema or {}).items():
+            self.schema[path] = self._converter(type_)
+        # (path, converter) -> (raw value, converted value or _Failed)
+        self._cache = {}
+        if self.schema:
+            conman.add_listener(self._on_snapshot)
+            self._on_snapshot(conman.snapshot())
+
+    @staticmethod
+    def _converter(type_):
+        if callable(type_):
+            return type_
+        try:
+            return CONVERTERS[type_]
+        except KeyError:
+            raise Exception('Unknown type: %s' % type_)
+
+    def close(self):
+        """Stop converting the schema paths on publish"""
+        if self.schema:
+            self._conman.remove_listener(self._on_snapshot)
+
+    def _convert(self, key, raw):
+        try:
+            value = key[1](raw)
+        except Exception as e:
+            value = _Failed(e)
+        self._cache[key] = (raw, value)
+        return value
+
+    def _on_snapshot(self, snapshot):
+        cache = self._cache
+        for path, converter in self.schema.items():
+            key = (path, converter)
+            raw = snapshot.get(path, _missing)
+            cached = cache.get(key)
+            if raw is _missing:
+                cache.pop(key, None)
+            elif cached is None or cached[0] is not raw:
+                value = self._convert(key, raw)
+                if type(value) is _Failed:
+                    logger.warning('Bad value of %s: %r', path, raw)
+
+    def _get(self, path, converter, default):
+        raw = self._conman.get(path, _missing)
+        if raw is _missing:
+            return default
+        key = (path, converter)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] is raw:
+            value = cached[1]
+        else:
+            value = self._convert(key, raw)
+        if type(value) is _Failed:
+            raise ValueError('Bad value of %s: %s' % (path, value.error))
+        return value
+
+    def get(self, path, default=None):
+        """Get the converted value of a path declared in the schema"""
+        return self._get(path, self.schema[path], default)
+
+    def get_as(self, path, type_, default=None):
+        """Get a value converted to a type (see the schema types)"""
+        return self._get(path, self._converter(type_), default)
+
+    def get_str(self, path, default=None):
+        return self._get(path, str, default)
+
+    def get_int(self, path, default=None):
+        return self._get(path, int, default)
+
+    def get_float(self, path, default=None):
+        return self._get(path, float, default)
+
+    def get_bool(self, path, default=None):
+        return self._get(path, to_bool, default)
+
+    def get_duration(self, path, default=None):
+        """Get a duration in seconds (see to_duration())"""
+        return self._get(path, to_duration, default)
+
+    def get_json(self, path, default=None):
+        return self._get(path, to_json, default)
@@ -0,0 +1,400 @@
+"""Multiplex many etcd watches over a few watches
+
+The etcd3 client already sends all its watches over one gRPC stream, but
+every watch is still a separate watch on the server, and when the stream
+breaks each of them is handed the error on its own. A ConManEtcd with 50
+watched keys then re-creates 50 watches, one round trip after the other,
+each with its own retries.
+
+A WatchManager merges the registered keys and prefixes whose ranges
+overlap or touch (e.g. the prefixes 'svc/0' and 'svc/1') into a single
+etcd watch, and routes every event to the registrations whose range
+contains its key. Ranges that are apart get watches of their own, so
+no events of the keys in between are streamed.
+
+A watch is re-created (with a wider range or from an older revision)
+only when a registration needs it. When the stream breaks all the
+watches are resumed together, each from the oldest revision any of its
+registrations still needs. Every registration remembers the revision and
+keys it got last, so the events replayed by a resumed or re-created
+watch are delivered exactly once. A registration that needs a revision
+etcd already compacted gets the RevisionCompactedError and is removed.
+
+Registrations must not be added from the callbacks, which run on the
+etcd3 watcher thread.
+"""
+import functools
+import logging
+import threading
+import time
+
+from etcd3 import etcdrpc
+from etcd3.exceptions import RevisionCompactedError
+from etcd3.utils import to_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class Registration(object):
+    """A watched key range and its callback (see WatchManager.add())"""
+
+    def __init__(self, key, range_end, callback, revision):
+        self.key = key
+        self.range_end = range_end
+        self.callback = callback
+        # The last revision delivered and the keys delivered at it. None
+        # means the revision was delivered in full.
+        self.revision = revision
+        self.keys = None
+
+    def next_revision(self):
+        """The oldest revision this registration may still need"""
+        return self.revision if self.keys else self.revision + 1
+
+    def __contains__(self, key):
+        return self.key <= key < self.range_end
+
+    def __repr__(self):
+        return 'Registration(%r, %r, revision=%d)' % (self.key,
+                                                      self.range_end,
+                                                      self.revision)
+
+
+class _Watch(object):
+    """An etcd watch over a range that covers some registrations"""
+
+    def __init__(self, key, range_end):
+        self.key = key
+        self.range_end = range_end
+        self.watch_id = None
+        # The latest revision the watch delivered
+        self.revision = 0
+        # Cleared when the watch is replaced or stopped, so its leftover
+        # events are ignored
+        self.active = True
+
+    def covers(self, registration):
+        """Check if the watch delivers all the events the registration
+        needs"""
+        return self.key <= registration.key and \
+            registration.range_end <= self.range_end and \
+            registration.next_revision() > self.revision
+
+
+def _merge_ranges(registrations):
+    """Group the registrations whose ranges overlap or touch
+
+    :returns: (key, range_end, registrations) tuples, by key
+    """
+    groups = []
+    for registration in sorted(registrations, key=lambda r: r.key):
+        if groups and registration.key <= groups[-1][1]:
+            key, range_end, members = groups[-1]
+            members.append(registration)
+            groups[-1] = (key, max(range_end, registration.range_end),
+                          members)
+        else:
+            groups.append((registration.key, registration.range_end,
+                           [registration]))
+    return groups
+
+
+class WatchManager(object):
+    def __init__(self, client, retry_policy):
+        """
+        :param callable client: returns the etcd3 client to watch with
+        :param RetryPolicy retry_policy: its backoff is used between
+            attempts to resume the broken watches
+        """
+        self._client = client
+        self.retry_policy = retry_policy
+        self.stats = dict(events=0, dropped=0, watches=0, resumes=0)
+        self._registrations = []
+        # The current etcd watches
+        self._watches = []
+        self._lock = threading.Lock()
+        # Serializes re-creating the watches
+        self._restart_lock = threading.Lock()
+        # Set while a resume is pending
+        self._resuming = False
+        self._closed = False
+
+    def add(self, key, callback, range_end=None, start_revision=None):
+        """Watch a key or key range
+
+        :param key: the key (str or bytes)
+        :param callable callback: called with every event in the range,
+            on the etcd3 watcher thread. Called with a
+            RevisionCompactedError if the registration can't be resumed.
+        :param range_end: the end of the range (exclusive). None watches
+            only the key.
+        :param int start_revision: the first revision to get events of.
+            None means from now on.
+        :returns: the Registration to pass to remove()
+        """
+        return self.add_many([(key, callback, range_end, start_revision)])[0]
+
+    def add_many(self, watches):
+        """Watch several keys or key ranges, re-creating each etcd watch
+        at most once
+
+        :param list watches: (key, callback, range_end, start_revision)
+            tuples, see add()
+        :returns: a list of Registrations
+        """
+        registrations = []
+        for key, callback, range_end, start_revision in watches:
+            key = to_bytes(key)
+            if range_end is None:
+                range_end = key + b'\0'
+            if start_revision is None:
+                start_revision = self._current_revision(key) + 1
+            registrations.append(Registration(key,
+                                              to_bytes(range_end),
+                                              callback,
+                                              start_revision - 1))
+        with self._restart_lock:
+            with self._lock:
+                if self._closed:
+                    raise Exception('The watch manager is closed')
+                self._registrations.extend(registrations)
+                if all(self._covered(r) for r in registrations):
+                    return registrations
+            try:
+                self._restart()
+            except Exception:
+                with self._lock:
+                    for registration in registrations:
+                        self._registrations.remove(registration)
+                    # The other registrations may have lost their watches
+                    self._resume_in_background()
+                raise
+        return registrations
+
+    def remove(self, registration):
+        """Stop watching a registration
+
+        An etcd watch is cancelled with the last registration in its
+        range, but not narrowed when others remain.
+        """
+        with self._lock:
+            if registration not in self._registrations:
+                return
+            self._registrations.remove(registration)
+            unused = [w for w in self._watches
+                      if not any(w.key <= r.key < w.range_end
+                                 for r in self._registrations)]
+            watch_ids = [self._stop(w) for w in unused]
+        for watch_id in watch_ids:
+            self._cancel(watch_id)
+
+    def close(self):
+        """Remove all the registrations and cancel the etcd watches"""
+        with self._lock:
+            self._closed = True
+            self._registrations = []
+            watch_ids = [self._stop(w) for w in list(self._watches)]
+        for watch_id in watch_ids:
+            self._cancel(watch_id)
+
+    def __len__(self):
+        return len(self._registrations)
+
+    def _covered(self, registration):
+        """Check if a current watch delivers all the events a registration
+        needs (called with the lock held)"""
+        return any(w.watch_id is not None and w.covers(registration)
+                   for w in self._watches)
+
+    def _stop(self, watch):
+        """Forget a watch (called with the lock held)
+
+        :returns: its id, to cancel once the lock is released
+        """
+        watch.active = False
+        self._watches.remove(watch)
+        return watch.watch_id
+
+    def _cancel(self, watch_id):
+        if watch_id is None:
+            return
+        try:
+            self._client().cancel_watch(watch_id)
+        except Exception:
+            logger.exception('Failed to cancel watch %s', watch_id)
+
+    def _current_revision(self, key):
+        client = self._client()
+        request = etcdrpc.RangeRequest(key=key, count_only=True)
+        response = client.kvstub.Range(request,
+                                       client.timeout,
+                                       credentials=client.call_credentials,
+                                       metadata=client.metadata)
+        return response.header.revision
+
+    def _restart(self):
+        """Make the etcd watches cover all the registrations
+
+        Every group of registrations with overlapping or touching ranges
+        that no current watch covers gets a new watch from the oldest
+        revision any of them needs, replacing the watches it overlaps.
+        Watches that cover no registration any more are cancelled.
+
+        The caller must hold the restart lock. The watches are created
+        without holding the lock, because their creation is completed by
+        the etcd3 watcher thread, which may be waiting for the lock to
+        deliver an event.
+        """
+        with self._lock:
+            needed = []
+            kept = []
+            for key, range_end, members in _merge_ranges(
+                    self._registrations):
+                watch = None
+                for w in self._watches:
+                    if w.watch_id is not None and \
+                            all(w.covers(r) for r in members):
+                        watch = w
+                        break
+                if watch is None:
+                    needed.append((key, range_end, members))
+                elif watch not in kept:
+                    kept.append(watch)
+            old_watch_ids = [self._stop(w) for w in list(self._watches)
+                             if w not in kept]
+            created = []
+            for key, range_end, members in needed:
+                watch = _Watch(key, range_end)
+                self._watches.append(watch)
+                start_revision = min(r.next_revision() for r in members)
+                created.append((watch, start_revision))
+        for watch_id in old_watch_ids:
+            self._cancel(watch_id)
+        client = self._client()
+        try:
+            for watch, start_revision in created:
+                watch_id = client.add_watch_callback(
+                    watch.key,
+                    functools.partial(self._on_event, watch),
+                    range_end=watch.range_end,
+                    start_revision=start_revision)
+                with self._lock:
+                    if watch.active:
+                        watch.watch_id = watch_id
+                        watch.revision = max(watch.revision,
+                                             start_revision - 1)
+                        self.stats['watches'] += 1
+                        continue
+                # Stopped while it was created
+                self._cancel(watch_id)
+        except Exception:
+            with self._lock:
+                for watch, _ in created:
+                    if watch.active and watch.watch_id is None:
+                        self._stop(watch)
+            raise
+
+    def _on_event(self, watch, event):
+        """Route an event of an etcd watch to the registrations"""
+        with self._lock:
+            if not watch.active:
+                return
+            if isinstance(event, Exception):
+                # The stream is broken, and etcd3 already dropped the
+                # callbacks of all the watches
+                watch_ids = [self._stop(w) for w in list(self._watches)]
+                self._resume_in_background(event)
+                targets = ()
+            else:
+                watch_ids = ()
+                targets = self._route(watch, event)
+        for watch_id in watch_ids:
+            self._cancel(watch_id)
+        for registration in targets:
+            try:
+                registration.callback(event)
+            except Exception:
+                logger.exception('Watch callback failed')
+
+    def _route(self, watch, event):
+        """Find the registrations an event is new to (called with the lock
+        held)"""
+        self.stats['events'] += 1
+        revision = event.mod_revision
+        watch.revision = max(watch.revision, revision)
+        key = event.key
+        targets = []
+        for registration in self._registrations:
+            if key not in registration:
+                continue
+            if revision < registration.revision:
+                continue
+            if revision == registration.revision:
+                if registration.keys is None or key in registration.keys:
+                    continue
+                registration.keys.add(key)
+            else:
+                registration.revision = revision
+                registration.keys = {key}
+            targets.append(registration)
+        if not targets:
+            self.stats['dropped'] += 1
+        return targets
+
+    def _resume_in_background(self, error=None):
+        """Resume the watches on another thread, unless a resume is
+        pending already (called with the lock held)"""
+        if self._resuming:
+            return
+        self._resuming = True
+        # Not on the etcd3 watcher thread, which must be free to
+        # re-establish the watch stream
+        t = threading.Thread(target=self._resume, args=(error,))
+        t.daemon = True
+        t.start()
+
+    def _resume(self, error=None):
+        """Re-create the etcd watches after they broke, until it
+        succeeds"""
+        delays = self.retry_policy.backoff()
+        while True:
+            if isinstance(error, RevisionCompactedError):
+                self._drop_compacted(error)
+            try:
+                with self._restart_lock:
+                    with self._lock:
+                        # Watches that break from now on need another
+                        # resume
+                        self._resuming = False
+                        if self._closed or all(self._covered(r) for r in
+                                               self._registrations):
+                            return
+                        self.stats['resumes'] += 1
+                    self._restart()
+                return
+            except RevisionCompactedError as e:
+                error = e
+            except Exception as e:
+                logger.exception('Failed to resume watch')
+                error = e
+            with self._lock:
+                if self._resuming:
+                    # Another resume took over
+                    return
+                self._resuming = True
+            if not isinstance(error, RevisionCompactedError):
+                time.sleep(next(delays))
+
+    def _drop_compacted(self, error):
+        """Remove the registrations that need a compacted revision and
+        pass them the error"""
+        with self._lock:
+            compacted = [r for r in self._registrations
+                         if r.next_revision() <= error.compacted_revision]
+            for registration in compacted:
+                self._registrations.remove(registration)
+        for registration in compacted:
+            try:
+                registration.callback(error)
+            except Exception:
+                logger.exception('Watch callback failed')
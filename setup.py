@@ -14,7 +14,7 @@ setup(name='conman',
           'License :: OSI Approved :: MIT License',
           'Programming Language :: Python :: 3',
       ],
-      packages=find_packages(exclude=['tests']),
+      packages=find_packages(exclude=['tests', 'benchmarks']),
       long_description=open('README.md').read(),
       zip_safe=False,
       test_suite='unittest')
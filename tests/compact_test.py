@@ -0,0 +1,82 @@
+import copy
+import json
+import pickle
+from collections.abc import Mapping
+from unittest import TestCase
+
+from conman.compact import CompactNode, compact
+
+
+class CompactTest(TestCase):
+    def setUp(self):
+        self.tree = dict(svc=dict(host='db.example.com',
+                                  port='5432',
+                                  limits=dict(cpu='500m')),
+                         other=dict(host='cache.example.com',
+                                    port='6379',
+                                    limits=dict(cpu='250m')),
+                         items=[1, 2],
+                         empty={})
+        self.node = compact(self.tree)
+
+    def test_mapping_interface(self):
+        node = self.node
+        self.assertIsInstance(node, Mapping)
+        self.assertEqual(4, len(node))
+        self.assertEqual(['svc', 'other', 'items', 'empty'], list(node))
+        self.assertEqual(list(self.tree.keys()), list(node.keys()))
+        self.assertEqual('5432', node['svc']['port'])
+        self.assertEqual('500m', node['svc']['limits']['cpu'])
+        self.assertEqual([1, 2], node['items'])
+        self.assertEqual(0, len(node['empty']))
+        self.assertIn('svc', node)
+        self.assertNotIn('nope', node)
+        self.assertNotIn(0, node)
+        self.assertIsNone(node.get('nope'))
+        self.assertEqual('x', node['svc'].get('nope', 'x'))
+        self.assertRaises(KeyError, lambda: node['nope'])
+        self.assertEqual(self.tree['svc']['limits'],
+                         dict(node['svc']['limits'].items()))
+
+    def test_equality(self):
+        self.assertEqual(self.tree, self.node)
+        self.assertEqual(self.node, self.tree)
+        self.assertEqual(self.node, compact(self.tree))
+        self.assertNotEqual(self.node['svc'], self.node['other'])
+        self.assertNotEqual(self.node['svc'], self.tree['other'])
+        self.assertNotEqual(self.node, (1, 2))
+        self.assertEqual(self.tree, self.node.to_dict())
+        self.assertEqual(json.dumps(self.tree),
+                         json.dumps(self.node.to_dict()))
+
+    def test_shapes_and_strings_are_shared(self):
+        svc = self.node['svc']
+        other = self.node['other']
+        self.assertIs(svc._values[0], other._values[0])
+        host = ''.join(['db.example', '.com'])
+        self.assertIs(compact(dict(host=host))['host'], svc['host'])
+
+    def test_compact_reuses_compact_nodes(self):
+        tree = dict(self.node.items())
+        tree['new'] = dict(a='1')
+        node = compact(tree)
+        self.assertIs(self.node['svc'], node['svc'])
+        self.assertIsInstance(node['new'], CompactNode)
+        self.assertIs(node, compact(node))
+
+    def test_copy_and_pickle(self):
+        self.assertEqual(self.tree, pickle.loads(pickle.dumps(self.node)))
+        self.assertEqual(self.tree, copy.deepcopy(self.node))
+        self.assertIs(self.node, self.node.copy())
+
+    def test_not_a_sequence(self):
+        self.assertNotIsInstance(self.node, tuple)
+        self.assertRaises(TypeError, json.dumps, self.node['svc'])
+        self.assertRaises(TypeError, lambda: self.node + (1,))
+        self.assertEqual('{"a": "1"}', json.dumps(compact(dict(a='1')),
+                                                  default=dict))
+
+    def test_read_only(self):
+        with self.assertRaises(TypeError):
+            self.node['svc'] = 1
+        self.assertRaises(TypeError, hash, self.node)
@@ -0,0 +1,111 @@
+from unittest import TestCase
+from conman.compact import CompactNode
+from conman.conman_base import ConManBase
+
+
+class ConManBaseTest(TestCase):
+    def setUp(self):
+        self.conman = ConManBase()
+        self.conman._publish(dict(
+            svc=dict(db=dict(host='db.example.com', port='5432')),
+            top='1'))
+
+    def test_get(self):
+        c = self.conman
+        self.assertEqual('1', c.get('top'))
+        self.assertEqual('5432', c.get('svc/db/port'))
+        self.assertEqual(dict(host='db.example.com', port='5432'),
+                         c.get('svc/db'))
+        self.assertIsNone(c.get('svc/db/no_such_key'))
+        self.assertEqual('x', c.get('no/such/key', 'x'))
+
+    def test_get_dotted_path(self):
+        c = self.conman
+        self.assertEqual('db.example.com', c.get('svc.db.host'))
+        c._set_path('a.b', '2')
+        self.assertEqual('2', c.get('a.b'))
+
+    def test_set_path_updates_index(self):
+        c = self.conman
+        c.get('top')
+        c._set_path('svc/cache/host', 'cache')
+        c._set_path('svc/db/port', '6543')
+        self.assertEqual('cache', c.get('svc/cache/host'))
+        self.assertEqual(dict(host='cache'), c.get('svc/cache'))
+        self.assertEqual('6543', c.get('svc/db/port'))
+        self.assertEqual('6543', c['svc']['db']['port'])
+
+    def test_set_path_replacing_subtree(self):
+        c = self.conman
+        c.get('top')
+        c._set_path('svc/db', 'flat')
+        self.assertEqual('flat', c.get('svc/db'))
+        self.assertIsNone(c.get('svc/db/host'))
+
+    def test_delete_path_prunes_empty_parents(self):
+        c = self.conman
+        c._set_path('a/b/c', '1')
+        c.get('top')
+        c._delete_path('a/b/c')
+        self.assertNotIn('a', c._conf)
+        self.assertIsNone(c.get('a/b'))
+        self.assertIsNone(c.get('a'))
+
+    def test_delete_subtree(self):
+        c = self.conman
+        c.get('top')
+        c._delete_path('svc/db')
+        self.assertEqual(dict(top='1'), c._conf)
+        self.assertIsNone(c.get('svc/db/host'))
+
+    def test_snapshot_is_immutable(self):
+        c = self.conman
+        snapshot = c.snapshot()
+        self.assertEqual('5432', snapshot.get('svc/db/port'))
+        c._set_path('svc/db/port', '6543')
+        c._delete_path('top')
+        self.assertEqual('5432', snapshot.get('svc/db/port'))
+        self.assertEqual('5432', snapshot['svc']['db']['port'])
+        self.assertEqual('1', snapshot['top'])
+        self.assertEqual('6543', c.get('svc/db/port'))
+        self.assertIsNone(c.get('top'))
+        self.assertLess(snapshot.version, c.snapshot().version)
+
+    def test_unchanged_subtrees_are_shared(self):
+        c = self.conman
+        c._set_path('other/x', '1')
+        snapshot = c.snapshot()
+        c._set_path('svc/db/port', '6543')
+        self.assertIs(snapshot['other'], c['other'])
+        self.assertIsNot(snapshot['svc'], c['svc'])
+
+    def test_many_updates_compact_the_index_overlay(self):
+        c = self.conman
+        c.get('top')
+        for i in range(2000):
+            c._set_path('many/%d' % i, str(i))
+        for i in range(0, 2000, 2):
+            c._delete_path('many/%d' % i)
+        self.assertEqual('1', c.get('many/1'))
+        self.assertIsNone(c.get('many/2'))
+        self.assertEqual(1000, len(c.get('many')))
+
+
+class CompactConManBaseTest(ConManBaseTest):
+    """Runs all the ConManBase tests on a compact tree"""
+
+    def setUp(self):
+        self.conman = ConManBase(compact=True)
+        self.conman._publish(dict(
+            svc=dict(db=dict(host='db.example.com', port='5432')),
+            top='1'))
+
+    def test_tree_is_compact(self):
+        c = self.conman
+        c._set_path('svc/cache/host', 'cache')
+        self.assertIsInstance(c['svc'], CompactNode)
+        self.assertIsInstance(c.get('svc/cache'), CompactNode)
+        self.assertIs(c.get('svc/cache'), c['svc']['cache'])
+        c._delete_path('svc/db/port')
+        self.assertIsInstance(c.get('svc/db'), CompactNode)
+        self.assertEqual(dict(host='db.example.com'), c.get('svc/db'))
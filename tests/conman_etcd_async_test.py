@@ -0,0 +1,198 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from conman.conman_etcd_async import AsyncConManEtcd
+from conman.dispatcher import EventDispatcher
+from conman.instrumentation import Recorder
+from conman.retry import RetryPolicy
+from conman.etcd_test_util import (start_local_etcd_server,
+                                   kill_local_etcd_server,
+                                   set_key,
+                                   delete_key)
+
+
+class AsyncConManEtcdTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        kill_local_etcd_server()
+        start_local_etcd_server()
+        cls.good_dict = dict(a='1', b='Yeah, it works!!!')
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            kill_local_etcd_server()
+        except:  # noqa
+            pass
+
+    def setUp(self):
+        self.conman = AsyncConManEtcd()
+        cli = self.conman.client
+        delete_key(cli, 'async_test')
+        set_key(cli, 'good', self.good_dict)
+
+    def tearDown(self):
+        for key in list(self.conman._watch_ids):
+            self.conman.unwatch(key)
+        cli = self.conman.client
+        delete_key(cli, 'good')
+        delete_key(cli, 'async_test')
+        cli.close()
+
+    def test_add_key(self):
+        asyncio.run(self.conman.add_key('good'))
+        self.assertEqual(self.good_dict, self.conman['good'])
+
+    def test_add_bad_key(self):
+        with self.assertRaises(Exception):
+            asyncio.run(self.conman.add_key('no such key'))
+
+    def test_add_keys_and_refresh(self):
+        async def run():
+            set_key(self.conman.client, 'async_test', dict(a='1'))
+            await self.conman.add_keys(['good', 'async_test'])
+            self.assertEqual(dict(a='1'), self.conman['async_test'])
+            set_key(self.conman.client, 'async_test', dict(b='2'))
+            await self.conman.refresh()
+            self.assertEqual(dict(b='2'), self.conman['async_test'])
+            self.assertEqual(self.good_dict, self.conman['good'])
+
+        asyncio.run(run())
+
+    def test_events(self):
+        changes = []
+
+        async def on_change(event):
+            changes.append(event.key)
+
+        async def run():
+            cli = self.conman.client
+            self.conman.on_change = on_change
+            set_key(cli, 'async_test', dict(a='1'))
+            await self.conman.add_key('async_test', watch=True)
+            events = self.conman.events()
+            next_event = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0)
+            cli.put('async_test/a', '2')
+            event = await asyncio.wait_for(next_event, 3)
+            await events.aclose()
+            self.assertEqual(b'async_test/a', event.key)
+            self.assertEqual(dict(a='2'), self.conman['async_test'])
+            self.assertEqual([b'async_test/a'], changes)
+
+        asyncio.run(run())
+
+    def test_failing_on_change_is_logged(self):
+        changes = []
+
+        async def on_change(event):
+            changes.append(event.key)
+            await asyncio.sleep(0.01)
+            raise ValueError('Bad change')
+
+        async def run():
+            cli = self.conman.client
+            self.conman.on_change = on_change
+            set_key(cli, 'async_test', dict(a='1'))
+            await self.conman.add_key('async_test', watch=True)
+            cli.put('async_test/a', '2')
+            for _ in range(300):
+                if changes and not self.conman._tasks:
+                    return
+                await asyncio.sleep(0.01)
+
+        with self.assertLogs('conman.conman_etcd_async', 'ERROR') as logs:
+            asyncio.run(run())
+        self.assertEqual([b'async_test/a'], changes)
+        self.assertIn('Bad change', logs.output[0])
+
+    def test_watch_prefix(self):
+        async def run():
+            events, cancel = await self.conman.watch_prefix('async_test')
+            self.conman.client.put('async_test/a', '1')
+            self.conman.client.put('async_test/b', 'stop')
+            values = []
+            async for event in events:
+                values.append(event.value)
+                if event.value == b'stop':
+                    cancel()
+            self.assertEqual([b'1', b'stop'], values)
+
+        asyncio.run(run())
+
+    def test_dispatcher(self):
+        batches = []
+        delivered = threading.Event()
+
+        def callback(events):
+            batches.append([e.key for e in events])
+            delivered.set()
+
+        conman = AsyncConManEtcd(dispatcher=EventDispatcher(callback,
+                                                            max_delay=0))
+        self.addCleanup(conman.close)
+
+        async def run():
+            await conman.add_key('good', watch=True)
+            conman.client.put('good/a', '2')
+            await asyncio.get_running_loop().run_in_executor(
+                None, delivered.wait, 3)
+
+        asyncio.run(run())
+        self.assertEqual([[b'good/a']], batches)
+
+    def test_cache_file(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_file = os.path.join(cache_dir, 'cache')
+        self.conman.cache_file = cache_file
+        asyncio.run(self.conman.add_key('good'))
+        self.conman.flush_cache()
+
+        # Nothing listens on port 1
+        policy = RetryPolicy(max_attempts=1, base_delay=0.01, max_delay=0.1)
+        conman = AsyncConManEtcd(cache_file=cache_file,
+                                 port=1,
+                                 retry_policy=policy)
+        self.addCleanup(conman.close)
+        asyncio.run(conman.add_key('good'))
+        self.assertEqual(self.good_dict, conman['good'])
+        self.assertEqual({'good'}, conman.stale_keys)
+
+    def test_store_runs_in_executor(self):
+        threads = []
+        self.conman.add_listener(
+            lambda snapshot: threads.append(threading.current_thread()))
+
+        async def run():
+            await self.conman.add_key('good')
+            await self.conman.refresh()
+
+        asyncio.run(run())
+        self.assertEqual(2, len(threads))
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_instrumentation(self):
+        recorder = Recorder()
+        self.conman.instrumentation = recorder
+        asyncio.run(self.conman.add_keys(['good']))
+        asyncio.run(self.conman.refresh('good'))
+        load = recorder.to_dict()['loads']['etcd']
+        self.assertEqual(2, load['count'])
+        self.assertEqual(4, load['keys'])
+
+    def test_lazy(self):
+        set_key(self.conman.client, 'async_test', dict(x=dict(a='1'), y='2'))
+
+        async def run():
+            await self.conman.add_key('async_test', lazy=True)
+            self.assertEqual(['x', 'y'], sorted(self.conman['async_test']))
+            self.conman.client.put('async_test/x/a', '3')
+            await self.conman.refresh()
+
+        asyncio.run(run())
+        self.assertEqual(dict(a='3'), self.conman['async_test']['x'])
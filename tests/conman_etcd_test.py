@@ -1,10 +1,18 @@
 import os
+import shutil
 import sys
+import tempfile
 import time
 from collections import defaultdict
 from threading import Thread
 
+from conman.client_pool import ClientPool
+from conman.compact import CompactNode
 from conman.conman_etcd import ConManEtcd
+from conman.dispatcher import EventDispatcher
+from conman.instrumentation import Recorder
+from conman.retry import RetryPolicy
+from etcd3.exceptions import RevisionCompactedError
 from conman.etcd_test_util import (start_local_etcd_server,
                                    kill_local_etcd_server,
                                    set_key,
@@ -13,6 +21,13 @@ from functools import partial
 from unittest import TestCase
 
 
+def _wait_for(predicate, timeout=3):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
 class ConManEtcdTest(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -43,8 +58,23 @@ class ConManEtcdTest(TestCase):
         delete_key(cli, 'good')
         delete_key(cli, 'refresh_test')
         delete_key(cli, 'watch_test')
+        for key in list(self.conman._watch_ids):
+            self.conman.unwatch(key)
         cli.close()
 
+    def _watch_test(self):
+        return self.conman._conf.get('watch_test')
+
+    def _break_watch(self, error=None):
+        """Cancel the etcd watches, then pass them an error like a broken
+        stream does"""
+        watches = list(self.conman._watches._watches)
+        for watch in watches:
+            if error is None:
+                self.conman.client.cancel_watch(watch.watch_id)
+            else:
+                self.conman._watches._on_event(watch, error)
+
     def test_initialization(self):
         cli = self.conman.client
         self.assertEqual('127.0.0.1:2379', cli._url)
@@ -89,6 +119,13 @@ class ConManEtcdTest(TestCase):
         self.conman.add_key('good')
         self.assertEqual(self.good_dict, self.conman['good'])
 
+    def test_get_path(self):
+        set_key(self.conman.client, 'refresh_test', dict(a=dict(b='1')))
+        self.conman.add_keys(['good', 'refresh_test'])
+        self.assertEqual('1', self.conman.get('refresh_test/a/b'))
+        self.assertEqual('1', self.conman.get('refresh_test.a.b'))
+        self.assertEqual(self.good_dict['b'], self.conman.get('good/b'))
+
     def test_watch_existing_key(self):
         def on_change(change_dict, event):
             change_dict[event.key].append((type(event).__name__, event.value))
@@ -143,18 +180,25 @@ class ConManEtcdTest(TestCase):
     def test_watch_prefix(self):
         all_events = []
 
+        # Watch before the puts below, so none of them is missed
+        events, cancel = self.conman.watch_prefix('watch_prefix_test')
+
         def read_events_in_thread():
+            stdout, stderr = sys.stdout, sys.stderr
             with open(os.devnull, 'w') as f:
                 sys.stdout = f
                 sys.stderr = f
-                events, cancel = self.conman.watch_prefix('watch_prefix_test')
-                for event in events:
-                    k = event.key.decode()
-                    v = event.value.decode()
-                    s = f'{k}: {v}'
-                    all_events.append(s)
-                    if v == 'stop':
-                        cancel()
+                try:
+                    for event in events:
+                        k = event.key.decode()
+                        v = event.value.decode()
+                        s = f'{k}: {v}'
+                        all_events.append(s)
+                        if v == 'stop':
+                            cancel()
+                finally:
+                    # Later tests log to stderr
+                    sys.stdout, sys.stderr = stdout, stderr
 
         t = Thread(target=read_events_in_thread)
         t.start()
@@ -173,3 +217,463 @@ class ConManEtcdTest(TestCase):
             'watch_prefix_test: stop'
         ]
         self.assertEqual(expected, all_events)
+
+    def test_add_key_with_watch_applies_events(self):
+        cli = self.conman.client
+        set_key(cli, 'watch_test', dict(a='1', b=dict(c='2')))
+        self.conman.add_key('watch_test', watch=True)
+        self.assertEqual(dict(a='1', b=dict(c='2')), self._watch_test())
+
+        cli.put('watch_test/a', '3')
+        cli.put('watch_test/d/e', '4')
+        cli.delete('watch_test/b/c')
+        expected = dict(a='3', d=dict(e='4'))
+        self.assertTrue(_wait_for(lambda: self._watch_test() == expected))
+        self.assertEqual('4', self.conman.get('watch_test/d/e'))
+        self.assertIsNone(self.conman.get('watch_test/b/c'))
+
+    def test_watch_resumes_from_last_revision(self):
+        cli = self.conman.client
+        set_key(cli, 'watch_test', dict(a='1'))
+        self.conman.add_key('watch_test', watch=True)
+
+        # Simulate a broken watch stream
+        self._break_watch()
+        cli.put('watch_test/a', '2')
+        self._break_watch(Exception('disconnected'))
+
+        expected = dict(a='2')
+        self.assertTrue(_wait_for(lambda: self._watch_test() == expected))
+
+    def test_watch_resyncs_after_compaction(self):
+        cli = self.conman.client
+        set_key(cli, 'watch_test', dict(a='1'))
+        self.conman.add_key('watch_test', watch=True)
+
+        self._break_watch()
+        cli.put('watch_test/a', '2')
+        cli.delete('watch_test/a')
+        cli.put('watch_test/b', '3')
+        revision = cli.get('watch_test/b')[1].mod_revision
+        cli.compact(revision)
+        self._break_watch(RevisionCompactedError(revision))
+
+        expected = dict(b='3')
+        self.assertTrue(_wait_for(lambda: self._watch_test() == expected))
+        cli.put('watch_test/c', '4')
+        expected = dict(b='3', c='4')
+        self.assertTrue(_wait_for(lambda: self._watch_test() == expected))
+
+    def test_add_keys(self):
+        cli = self.conman.client
+        set_key(cli, 'refresh_test', dict(a='1'))
+        self.conman.add_keys(['good', 'refresh_test'])
+        self.assertEqual(self.good_dict, self.conman['good'])
+        self.assertEqual(dict(a='1'), self.conman['refresh_test'])
+        self.assertEqual(self.conman._revisions['good'],
+                         self.conman._revisions['refresh_test'])
+
+    def test_add_keys_pinned_to_one_revision(self):
+        cli = self.conman.client
+        set_key(cli, 'refresh_test', dict(a='1'))
+        self.conman.max_txn_ops = 1
+        self.conman.add_keys(['good', 'refresh_test'])
+        self.assertEqual(self.good_dict, self.conman['good'])
+        self.assertEqual(dict(a='1'), self.conman['refresh_test'])
+
+    def test_add_keys_with_bad_key(self):
+        self.assertRaises(Exception,
+                          self.conman.add_keys, ['good', 'no such key'])
+        self.assertNotIn('good', self.conman._conf)
+
+    def test_refresh_all(self):
+        cli = self.conman.client
+        set_key(cli, 'refresh_test', dict(a='1'))
+        self.conman.add_keys(['good', 'refresh_test'])
+
+        set_key(cli, 'refresh_test', dict(b='3'))
+        cli.put('good/a', '2')
+        self.conman.refresh()
+
+        self.assertEqual(dict(b='3'), self.conman['refresh_test'])
+        self.assertEqual('2', self.conman['good']['a'])
+
+    def test_add_key_paged(self):
+        cli = self.conman.client
+        values = {str(i): str(i * 2) for i in range(10)}
+        set_key(cli, 'refresh_test', dict(x=values, y='1'))
+        self.conman.page_size = 3
+        self.conman.add_key('refresh_test')
+        self.assertEqual(dict(x=values, y='1'), self.conman['refresh_test'])
+        stats = self.conman.last_load_stats
+        self.assertEqual(11, stats['keys'])
+        self.assertEqual(4, stats['pages'])
+        self.assertEqual(self.conman._revisions['refresh_test'],
+                         stats['revision'])
+
+    def test_add_bad_key_paged(self):
+        self.conman.page_size = 3
+        self.assertRaises(Exception, self.conman.add_key, 'no such key')
+
+    def test_add_key_lazy(self):
+        cli = self.conman.client
+        conf = dict(x=dict(a='1', b=dict(c='2')), y='3', z=dict(d='4'))
+        set_key(cli, 'refresh_test', conf)
+        self.conman.add_key('refresh_test', lazy=True)
+        lazy = self.conman['refresh_test']
+        self.assertEqual(['x', 'y', 'z'], sorted(lazy))
+        self.assertIn('x', lazy)
+        self.assertEqual({}, dict(self.conman._subtrees))
+
+        self.assertEqual(conf['x'], lazy['x'])
+        self.assertEqual('3', lazy['y'])
+        self.assertEqual('2', self.conman.get('refresh_test/x/b/c'))
+        self.assertEqual('4', self.conman.get('refresh_test.z.d'))
+        self.assertIsNone(self.conman.get('refresh_test/x/nope'))
+        self.assertRaises(KeyError, lambda: lazy['nope'])
+        self.assertEqual(conf, dict(lazy))
+
+    def test_lazy_subtree_cache_is_bounded(self):
+        cli = self.conman.client
+        conf = {str(i): dict(a=str(i), b=str(i)) for i in range(5)}
+        set_key(cli, 'refresh_test', conf)
+        self.conman.subtree_cache_size = 4
+        self.conman.add_key('refresh_test', lazy=True)
+        lazy = self.conman['refresh_test']
+        for name in '0', '1', '2':
+            self.assertEqual(conf[name], lazy[name])
+        cached = [name for _, name in self.conman._subtrees]
+        self.assertEqual(['1', '2'], cached)
+        self.assertEqual(4, self.conman._subtree_keys)
+        # An evicted subtree is fetched again
+        self.assertEqual(conf['0'], lazy['0'])
+
+    def test_watch_lazy_key(self):
+        cli = self.conman.client
+        set_key(cli, 'watch_test', dict(x=dict(a='1'), y='2'))
+        self.conman.add_key('watch_test', watch=True, lazy=True)
+        self.assertEqual(dict(a='1'), self.conman['watch_test']['x'])
+
+        cli.put('watch_test/x/a', '3')
+        cli.put('watch_test/z/b', '4')
+        cli.delete('watch_test/y')
+        self.assertTrue(_wait_for(
+            lambda: 'y' not in self.conman['watch_test']))
+        expected = dict(x=dict(a='3'), z=dict(b='4'))
+        self.assertEqual(expected, dict(self.conman['watch_test']))
+
+    def test_refresh_lazy_key(self):
+        cli = self.conman.client
+        set_key(cli, 'refresh_test', dict(x=dict(a='1')))
+        self.conman.add_keys(['good'])
+        self.conman.add_key('refresh_test', lazy=True)
+        self.assertEqual(dict(a='1'), self.conman['refresh_test']['x'])
+
+        set_key(cli, 'refresh_test', dict(x=dict(a='2'), y='3'))
+        self.conman.refresh()
+        self.assertEqual(dict(x=dict(a='2'), y='3'),
+                         dict(self.conman['refresh_test']))
+        self.assertEqual(self.good_dict, self.conman['good'])
+
+    def test_add_bad_key_lazy(self):
+        self.assertRaises(Exception,
+                          self.conman.add_key, 'no such key', lazy=True)
+        self.assertNotIn('no such key', self.conman._lazy_keys)
+
+    def test_compact(self):
+        cli = self.conman.client
+        self.conman.compact = True
+        set_key(cli, 'watch_test', dict(a='1', b=dict(c='2')))
+        self.conman.add_key('watch_test', watch=True)
+        self.assertIsInstance(self._watch_test(), CompactNode)
+        self.assertEqual(dict(a='1', b=dict(c='2')), self._watch_test())
+
+        cli.put('watch_test/b/d', '3')
+        cli.delete('watch_test/a')
+        expected = dict(b=dict(c='2', d='3'))
+        self.assertTrue(_wait_for(lambda: self._watch_test() == expected))
+        self.assertIsInstance(self.conman.get('watch_test/b'), CompactNode)
+
+    def _cache_file(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return os.path.join(cache_dir, 'cache')
+
+    def _cached_conman(self, cache_file, **kwargs):
+        conman = ConManEtcd(cache_file=cache_file, **kwargs)
+        self.addCleanup(conman.client.close)
+        return conman
+
+    def test_cache_survives_etcd_outage(self):
+        cache_file = self._cache_file()
+        self.conman.cache_file = cache_file
+        self.conman.add_key('good')
+        self.conman.flush_cache()
+
+        # Nothing listens on port 1
+        policy = RetryPolicy(max_attempts=1, base_delay=0.01, max_delay=0.1)
+        conman = self._cached_conman(cache_file, port=1, retry_policy=policy)
+        conman.add_key('good')
+        self.assertEqual(self.good_dict, conman['good'])
+        self.assertEqual({'good'}, conman.stale_keys)
+
+    def test_cache_is_revalidated(self):
+        cli = self.conman.client
+        cache_file = self._cache_file()
+        self.conman.cache_file = cache_file
+        self.conman.add_key('good')
+        self.conman.flush_cache()
+        cli.put('good/a', '2')
+
+        conman = self._cached_conman(cache_file)
+        conman.add_key('good')
+        expected = dict(self.good_dict, a='2')
+        self.assertTrue(_wait_for(lambda: not conman.stale_keys))
+        self.assertEqual(expected, conman['good'])
+        conman.flush_cache()
+
+        # The revalidated key was written back to the cache
+        conman = self._cached_conman(cache_file)
+        conman._revalidate = lambda keys, watch: None
+        conman.add_key('good')
+        self.assertEqual(expected, conman['good'])
+
+    def test_cached_key_is_watched_from_cached_revision(self):
+        cli = self.conman.client
+        cache_file = self._cache_file()
+        set_key(cli, 'watch_test', dict(a='1', b='2'))
+        self.conman.cache_file = cache_file
+        self.conman.add_key('watch_test')
+        self.conman.flush_cache()
+        cli.put('watch_test/a', '3')
+        cli.delete('watch_test/b')
+
+        conman = self._cached_conman(cache_file)
+        conman.add_key('watch_test', watch=True)
+        self.addCleanup(conman.unwatch, 'watch_test')
+        expected = dict(a='3')
+        self.assertTrue(_wait_for(
+            lambda: conman._conf.get('watch_test') == expected))
+        cli.put('watch_test/c', '4')
+        expected = dict(a='3', c='4')
+        self.assertTrue(_wait_for(
+            lambda: conman._conf.get('watch_test') == expected))
+        self.assertFalse(conman.stale_keys)
+
+    def test_instrumentation(self):
+        cli = self.conman.client
+        recorder = Recorder()
+        self.conman.instrumentation = recorder
+        set_key(cli, 'watch_test', dict(a='1', b='2'))
+        self.conman.add_key('watch_test', watch=True)
+        load = recorder.to_dict()['loads']['etcd']
+        self.assertEqual(1, load['count'])
+        self.assertEqual(2, load['keys'])
+        self.assertEqual(len('watch_test/a1watch_test/b2'), load['bytes'])
+
+        cli.put('watch_test/c', '3')
+        self.assertTrue(_wait_for(
+            lambda: recorder.to_dict()['watch']['events'] == 1))
+        revision = cli.get('watch_test/c')[1].mod_revision
+        self.assertEqual(revision, recorder.to_dict()['watch']['revision'])
+        self.assertEqual(3, recorder.to_dict()['tree']['leaves'])
+
+        failures = [ConnectionError()]
+
+        def flaky():
+            if failures:
+                raise failures.pop()
+            return 'ok'
+
+        self.assertEqual('ok', self.conman._retry('load', flaky))
+        self.assertEqual(dict(load=1), recorder.to_dict()['retries'])
+
+    def test_client_pool(self):
+        pool = ClientPool(check_interval=0)
+        c1 = ConManEtcd(client_pool=pool)
+        c2 = ConManEtcd(client_pool=pool)
+        other = ConManEtcd(client_pool=pool, port=2380)
+        self.assertIs(c1.client, c2.client)
+        self.assertIsNot(c1.client, other.client)
+        self.assertEqual(2, len(pool))
+        other.close()
+        self.assertEqual(1, len(pool))
+
+        c1.add_key('good', watch=True)
+        c1.close()
+        c1.close()
+        c2.add_key('good')
+        self.assertEqual(self.good_dict, c2['good'])
+        client = c2.client
+        c2.close()
+        self.assertEqual(0, len(pool))
+        self.assertRaises(ValueError, client.get, 'good/a')
+
+    def test_client_pool_replaces_closed_client(self):
+        pool = ClientPool(check_interval=0)
+        c1 = ConManEtcd(client_pool=pool)
+        self.addCleanup(c1.close)
+        closed = c1.client
+        closed.close()
+        c2 = ConManEtcd(client_pool=pool)
+        self.addCleanup(c2.close)
+        self.assertIsNot(closed, c2.client)
+        self.assertIs(c1.client, c2.client)
+        self.assertEqual(0, pool.check())
+        c1.add_key('good')
+        self.assertEqual(self.good_dict, c1['good'])
+
+    def test_client_pool_after_fork(self):
+        pool = ClientPool()
+        pooled = pool.acquire(host='127.0.0.1', port=2379)
+        self.addCleanup(pooled.client.close)
+        # Pretend this is a forked child
+        pool._pid = -1
+        child = pool.acquire(host='127.0.0.1', port=2379)
+        self.addCleanup(child.client.close)
+        self.assertIsNot(pooled, child)
+
+    def test_read_endpoints(self):
+        set_key(self.conman.client, 'refresh_test', dict(a='1'))
+        conman = ConManEtcd(read_endpoints=['127.0.0.1:2379',
+                                            ('localhost', 2379)])
+        self.addCleanup(conman.close)
+        readers = [p.client for p in conman._readers]
+        self.assertEqual(2, len(readers))
+        self.assertEqual(readers[0], conman._read_client())
+        self.assertEqual(readers[1], conman._read_client())
+        conman.add_key('good')
+        conman.add_keys(['refresh_test'])
+        conman.refresh()
+        self.assertEqual(self.good_dict, conman['good'])
+        self.assertEqual(dict(a='1'), conman['refresh_test'])
+
+    def test_dispatcher(self):
+        batches = []
+        dispatcher = EventDispatcher(batches.append, max_delay=0.2)
+        conman = ConManEtcd(dispatcher=dispatcher)
+        self.addCleanup(conman.close)
+        conman.client.put('watch_test/a', 'start')
+        conman.add_key('watch_test', watch=True)
+        for i in range(5):
+            conman.client.put('watch_test/a', str(i))
+        conman.client.put('watch_test/b', 'x')
+        self.assertTrue(_wait_for(lambda: dispatcher.stats['received'] == 6))
+        self.assertTrue(dispatcher.flush(5))
+        events = [e for batch in batches for e in batch]
+        self.assertEqual([(b'watch_test/a', b'4'), (b'watch_test/b', b'x')],
+                         [(e.key, e.value) for e in events])
+        self.assertEqual(dict(a='4', b='x'), conman['watch_test'])
+
+    def test_watches_share_one_etcd_watch(self):
+        cli = self.conman.client
+        keys = ['watch_test/%d' % i for i in range(5)]
+        for key in keys:
+            cli.put(key + '/a', '1')
+        self.conman.add_keys(keys, watch=True)
+        # A key outside of the watched prefixes
+        cli.put('watch_test/other', 'x')
+        watches = self.conman._watches
+        self.assertEqual(5, len(watches))
+        self.assertEqual(1, watches.stats['watches'])
+
+        for key in keys:
+            cli.put(key + '/a', '2')
+        self.assertTrue(_wait_for(
+            lambda: all(self.conman.get(k + '/a') == '2' for k in keys)))
+
+        # A broken stream is resumed once for all the keys
+        self._break_watch()
+        for key in keys:
+            cli.put(key + '/b', '3')
+        self._break_watch(Exception('disconnected'))
+        self.assertTrue(_wait_for(
+            lambda: all(self.conman.get(k + '/b') == '3' for k in keys)))
+        self.assertEqual(1, watches.stats['resumes'])
+        self.assertEqual(2, watches.stats['watches'])
+        self.assertEqual(dict(a='2', b='3'), self.conman['watch_test']['0'])
+
+    def test_watches_of_disjoint_ranges(self):
+        cli = self.conman.client
+        keys = ['watch_test/a', 'watch_test/z']
+        for key in keys:
+            cli.put(key + '/x', '1')
+        for key in keys:
+            self.conman.add_key(key, watch=True)
+        watches = self.conman._watches
+        self.assertEqual(2, watches.stats['watches'])
+
+        # The keys in between aren't streamed
+        for i in range(100):
+            cli.put('watch_test/m/%d' % i, 'x')
+        cli.put('watch_test/z/x', '2')
+        self.assertTrue(_wait_for(
+            lambda: self.conman.get('watch_test/z/x') == '2'))
+        self.assertEqual(0, watches.stats['dropped'])
+
+        # Both are resumed together
+        self._break_watch()
+        for key in keys:
+            cli.put(key + '/x', '3')
+        self._break_watch(Exception('disconnected'))
+        self.assertTrue(_wait_for(
+            lambda: all(self.conman.get(k + '/x') == '3' for k in keys)))
+        self.assertEqual(1, watches.stats['resumes'])
+        self.assertEqual(4, watches.stats['watches'])
+
+    def test_watch_replays_only_to_new_registrations(self):
+        cli = self.conman.client
+        events = []
+        cli.put('watch_test/a', '1')
+        self.conman.add_key('watch_test', watch=True)
+        revision = cli.put('watch_test/b', '1').header.revision
+        self.assertTrue(_wait_for(lambda: 'b' in self._watch_test()))
+        # Needs an older revision, so the watch is re-created from it
+        self.conman._watches.add('watch_test/b', events.append,
+                                 start_revision=revision)
+        cli.put('watch_test/c', '1')
+        self.assertTrue(_wait_for(lambda: 'c' in self._watch_test()))
+        self.assertEqual([(b'watch_test/b', b'1')],
+                         [(e.key, e.value) for e in events])
+        self.assertEqual(dict(a='1', b='1', c='1'), self._watch_test())
+
+    def test_put_tree(self):
+        cli = self.conman.client
+        set_key(cli, 'refresh_test', dict(a='1', b=dict(c='2'), d='3'))
+        self.conman.add_key('refresh_test')
+        tree = dict(a='1', b=dict(c='5', e=dict(f=6)))
+        revision = self.conman.put_tree('refresh_test', tree)
+        stats = self.conman.last_write_stats
+        self.assertEqual(2, stats['puts'])
+        self.assertEqual(1, stats['deletes'])
+        self.assertEqual(1, stats['unchanged'])
+        self.assertEqual(1, stats['txns'])
+
+        # Read your writes
+        expected = dict(a='1', b=dict(c='5', e=dict(f='6')))
+        self.assertEqual(expected, self.conman['refresh_test'])
+        self.assertEqual(revision, self.conman._revisions['refresh_test'])
+        conman = ConManEtcd()
+        self.addCleanup(conman.close)
+        conman.add_key('refresh_test')
+        self.assertEqual(expected, conman['refresh_test'])
+
+        # Nothing changed
+        self.assertIsNone(self.conman.put_tree('refresh_test', expected))
+        self.assertEqual(0, self.conman.last_write_stats['txns'])
+
+    def test_put_tree_batches(self):
+        self.conman.max_txn_ops = 10
+        tree = {str(i): dict(v=str(i)) for i in range(25)}
+        self.conman['refresh_test'] = tree
+        self.assertEqual(3, self.conman.last_write_stats['txns'])
+        self.conman.add_key('refresh_test', watch=True)
+        self.assertEqual(tree, self.conman['refresh_test'])
+
+        self.conman.put_tree('refresh_test', dict(x='1'),
+                             delete_missing=False)
+        self.assertEqual(1, self.conman.last_write_stats['txns'])
+        self.assertEqual('1', self.conman['refresh_test']['x'])
+        self.assertEqual(26, len(self.conman['refresh_test']))
+        self.assertRaises(Exception, self.conman.__setitem__,
+                          'refresh_test', 'x')
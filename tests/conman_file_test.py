@@ -2,8 +2,19 @@ import json
 import os
 import yaml
 import tempfile
-from unittest import TestCase
-from conman.conman_file import ConManFile
+import time
+from unittest import TestCase, mock
+from conman import conman_file
+from conman.compact import CompactNode
+from conman.conman_base import Lazy
+from conman.conman_file import ConManFile, diff_trees
+from conman.file_watcher import inotify_available
+
+
+def _wait_for(predicate, timeout=3):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
 
 
 def _make_config_file(file_type, content):
@@ -140,5 +151,265 @@ class ConmanFileTest(TestCase):
         c = ConManFile(self._good_files.values())
         self.assertEqual('root_value', c['root_key'])
 
+    def test_get_path(self):
+        c = ConManFile([self._good_files['ini']])
+        self.assertEqual('value', c.get('ini_conf.key'))
+        c.add_config_file(self._good_files['json'])
+        self.assertEqual('value', c.get('json_conf/key'))
 
+    def test_add_config_files_merges_in_order(self):
+        first = _make_config_file('.json', json.dumps(dict(a=1, b=1)))
+        second = _make_config_file('.json', json.dumps(dict(b=2)))
+        self._all_files.extend([first, second])
+        c = self.conman
+        c.add_config_files([first, second])
+        self.assertDictEqual(dict(a=1, b=2), c._conf)
+
+    def test_add_config_files_in_process_pool(self):
+        first = _make_config_file('.yaml', yaml.dump(dict(a=1, b=1)))
+        second = _make_config_file('.ini', '[b]\nc = 2\n')
+        self._all_files.extend([first, second])
+        c = self.conman
+        c.add_config_files([first, second], use_processes=True)
+        self.assertDictEqual(dict(a=1, b=dict(c='2')), c._conf)
 
+    def test_add_config_files_with_bad_file(self):
+        c = self.conman
+        files = [self._good_files['json'], self._bad_files['json']]
+        self.assertRaises(Exception, c.add_config_files, files)
+        self.assertDictEqual({}, c._conf)
+        c.add_config_file(self._good_files['json'])
+
+    def test_add_same_file_twice(self):
+        c = self.conman
+        c.add_config_file(self._good_files['json'])
+        self.assertRaises(Exception,
+                          c.add_config_file, self._good_files['json'])
+
+    def test_unchanged_file_is_not_parsed_again(self):
+        filename = _make_config_file('.json', json.dumps(dict(a=1)))
+        self._all_files.append(filename)
+        ConManFile([filename])
+        with mock.patch.object(conman_file, '_parse_config_timed') as parse:
+            c = ConManFile([filename])
+            parse.assert_not_called()
+        self.assertDictEqual(dict(a=1), c._conf)
+
+        with open(filename, 'w') as f:
+            f.write(json.dumps(dict(a=2)))
+        c = ConManFile([filename])
+        self.assertDictEqual(dict(a=2), c._conf)
+
+    def test_cached_configs_are_not_shared(self):
+        content = json.dumps(dict(db=dict(host='h', ports=[1]), big=dict()))
+        filename = _make_config_file('.json', content)
+        self._all_files.append(filename)
+        for lazy_json in False, True:
+            conman_file._parse_cache.clear()
+            c1 = ConManFile([filename], lazy_json=lazy_json)
+            c1['db']['host'] = 'X'
+            c1['db']['ports'].append(2)
+            c2 = ConManFile([filename], lazy_json=lazy_json)
+            self.assertEqual(dict(host='h', ports=[1]), c2['db'])
+            c2['big']['k'] = 'v'
+            c3 = ConManFile([filename], lazy_json=lazy_json)
+            self.assertEqual({}, c3['big'])
+
+    def test_yaml_loaders(self):
+        self.assertIs(yaml.SafeLoader, conman_file.get_yaml_loader('safe'))
+        self.assertIs(yaml.FullLoader, conman_file.get_yaml_loader('full'))
+        if yaml.__with_libyaml__:
+            self.assertIs(yaml.CSafeLoader, conman_file.get_yaml_loader())
+        else:
+            self.assertIs(yaml.SafeLoader, conman_file.get_yaml_loader())
+        self.assertRaises(Exception, ConManFile, yaml_loader='no such')
+
+        expected = dict(root_key='root_value', yaml_conf=dict(key='value'))
+        for loader in 'auto', 'safe', 'full':
+            c = ConManFile([self._good_files['yaml']], yaml_loader=loader)
+            self.assertDictEqual(expected, c._conf)
+
+    def test_safe_yaml_loader_rejects_python_objects(self):
+        filename = _make_config_file('.yaml', 'a: !!python/tuple [1, 2]\n')
+        self._all_files.append(filename)
+        self.assertRaises(Exception, ConManFile, [filename])
+        c = ConManFile([filename], yaml_loader='full')
+        self.assertEqual((1, 2), c['a'])
+
+    def test_sniff_file_types(self):
+        sniff = conman_file._sniff_file_types
+        self.assertEqual(['ini'], sniff(b'; comment\n\n[section]\na = 1'))
+        self.assertEqual(['json', 'yaml'], sniff(b'  \n {"a": 1}'))
+        self.assertEqual(['yaml'], sniff(b'# comment\na: 1'))
+        self.assertEqual(['yaml'], sniff(b'- [1, 2]'))
+        self.assertEqual(['yaml'], sniff(b''))
+
+    def test_extensionless_files_are_parsed_once(self):
+        contents = dict(ini='[ini_conf]\nkey = value\n',
+                        json=json.dumps(dict(json_conf=dict(key='value'))),
+                        yaml=yaml.dump(dict(yaml_conf=dict(key='value'))))
+        for file_type, content in contents.items():
+            filename = _make_config_file('', content)
+            self._all_files.append(filename)
+            parsers = {t: mock.Mock(wraps=p)
+                       for t, p in conman_file._parsers.items()}
+            with mock.patch.dict(conman_file._parsers, parsers):
+                c = ConManFile([filename], yaml_loader='full')
+            self.assertEqual(dict(key='value'), c[file_type + '_conf'])
+            calls = {t: p.call_count for t, p in parsers.items()}
+            self.assertEqual(1, sum(calls.values()))
+
+    def _watch_test(self, use_inotify, deep_merge=False):
+        base = _make_config_file('.yaml', 'a: 1\nshared: {x: 1}\n')
+        override = _make_config_file('.yaml', 'shared: {x: 2, y: 3}\n')
+        self._all_files += [base, override]
+        diffs = []
+        c = ConManFile([base, override],
+                       on_change=diffs.append,
+                       deep_merge=deep_merge)
+        c.watch(debounce=0.2, poll_interval=0.05, use_inotify=use_inotify)
+        try:
+            # A burst of writes is reloaded once
+            for i in range(3):
+                with open(base, 'w') as f:
+                    f.write('a: %d\nb: 1\nshared: {x: 1}\n' % (i + 2))
+                time.sleep(0.05)
+            _wait_for(lambda: diffs)
+            time.sleep(0.3)
+            expected = dict(added=['b'], removed=[], changed=['a'])
+            self.assertEqual([expected], diffs)
+            self.assertEqual(4, c['a'])
+            # The override still wins
+            self.assertEqual(dict(x=2, y=3), c['shared'])
+
+            # A broken file keeps its previous content
+            with open(override, 'w') as f:
+                f.write('shared: [')
+            time.sleep(0.5)
+            self.assertEqual(1, len(diffs))
+            self.assertEqual(dict(x=2, y=3), c['shared'])
+
+            os.remove(override)
+            with open(override, 'w') as f:
+                f.write('shared: {x: 2}\n')
+            _wait_for(lambda: len(diffs) == 2)
+            expected = dict(added=[], removed=['shared/y'], changed=[])
+            self.assertEqual(expected, diffs[1])
+            self.assertEqual(dict(x=2), c.get('shared'))
+        finally:
+            c.stop_watching()
+
+    def test_watch_inotify(self):
+        if not inotify_available():
+            self.skipTest('inotify is not available')
+        self._watch_test(use_inotify=True)
+
+    def test_watch_polling(self):
+        self._watch_test(use_inotify=False)
+
+    def test_watch_deep_merge(self):
+        self._watch_test(use_inotify=False, deep_merge=True)
+
+    def test_deep_merge(self):
+        base = _make_config_file('.yaml', 'db: {host: a, port: 1}\nx: 1\n')
+        override = _make_config_file('.json', json.dumps(dict(db=dict(
+            host='b', options=dict(ssl=True)))))
+        self._all_files += [base, override]
+        c = ConManFile([base, override], deep_merge=True)
+        expected = dict(host='b', port=1, options=dict(ssl=True))
+        self.assertEqual(expected, c['db'])
+        self.assertEqual(1, c.get('x'))
+        self.assertEqual(override, c.provenance('db/host'))
+        self.assertEqual(base, c.provenance('db/port'))
+        self.assertIsNone(c.provenance('db/nope'))
+
+        shallow = ConManFile([base, override])
+        self.assertEqual(dict(host='b', options=dict(ssl=True)),
+                         shallow['db'])
+        self.assertRaises(Exception, shallow.provenance, 'db/host')
+
+    def test_diff_trees(self):
+        old = dict(a=1, b=dict(c=2, d=3), e=dict(f=4))
+        new = dict(a=1, b=dict(c=5), g=dict(h=dict(i=6)))
+        expected = dict(added=['g/h/i'],
+                        removed=['b/d', 'e/f'],
+                        changed=['b/c'])
+        self.assertEqual(expected, diff_trees(old, new))
+        self.assertEqual(dict(added=[], removed=[], changed=[]),
+                         diff_trees(old, new, ['a']))
+
+    def test_json_parsers(self):
+        content = json.dumps(dict(a=dict(b=[1, 'x']), c=float('nan')))
+        filename = _make_config_file('.json', content)
+        self._all_files.append(filename)
+        for parser in conman_file.JSON_PARSERS:
+            if parser == 'orjson' and conman_file.orjson is None:
+                continue
+            c = ConManFile([filename], json_parser=parser)
+            self.assertEqual(dict(b=[1, 'x']), c['a'])
+            self.assertNotEqual(c['c'], c['c'])
+        self.assertRaises(Exception, ConManFile, json_parser='simdjson')
+
+    def test_big_files_are_mmapped(self):
+        files = [_make_ini_file(True), _make_json_file(True),
+                 _make_yaml_file(True)]
+        self._all_files += files
+        with mock.patch.object(conman_file, 'MMAP_THRESHOLD', 1):
+            for parser in 'json', 'auto':
+                conman_file._parse_cache.clear()
+                c = ConManFile(files, json_parser=parser)
+                self.assertEqual(dict(key='value'), c['ini_conf'])
+                self.assertEqual(dict(key='value'), c['json_conf'])
+                self.assertEqual(dict(key='value'), c['yaml_conf'])
+
+    def test_lazy_json(self):
+        conf = dict(a=dict(b=[1, ']', dict(c='}"{')], g=dict(h=1)),
+                    d='x,y',
+                    e=None,
+                    f=[[[]]])
+        content = json.dumps(conf, indent=2)
+        filename = _make_config_file('.json', content)
+        self._all_files.append(filename)
+        with mock.patch.object(conman_file, 'MMAP_THRESHOLD', 1):
+            c = ConManFile([filename], lazy_json=True)
+        tree = c.snapshot().tree
+        self.assertIsInstance(tree['a'], Lazy)
+        self.assertIsInstance(tree['f'], Lazy)
+        self.assertEqual('x,y', tree['d'])
+        # Paths below lazy subtrees are looked up through them
+        self.assertEqual(1, c.get('a/g/h'))
+        self.assertEqual(1, c.get('a.g.h'))
+        self.assertIsNone(c.get('a/g/x'))
+        self.assertEqual(conf['a']['b'], c.get('a/b'))
+        self.assertEqual(conf['a'], c['a'])
+        self.assertEqual(conf['f'], c.get('f'))
+        self.assertEqual(conf['e'], c['e'])
+
+    def test_lazy_json_fallback(self):
+        deep = '{"a": %s1%s}' % ('[' * 100, ']' * 100)
+        for content, expected in ((deep, json.loads(deep)),
+                                  ('{}', {}),
+                                  (' { } ', {})):
+            filename = _make_config_file('.json', content)
+            self._all_files.append(filename)
+            c = ConManFile([filename], lazy_json=True)
+            self.assertEqual(expected, {k: c[k] for k in c.snapshot().tree})
+
+        filename = _make_config_file('.json', '{"a": [1, }')
+        self._all_files.append(filename)
+        self.assertRaises(Exception, ConManFile, [filename], lazy_json=True)
+
+        # Malformed objects are left to the JSON parser
+        for content in (b'{"a": 1,}', b'{"a" x: 1}', b'{"a": 1} x',
+                        b'{"a": [1]', b'{"a": 1 "b": 2}'):
+            self.assertRaises(ValueError,
+                              conman_file._parse_json_lazy,
+                              content)
+
+    def test_compact(self):
+        files = [self._good_files['ini'], self._good_files['yaml']]
+        c = ConManFile(files, compact=True)
+        self.assertIsInstance(c['yaml_conf'], CompactNode)
+        self.assertEqual(dict(key='value'), c['yaml_conf'])
+        self.assertEqual('value', c.get('ini_conf/key'))
+        self.assertEqual('root_value', c['root_key'])
@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import namedtuple
+from unittest import TestCase
+
+from conman.dispatcher import EventDispatcher
+from conman.instrumentation import Recorder
+
+Event = namedtuple('Event', 'key value')
+
+
+class DispatcherTest(TestCase):
+    def setUp(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.dispatchers = []
+
+    def tearDown(self):
+        self.gate.set()
+        for dispatcher in self.dispatchers:
+            dispatcher.close()
+
+    def _callback(self, events):
+        self.gate.wait()
+        self.batches.append(events)
+
+    def _dispatcher(self, **kwargs):
+        dispatcher = EventDispatcher(self._callback, **kwargs)
+        self.dispatchers.append(dispatcher)
+        return dispatcher
+
+    def _delivered(self):
+        return [e for batch in self.batches for e in batch]
+
+    def test_coalesce(self):
+        d = self._dispatcher(max_delay=10)
+        for i in range(100):
+            d.submit(Event(b'k%d' % (i % 10), i))
+        d.close()
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual([Event(b'k%d' % i, 90 + i) for i in range(10)],
+                         self.batches[0])
+        self.assertEqual(100, d.stats['received'])
+        self.assertEqual(90, d.stats['coalesced'])
+        self.assertEqual(10, d.stats['delivered'])
+
+    def test_max_batch(self):
+        d = self._dispatcher(max_batch=5, max_delay=10)
+        for i in range(12):
+            d.submit(Event(b'k%d' % i, i))
+        deadline = time.monotonic() + 5
+        while len(self.batches) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([5, 5], [len(b) for b in self.batches])
+        d.close()
+        self.assertEqual([5, 5, 2], [len(b) for b in self.batches])
+
+    def test_max_delay(self):
+        d = self._dispatcher(max_delay=0.05)
+        start = time.monotonic()
+        d.submit(Event(b'k', 1))
+        self.assertTrue(d.flush(5))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual([[Event(b'k', 1)]], self.batches)
+        self.assertGreaterEqual(d.stats['lag'], 0.05)
+
+    def test_events_without_key_are_not_coalesced(self):
+        d = self._dispatcher(max_delay=10, key=lambda e: None)
+        d.submit(Event(b'k', 1))
+        d.submit(Event(b'k', 2))
+        d.close()
+        self.assertEqual([Event(b'k', 1), Event(b'k', 2)], self._delivered())
+
+    def _fill(self, d):
+        """Get an event in flight, blocked in the callback, then fill the
+        queue"""
+        self.gate.clear()
+        d.submit(Event(b'in flight', 0))
+        deadline = time.monotonic() + 5
+        while d.stats['queue_depth'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        d.submit(Event(b'a', 1))
+        d.submit(Event(b'b', 2))
+
+    def test_block(self):
+        d = self._dispatcher(max_delay=0, max_queue=2)
+        self._fill(d)
+        t = threading.Thread(target=d.submit, args=(Event(b'c', 3),))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        # Coalesced events don't need room
+        d.submit(Event(b'a', 4))
+        self.gate.set()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        d.close()
+        self.assertEqual([Event(b'in flight', 0),
+                          Event(b'b', 2),
+                          Event(b'a', 4),
+                          Event(b'c', 3)], self._delivered())
+        self.assertEqual(0, d.stats['dropped'])
+        self.assertEqual(2, d.stats['max_queue_depth'])
+
+    def test_drop_oldest(self):
+        d = self._dispatcher(max_delay=0, max_queue=2, policy='drop_oldest')
+        self._fill(d)
+        d.submit(Event(b'c', 3))
+        self.gate.set()
+        d.close()
+        self.assertEqual([Event(b'in flight', 0),
+                          Event(b'b', 2),
+                          Event(b'c', 3)], self._delivered())
+        self.assertEqual(1, d.stats['dropped'])
+
+    def test_drop_newest(self):
+        d = self._dispatcher(max_delay=0, max_queue=2, policy='drop_newest')
+        self._fill(d)
+        d.submit(Event(b'c', 3))
+        self.gate.set()
+        d.close()
+        self.assertEqual([Event(b'in flight', 0),
+                          Event(b'a', 1),
+                          Event(b'b', 2)], self._delivered())
+        self.assertEqual(1, d.stats['dropped'])
+
+    def test_bad_policy(self):
+        self.assertRaises(Exception, EventDispatcher, print, policy='nope')
+
+    def test_failing_callback(self):
+        calls = []
+
+        def callback(events):
+            calls.append(events)
+            raise Exception('boom')
+
+        d = EventDispatcher(callback, max_delay=0)
+        d.submit(Event(b'a', 1))
+        self.assertTrue(d.flush(5))
+        d.submit(Event(b'b', 2))
+        d.close()
+        self.assertEqual(2, len(calls))
+        self.assertEqual(2, d.stats['failed'])
+
+    def test_closed(self):
+        d = self._dispatcher()
+        d.close()
+        self.assertRaises(Exception, d.submit, Event(b'a', 1))
+
+    def test_workers(self):
+        d = self._dispatcher(max_batch=1, max_delay=0, workers=4)
+        for i in range(20):
+            d.submit(Event(b'k%d' % i, i))
+        d.close()
+        self.assertEqual(set(range(20)), {e.value for e in self._delivered()})
+
+    def test_instrumentation(self):
+        recorder = Recorder()
+        d = self._dispatcher(max_delay=10, instrumentation=recorder)
+        d.submit(Event(b'a', 1))
+        d.submit(Event(b'b', 1))
+        d.close()
+        stats = recorder.to_dict()['dispatch']
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(2, stats['events'])
+        self.assertEqual(0, stats['queue_depth'])
@@ -0,0 +1,314 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from conman import conman_etcd
+from conman.conman_etcd import ConManEtcd
+from conman.etcd_test_util import set_key
+from conman.fake_etcd import FakeEtcd
+from etcd3 import etcdrpc
+from etcd3.exceptions import RevisionCompactedError
+
+
+def _wait_for(predicate, timeout=3):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.001)
+    return predicate()
+
+
+class FakeEtcdTest(TestCase):
+    def setUp(self):
+        self.etcd = FakeEtcd()
+        self.client = self.etcd.client()
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_get_put_delete(self):
+        client = self.client
+        self.assertEqual((None, None), client.get('a'))
+        client.put('a', '1')
+        client.put('a', '2')
+        value, meta = client.get('a')
+        self.assertEqual(b'2', value)
+        self.assertEqual(2, meta.version)
+        self.assertEqual(2, meta.create_revision)
+        self.assertEqual(3, meta.mod_revision)
+        self.assertTrue(client.delete('a'))
+        self.assertFalse(client.delete('a'))
+        self.assertEqual((None, None), client.get('a'))
+        self.assertEqual(4, self.etcd.revision)
+
+    def test_prefix(self):
+        client = self.client
+        for k in 'b/2', 'a', 'b/1', 'c', 'b/3':
+            client.put(k, k)
+        self.assertEqual([b'b/1', b'b/2', b'b/3'],
+                         [v for v, _ in client.get_prefix('b/')])
+        values = client.get_prefix('b/', sort_order='descend')
+        self.assertEqual([b'b/3', b'b/2', b'b/1'], [v for v, _ in values])
+        client.delete_prefix('b/')
+        self.assertEqual([b'a', b'c'], [v for v, _ in client.get_all()])
+
+    def test_read_at_revision(self):
+        client = self.client
+        client.put('a', '1')
+        revision = self.etcd.revision
+        client.put('a', '2')
+        client.put('b', '3')
+        self.assertEqual(b'1', self._get_at('a', revision))
+        self.assertIsNone(self._get_at('b', revision))
+
+    def _get_at(self, key, revision):
+        response = self.etcd.Range(etcdrpc.RangeRequest(key=key.encode(),
+                                                        revision=revision))
+        return response.kvs[0].value if response.kvs else None
+
+    def test_transaction(self):
+        client = self.client
+        t = client.transactions
+        client.put('a', '1')
+        revision = self.etcd.revision
+        ok, _ = client.transaction(compare=[t.value('a') == '1'],
+                                   success=[t.put('a', '2'), t.put('b', '2')],
+                                   failure=[t.put('a', 'failed')])
+        self.assertTrue(ok)
+        # A transaction applies at a single revision
+        self.assertEqual(revision + 1, self.etcd.revision)
+        self.assertEqual(b'2', client.get('b')[0])
+        ok, responses = client.transaction(compare=[t.version('a') > 5],
+                                           success=[],
+                                           failure=[t.get('a')])
+        self.assertFalse(ok)
+        self.assertEqual(b'2', responses[0][0][0])
+        ok, _ = client.transaction(compare=[t.value('missing') == ''],
+                                   success=[],
+                                   failure=[])
+        self.assertFalse(ok)
+        # Read-only transactions don't create revisions
+        self.assertEqual(revision + 1, self.etcd.revision)
+
+    def test_watch(self):
+        client = self.client
+        client.put('w/a', '1')
+        revision = self.etcd.revision
+        client.put('w/b', '2')
+        client.put('x', '3')
+        events = []
+        watch_id = client.add_watch_callback('w/',
+                                             events.append,
+                                             range_end='w0',
+                                             start_revision=revision)
+        client.delete('w/a')
+        self.assertTrue(_wait_for(lambda: len(events) == 3))
+        self.assertEqual([(b'w/a', b'1'), (b'w/b', b'2'), (b'w/a', b'')],
+                         [(e.key, e.value) for e in events])
+        self.assertEqual('DeleteEvent', type(events[2]).__name__)
+        client.cancel_watch(watch_id)
+        client.put('w/c', '4')
+        time.sleep(0.05)
+        self.assertEqual(3, len(events))
+
+    def test_compaction(self):
+        client = self.client
+        client.put('a', '1')
+        client.put('b', '1')
+        client.delete('b')
+        revision = self.etcd.revision
+        client.put('a', '2')
+        client.compact(revision)
+        self.assertEqual(b'2', client.get('a')[0])
+        self.assertEqual(b'1', self._get_at('a', revision))
+        self.assertRaises(RevisionCompactedError,
+                          client.add_watch_callback,
+                          'a',
+                          print,
+                          start_revision=revision - 1)
+
+    def test_break_watches(self):
+        events = []
+        self.client.add_watch_callback('a', events.append)
+        self.etcd.break_watches()
+        self.client.put('a', '1')
+        self.assertTrue(_wait_for(lambda: events))
+        time.sleep(0.05)
+        self.assertEqual(1, len(events))
+        self.assertIsInstance(events[0], ConnectionError)
+
+    def test_failing_callback_is_logged(self):
+        def callback(event):
+            raise ValueError('Bad event')
+
+        self.client.add_watch_callback('a', callback)
+        with self.assertLogs('conman.fake_etcd', 'ERROR') as logs:
+            self.client.put('a', '1')
+            self.client.put('a', '2')
+            self.assertTrue(_wait_for(lambda: len(logs.output) == 2))
+        self.assertIn('Bad event', logs.output[0])
+
+
+class ConManFakeEtcdTest(TestCase):
+    def setUp(self):
+        self.etcd = FakeEtcd()
+        self.client = self.etcd.client()
+        set_key(self.client, 'good', dict(a='1', b=dict(c='2')))
+        self.conmans = []
+
+    def tearDown(self):
+        for conman in self.conmans:
+            conman.close()
+        self.client.close()
+
+    def _conman(self, **kwargs):
+        conman = ConManEtcd(client=self.client, **kwargs)
+        self.conmans.append(conman)
+        return conman
+
+    def test_add_key(self):
+        conman = self._conman()
+        conman.add_key('good')
+        self.assertEqual(dict(a='1', b=dict(c='2')), conman['good'])
+        conman = self._conman(page_size=1)
+        conman.add_key('good')
+        self.assertEqual(dict(a='1', b=dict(c='2')), conman['good'])
+        self.assertEqual(2, conman.last_load_stats['pages'])
+
+    def test_paged_add_keys_and_refresh(self):
+        set_key(self.client, 'other', dict(w='1', x='1', y='1', z='1'))
+        conman = self._conman(page_size=3)
+        revision = self.etcd.revision
+        range_ = self.etcd.Range
+
+        def racing_range(request, *args, **kwargs):
+            response = range_(request, *args, **kwargs)
+            # Committed after every page
+            self.client.put('other/x', str(self.etcd.revision + 1))
+            return response
+
+        with mock.patch.object(self.etcd, 'Txn') as txn, \
+                mock.patch.object(self.etcd, 'Range', racing_range):
+            conman.add_keys(['good', 'other'])
+            self.assertEqual(dict(w='1', x='1', y='1', z='1'),
+                             conman['other'])
+            self.assertEqual(dict(good=revision, other=revision),
+                             conman._revisions)
+            self.assertEqual(3, conman.last_load_stats['pages'])
+            self.assertEqual(6, conman.last_load_stats['keys'])
+            revision = self.etcd.revision
+            conman.refresh()
+            self.assertEqual(str(revision), conman['other']['x'])
+            self.assertEqual(dict(good=revision, other=revision),
+                             conman._revisions)
+            self.assertEqual(3, conman.last_load_stats['pages'])
+            txn.assert_not_called()
+
+    def test_lazy(self):
+        conman = self._conman()
+        conman.add_key('good', lazy=True)
+        self.assertEqual(dict(c='2'), dict(conman['good']['b']))
+
+    def test_watch(self):
+        conman = self._conman()
+        conman.add_key('good', watch=True)
+        self.client.put('good/b/d', '3')
+        self.assertTrue(_wait_for(lambda: conman.get('good/b/d') == '3'))
+        self.etcd.break_watches()
+        self.client.put('good/a', '4')
+        self.assertTrue(_wait_for(lambda: conman.get('good/a') == '4'))
+        self.assertEqual(1, conman._watches.stats['resumes'])
+
+    def test_watch_resyncs_after_compaction(self):
+        conman = self._conman()
+        conman.add_key('good', watch=True)
+        self.etcd.break_watches()
+        self.client.put('good/a', '5')
+        self.client.compact(self.etcd.revision)
+        self.assertTrue(_wait_for(lambda: conman.get('good/a') == '5'))
+
+    def test_put_tree(self):
+        conman = self._conman()
+        conman.add_key('good')
+        conman.put_tree('good', dict(a='1', x=dict(y='2')))
+        self.assertEqual(dict(a='1', x=dict(y='2')), conman['good'])
+        self.assertEqual(dict(puts=1, deletes=1, unchanged=1, txns=1),
+                         {k: conman.last_write_stats[k]
+                          for k in ('puts', 'deletes', 'unchanged', 'txns')})
+
+    def test_put_tree_keeps_concurrent_writes(self):
+        conman = self._conman()
+        conman.add_key('good', watch=True)
+        txn = conman._txn
+
+        def racing_txn(ops):
+            # Committed after put_tree read the key
+            self.client.put('good/other', 'x')
+            return txn(ops)
+
+        conman._txn = racing_txn
+        conman.put_tree('good', dict(a='2', b=dict(c='2')))
+        time.sleep(0.05)
+        self.assertEqual(dict(a='2', b=dict(c='2'), other='x'),
+                         conman['good'])
+
+    def _cache_file(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return os.path.join(cache_dir, 'cache')
+
+    def test_cache_writes_are_coalesced(self):
+        for i in range(20):
+            set_key(self.client, 'key_%d' % i, dict(a=str(i)))
+        conman = self._conman(cache_file=self._cache_file())
+        write_snapshot = conman_etcd.write_snapshot
+        release = threading.Event()
+
+        def slow_write_snapshot(*args):
+            release.wait(3)
+            write_snapshot(*args)
+
+        with mock.patch.object(conman_etcd,
+                               'write_snapshot',
+                               side_effect=slow_write_snapshot) as write:
+            # The loads don't wait for the writes
+            for i in range(20):
+                conman.add_key('key_%d' % i)
+            release.set()
+            conman.close()
+        self.assertEqual(2, write.call_count)
+        cached = self._conman(cache_file=conman.cache_file)
+        cached._revalidate = lambda keys, watch: None
+        cached.add_keys(['key_%d' % i for i in range(20)])
+        self.assertEqual(dict(a='19'), cached['key_19'])
+
+    def test_deleted_cached_keys_are_dropped(self):
+        set_key(self.client, 'gone', dict(a='1'))
+        conman = self._conman(cache_file=self._cache_file())
+        conman.add_keys(['good', 'gone'])
+        conman.close()
+        self.client.delete_prefix('gone')
+
+        conman = self._conman(cache_file=conman.cache_file)
+        conman.add_keys(['good', 'gone'])
+        self.assertTrue(_wait_for(lambda: not conman.stale_keys))
+        self.assertNotIn('gone', conman._conf)
+        self.assertEqual(['good'], list(conman._revisions))
+
+    def test_put_tree_of_lazy_key(self):
+        set_key(self.client, 'lz', {'1': dict(a='v1'), '2': dict(a='v2')})
+        conman = self._conman(page_size=10)
+        conman.add_key('lz', lazy=True)
+        self.assertEqual('v1', conman['lz']['1']['a'])
+        stats = conman.last_load_stats
+        conman.put_tree('lz', {'1': dict(a='new'), '3': dict(a='v3')})
+        self.assertIs(stats, conman.last_load_stats)
+        self.assertEqual(['1', '3'], sorted(conman['lz']))
+        self.assertEqual('new', conman['lz']['1']['a'])
+        self.assertEqual('v3', conman['lz']['3']['a'])
+
+    def test_client_not_closed(self):
+        self._conman().close()
+        self.assertEqual(b'1', self.client.get('good/a')[0])
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from conman.conman_base import ConManBase
+from conman.conman_file import ConManFile
+from conman.instrumentation import Instrumentation, Recorder, count_leaves
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.recorder = Recorder()
+        fd, self.filename = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(a=dict(b='1', c='2'), d='3'), f)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_noop_default(self):
+        conman = ConManFile([self.filename])
+        self.assertIs(type(conman.instrumentation), Instrumentation)
+
+    def test_file_load(self):
+        conman = ConManFile([self.filename], instrumentation=self.recorder)
+        d = self.recorder.to_dict()
+        load = d['loads']['file']
+        self.assertEqual(1, load['count'])
+        self.assertEqual(2, load['keys'])
+        self.assertEqual(os.path.getsize(self.filename), load['bytes'])
+        self.assertGreater(load['seconds'], 0)
+        parse = d['parses']['json']
+        self.assertEqual(1, parse['count'])
+        self.assertEqual(os.path.getsize(self.filename), parse['bytes'])
+        self.assertEqual(dict(version=conman.snapshot().version, leaves=3),
+                         d['tree'])
+
+        with open(self.filename, 'w') as f:
+            json.dump(dict(d='4'), f)
+        conman._reload([self.filename])
+        d = self.recorder.to_dict()
+        self.assertEqual(2, d['loads']['file']['count'])
+        self.assertEqual(2, d['parses']['json']['count'])
+        self.assertEqual(1, d['tree']['leaves'])
+
+    def test_published(self):
+        conman = ConManBase(instrumentation=self.recorder)
+        conman._publish(dict(a=dict(b='1')))
+        conman._set_path('a/c', '2')
+        self.assertEqual(dict(version=2, leaves=2),
+                         self.recorder.to_dict()['tree'])
+
+    def test_count_leaves(self):
+        conman = ConManBase(compact=True)
+        conman._publish(dict(a=dict(b='1', c=dict(d=[1, 2])), e={}))
+        self.assertEqual(2, count_leaves(conman.snapshot().tree))
+
+    def test_to_prometheus(self):
+        recorder = self.recorder
+        recorder.loaded('etcd', ['a'], 0.5, 10, 100)
+        recorder.retried('load', 2)
+        recorder.parsed('yaml', 0.25, 1000)
+        recorder.watch_event('a', 12, 3, 0.001)
+        recorder.watch_event('a', 13, 1, 0.001)
+        lines = recorder.to_prometheus().splitlines()
+        self.assertIn('# TYPE conman_loads_total counter', lines)
+        self.assertIn('conman_loads_total{source="etcd"} 1', lines)
+        self.assertIn('conman_load_seconds_total{source="etcd"} 0.5', lines)
+        self.assertIn('conman_load_keys_total{source="etcd"} 10', lines)
+        self.assertIn('conman_load_bytes_total{source="etcd"} 100', lines)
+        self.assertIn('conman_retries_total{operation="load"} 2', lines)
+        self.assertIn('conman_parse_seconds_total{format="yaml"} 0.25', lines)
+        self.assertIn('conman_watch_events_total 2', lines)
+        self.assertIn('conman_watch_lag_revisions 1', lines)
+        self.assertIn('conman_watch_max_lag_revisions 3', lines)
+        self.assertIn('conman_watch_revision 13', lines)
+        self.assertIn('conman_tree_leaves 0', lines)
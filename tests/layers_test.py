@@ -0,0 +1,114 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from conman.conman_file import ConManFile
+from conman.layers import LayeredConfig, LayeredConMan, changed_paths
+
+
+class LayeredConfigTest(TestCase):
+    def setUp(self):
+        self.layers = LayeredConfig()
+        self.layers.set_layer('defaults', dict(a=1,
+                                               db=dict(host='a', port=1),
+                                               tags=['x']))
+        self.layers.set_layer('site', dict(db=dict(host='b'), tags=['y']))
+
+    def test_deep_merge(self):
+        expected = dict(a=1, db=dict(host='b', port=1), tags=['y'])
+        self.assertEqual(expected, self.layers.tree)
+        self.assertEqual({'a': 1,
+                          'db/host': 'b',
+                          'db/port': 1,
+                          'tags': ['y']}, self.layers.resolved)
+        self.assertEqual('site', self.layers.provenance('db/host'))
+        self.assertEqual('defaults', self.layers.provenance('db/port'))
+        self.assertEqual('b', self.layers.get('db/host'))
+        self.assertEqual(['defaults', 'site'], self.layers.layers)
+
+    def test_layers_are_not_modified(self):
+        defaults = dict(db=dict(host='a'))
+        site = dict(db=dict(port=2))
+        layers = LayeredConfig()
+        layers.set_layer('defaults', defaults)
+        tree = layers.tree
+        layers.set_layer('site', site)
+        self.assertEqual(dict(db=dict(host='a')), defaults)
+        self.assertEqual(dict(db=dict(port=2)), site)
+        self.assertEqual(dict(db=dict(host='a')), tree)
+
+    def test_value_replaces_subtree(self):
+        self.layers.set_layer('local', dict(db='sqlite'))
+        self.assertEqual('sqlite', self.layers.tree['db'])
+        self.assertEqual({'a': 1, 'db': 'sqlite', 'tags': ['y']},
+                         self.layers.resolved)
+        self.assertEqual('local', self.layers.provenance('db'))
+
+        # Earlier values under the replaced subtree don't come back
+        self.layers.set_layer('top', dict(db=dict(name='n')))
+        self.assertEqual(dict(name='n'), self.layers.tree['db'])
+        self.assertIsNone(self.layers.provenance('db/host'))
+
+        # Unless the replacing value goes away
+        self.layers.remove_layer('local')
+        self.assertEqual(dict(host='b', port=1, name='n'),
+                         self.layers.tree['db'])
+
+    def test_change_recomputes_only_changed_paths(self):
+        self.layers.set_layer('site', dict(db=dict(host='c'), tags=['y']))
+        self.assertEqual('c', self.layers.get('db/host'))
+        self.assertEqual(1, self.layers.get('db/port'))
+
+        tree = self.layers.tree
+        recomputed = self.layers.stats['recomputed']
+        paths = self.layers.set_layer('site', dict(db=dict(host='d'),
+                                                   tags=['y']))
+        self.assertEqual([('db', 'host')], paths)
+        self.assertEqual(recomputed + 1, self.layers.stats['recomputed'])
+        self.assertEqual('d', self.layers.get('db/host'))
+        # Unchanged subtrees are shared
+        self.assertIs(tree['tags'], self.layers.tree['tags'])
+
+    def test_remove_layer(self):
+        self.layers.remove_layer('site')
+        self.assertEqual(dict(a=1, db=dict(host='a', port=1), tags=['x']),
+                         self.layers.tree)
+        self.assertEqual('defaults', self.layers.provenance('db/host'))
+        self.layers.remove_layer('defaults')
+        self.assertEqual({}, self.layers.tree)
+        self.assertEqual({}, self.layers.resolved)
+
+    def test_changed_paths(self):
+        shared = dict(x=1)
+        old = dict(a=1, b=dict(c=2, d=shared), e=dict(f=1))
+        new = dict(a=1, b=dict(c=3, d=shared), e=5, g=dict(h=1))
+        self.assertEqual({('b', 'c'), ('e',), ('g',)},
+                         set(changed_paths(old, new)))
+
+
+class LayeredConManTest(TestCase):
+    def _file(self, content):
+        f = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        f.write(json.dumps(content).encode())
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_layered_conmans(self):
+        defaults = ConManFile([self._file(dict(db=dict(host='a', port=1)))])
+        local_file = self._file(dict(db=dict(host='b')))
+        local = ConManFile([local_file])
+        c = LayeredConMan([('defaults', defaults), ('local', local)])
+        self.assertEqual(dict(host='b', port=1), c['db'])
+        self.assertEqual('local', c.provenance('db/host'))
+
+        # A change of a source is merged in
+        local._set_path('db/port', 2)
+        self.assertEqual(dict(host='b', port=2), c['db'])
+        self.assertEqual(2, c.get('db/port'))
+        self.assertEqual('local', c.provenance('db/port'))
+
+        c.close()
+        local._set_path('db/port', 3)
+        self.assertEqual(2, c.get('db/port'))
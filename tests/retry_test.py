@@ -0,0 +1,114 @@
+import asyncio
+from unittest import TestCase
+
+import grpc
+from etcd3.exceptions import ConnectionFailedError, RevisionCompactedError
+from conman.retry import RetryPolicy, is_retryable, thrice
+
+
+class Flaky(object):
+    """Fails with the given errors, then returns 'ok'"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class RpcError(grpc.RpcError):
+    def __init__(self, code, details):
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+
+class RetryPolicyTest(TestCase):
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(ConnectionFailedError()))
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertFalse(is_retryable(RevisionCompactedError(1)))
+        self.assertFalse(is_retryable(Exception('Empty result')))
+        exhausted = grpc.StatusCode.RESOURCE_EXHAUSTED
+        self.assertTrue(is_retryable(
+            RpcError(exhausted, 'etcdserver: too many requests')))
+        self.assertFalse(is_retryable(RpcError(
+            exhausted,
+            'Received message larger than max (5345594 vs. 4194304)')))
+        self.assertFalse(is_retryable(
+            RpcError(grpc.StatusCode.INVALID_ARGUMENT, 'bad')))
+
+    def test_retries_retryable_errors(self):
+        f = Flaky(ConnectionFailedError(), ConnectionFailedError())
+        policy = RetryPolicy(base_delay=0, max_delay=0)
+        self.assertEqual('ok', policy.call(f))
+        self.assertEqual(3, f.calls)
+        self.assertEqual(1, policy.stats['calls'])
+        self.assertEqual(3, policy.stats['attempts'])
+        self.assertEqual(2, policy.stats['retries'])
+        self.assertEqual(0, policy.stats['failures'])
+
+    def test_does_not_retry_other_errors(self):
+        f = Flaky(ValueError())
+        policy = RetryPolicy(base_delay=0, max_delay=0)
+        self.assertRaises(ValueError, policy.call, f)
+        self.assertEqual(1, f.calls)
+        self.assertEqual(1, policy.stats['failures'])
+
+    def test_max_attempts(self):
+        f = Flaky(*[ConnectionFailedError()] * 5)
+        policy = RetryPolicy(max_attempts=4, base_delay=0, max_delay=0)
+        self.assertRaises(ConnectionFailedError, policy.call, f)
+        self.assertEqual(4, f.calls)
+
+    def test_deadline(self):
+        f = Flaky(*[ConnectionFailedError()] * 5)
+        policy = RetryPolicy(max_attempts=None,
+                             base_delay=10,
+                             max_delay=10,
+                             deadline=1)
+        self.assertRaises(ConnectionFailedError, policy.call, f)
+        self.assertEqual(1, f.calls)
+
+    def test_backoff_is_jittered_and_capped(self):
+        policy = RetryPolicy(base_delay=0.1, max_delay=2)
+        delays = policy.backoff()
+        values = [next(delays) for _ in range(100)]
+        self.assertTrue(all(0.1 <= d <= 2 for d in values))
+        self.assertGreater(len(set(values)), 1)
+
+    def test_on_attempt(self):
+        attempts = []
+        policy = RetryPolicy(
+            base_delay=0,
+            max_delay=0,
+            on_attempt=lambda n, t, e: attempts.append((n, type(e))))
+        policy.call(Flaky(ConnectionFailedError()))
+        expected = [(1, ConnectionFailedError), (2, type(None))]
+        self.assertEqual(expected, attempts)
+
+    def test_call_async(self):
+        f = Flaky(ConnectionFailedError())
+
+        async def call():
+            return f()
+
+        policy = RetryPolicy(base_delay=0, max_delay=0)
+        self.assertEqual('ok', asyncio.run(policy.call_async(call)))
+        self.assertEqual(2, f.calls)
+
+    def test_thrice(self):
+        f = Flaky(ValueError(), ValueError())
+        self.assertEqual('ok', thrice(delay=0)(f)())
+        f = Flaky(ValueError(), ValueError(), ValueError())
+        self.assertRaises(ValueError, thrice(delay=0)(f))
+        self.assertEqual(3, f.calls)
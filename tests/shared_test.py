@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import Mapping
+from unittest import TestCase
+
+from conman.conman_base import ConManBase
+from conman.conman_etcd import ConManEtcd
+from conman.etcd_test_util import set_key
+from conman.fake_etcd import FakeEtcd
+from conman.shared import (ConManShared,
+                           SnapshotFile,
+                           SnapshotPublisher,
+                           write_snapshot)
+
+
+def _read_in_child(filename, queue):
+    queue.put(ConManShared(filename).get('svc/db/host'))
+
+
+class SharedTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'snapshot')
+        self.tree = dict(svc=dict(db=dict(host='db.example.com', port=5432),
+                                  tags=['a', 'b'],
+                                  a='leaf',
+                                  **{'a-b': 'dash', 'a.b': 'dot'}),
+                         top='1',
+                         enabled=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _wait_for(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                self.fail('Timed out')
+            time.sleep(0.01)
+
+    def test_read_snapshot_file(self):
+        write_snapshot(self.filename, self.tree, 3, dict(revisions={'x': 7}))
+        snapshot = SnapshotFile(self.filename)
+        self.assertEqual(3, snapshot.version)
+        self.assertEqual(dict(revisions={'x': 7}), snapshot.metadata)
+        self.assertEqual(self.tree, snapshot)
+        self.assertEqual('1', snapshot['top'])
+        self.assertIs(True, snapshot['enabled'])
+        self.assertEqual(5432, snapshot['svc']['db']['port'])
+        self.assertEqual(['a', 'b'], snapshot['svc']['tags'])
+        self.assertIsInstance(snapshot['svc'], Mapping)
+        self.assertEqual(['a', 'a-b', 'a.b', 'db', 'tags'],
+                         sorted(snapshot['svc']))
+        self.assertEqual(5, len(snapshot['svc']))
+        self.assertIn('db', snapshot['svc'])
+        self.assertNotIn('d', snapshot['svc'])
+        self.assertRaises(KeyError, lambda: snapshot['svc']['nope'])
+        self.assertRaises(KeyError, lambda: snapshot['nope'])
+
+    def test_to_dict(self):
+        write_snapshot(self.filename, self.tree)
+        snapshot = SnapshotFile(self.filename)
+        self.assertEqual(self.tree, snapshot.to_dict())
+        self.assertEqual(dict(svc=dict(db=self.tree['svc']['db'])),
+                         snapshot.to_dict('svc/db'))
+        # Like etcd prefixes, the prefix may end in the middle of a name
+        self.assertEqual(dict(svc={'a': 'leaf', 'a-b': 'dash', 'a.b': 'dot'}),
+                         snapshot.to_dict('svc/a'))
+        self.assertEqual({}, snapshot.to_dict('nope'))
+
+    def test_get(self):
+        write_snapshot(self.filename, self.tree)
+        conman = ConManShared(self.filename)
+        self.assertEqual('db.example.com', conman.get('svc/db/host'))
+        self.assertEqual('db.example.com', conman.get('svc.db.host'))
+        self.assertEqual('dot', conman.get('svc/a.b'))
+        self.assertEqual(self.tree['svc']['db'], conman.get('svc/db'))
+        self.assertEqual('x', conman.get('svc/nope', 'x'))
+        self.assertIsNone(conman.get('svc/db/host/nope'))
+        self.assertEqual(self.tree['svc'], conman['svc'])
+
+    def test_missing_file(self):
+        self.assertRaises(Exception, ConManShared, self.filename)
+
+    def test_publisher(self):
+        conman = ConManBase()
+        conman._publish(self.tree)
+        publisher = SnapshotPublisher(conman, self.filename, interval=0)
+        shared = ConManShared(self.filename, check_interval=0)
+        self.assertEqual(conman.snapshot().version, shared.version)
+        self.assertEqual('db.example.com', shared.get('svc/db/host'))
+
+        old = shared.snapshot()
+        conman._set_path('svc/db/host', 'new.example.com')
+        self._wait_for(lambda: shared.get('svc/db/host') ==
+                       'new.example.com')
+        self.assertEqual(conman.snapshot().version, shared.version)
+        # The old snapshot stays readable and consistent
+        self.assertEqual('db.example.com', old['svc']['db']['host'])
+
+        conman._delete_path('svc/db')
+        publisher.close()
+        self.assertTrue(shared.refresh())
+        self.assertNotIn('db', shared['svc'])
+        self.assertFalse(shared.refresh())
+
+    def test_publisher_leaves_lazy_keys_out(self):
+        client = FakeEtcd().client()
+        self.addCleanup(client.close)
+        set_key(client, 'good', dict(a='1'))
+        set_key(client, 'big', {str(i): dict(a='1') for i in range(50)})
+        conman = ConManEtcd(client=client, subtree_cache_size=10)
+        self.addCleanup(conman.close)
+        conman.add_key('good')
+        conman.add_key('big', lazy=True)
+        conman._fetch_subtree = None
+        SnapshotPublisher(conman, self.filename).close()
+        snapshot = SnapshotFile(self.filename)
+        self.assertEqual(dict(good=dict(a='1')), snapshot.to_dict())
+        self.assertEqual(dict(good=conman._revisions['good']),
+                         snapshot.metadata['revisions'])
+
+    def test_stale_check_interval(self):
+        write_snapshot(self.filename, self.tree, 1)
+        shared = ConManShared(self.filename, check_interval=3600)
+        write_snapshot(self.filename, dict(top='2'), 2)
+        self.assertTrue(shared.is_stale())
+        self.assertEqual('1', shared['top'])
+        self.assertTrue(shared.refresh())
+        self.assertEqual('2', shared['top'])
+        self.assertEqual(2, shared.version)
+
+    def test_read_in_forked_worker(self):
+        write_snapshot(self.filename, self.tree)
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        p = ctx.Process(target=_read_in_child, args=(self.filename, queue))
+        p.start()
+        self.assertEqual('db.example.com', queue.get(timeout=10))
+        p.join()
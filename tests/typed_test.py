@@ -0,0 +1,87 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from conman.conman_file import ConManFile
+from conman.typed import TypedView, to_bool, to_duration
+
+
+class TypedViewTest(TestCase):
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile(suffix='.ini', delete=False)
+        f.write(b'[svc]\ntimeout = 1m30s\nworkers = 4\ndebug = yes\n'
+                b'ratio = 0.5\nhosts = ["a", "b"]\nbad = x\n')
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        self.conman = ConManFile([f.name])
+
+    def test_accessors(self):
+        typed = TypedView(self.conman)
+        self.assertEqual(90.0, typed.get_duration('svc/timeout'))
+        self.assertEqual(4, typed.get_int('svc/workers'))
+        self.assertEqual(4.0, typed.get_float('svc.workers'))
+        self.assertIs(True, typed.get_bool('svc/debug'))
+        self.assertEqual(0.5, typed.get_as('svc/ratio', 'float'))
+        self.assertEqual(['a', 'b'], typed.get_json('svc/hosts'))
+        self.assertEqual('4', typed.get_str('svc/workers'))
+        self.assertEqual(7, typed.get_int('svc/nope', 7))
+        self.assertRaises(ValueError, typed.get_int, 'svc/bad')
+        self.assertRaises(ValueError, typed.get_int, 'svc/bad')
+
+    def test_values_are_converted_once(self):
+        convert = mock.Mock(side_effect=int)
+        typed = TypedView(self.conman)
+        for _ in range(3):
+            self.assertEqual(4, typed.get_as('svc/workers', convert))
+        self.assertEqual(1, convert.call_count)
+
+        # Only the changed value is converted again
+        self.conman._set_path('svc/timeout', '5s')
+        self.assertEqual(4, typed.get_as('svc/workers', convert))
+        self.assertEqual(1, convert.call_count)
+        self.conman._set_path('svc/workers', '8')
+        self.assertEqual(8, typed.get_as('svc/workers', convert))
+        self.assertEqual(2, convert.call_count)
+
+    def test_schema_is_converted_on_publish(self):
+        convert = mock.Mock(side_effect=int)
+        typed = TypedView(self.conman, schema={'svc/workers': convert,
+                                               'svc/timeout': 'duration',
+                                               'svc/bad': 'int'})
+        self.assertEqual(1, convert.call_count)
+        self.conman._set_path('svc/workers', '8')
+        self.assertEqual(2, convert.call_count)
+        self.conman._set_path('svc/debug', 'no')
+        self.assertEqual(2, convert.call_count)
+        self.assertEqual(8, typed.get('svc/workers'))
+        self.assertEqual(90.0, typed.get('svc/timeout'))
+        self.assertEqual(2, convert.call_count)
+        self.assertRaises(ValueError, typed.get, 'svc/bad')
+
+        self.conman._delete_path('svc/workers')
+        self.assertIsNone(typed.get('svc/workers'))
+        typed.close()
+        self.conman._set_path('svc/workers', '9')
+        self.assertEqual(2, convert.call_count)
+        self.assertEqual(9, typed.get('svc/workers'))
+
+    def test_unknown_type(self):
+        self.assertRaises(Exception, TypedView, self.conman, dict(a='nope'))
+
+    def test_to_bool(self):
+        for v in ['true', 'Yes', 'ON', '1', 1, True]:
+            self.assertIs(True, to_bool(v))
+        for v in ['false', 'No', 'off', '0', 0, False]:
+            self.assertIs(False, to_bool(v))
+        for v in ['maybe', 2, None]:
+            self.assertRaises(ValueError, to_bool, v)
+
+    def test_to_duration(self):
+        self.assertEqual(30.0, to_duration('30'))
+        self.assertEqual(30.0, to_duration(30))
+        self.assertEqual(0.25, to_duration('250ms'))
+        self.assertEqual(5400.0, to_duration('1h30m'))
+        self.assertEqual(1.5, to_duration('1.5s'))
+        self.assertEqual(86400.0 + 1, to_duration('1d1s'))
+        for v in ['', 'abc', '5x', '1h 30m', '10s5', True]:
+            self.assertRaises(ValueError, to_duration, v)